@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of Record.get_values() for records with many photo fields.
+
+Compares serialization with media index shared by all values of record
+(Record.get_values()) with index built for each value separately
+(Value.get_value() called without media index).
+
+Objects are not stored in db, so this measures serialization only.
+
+usage:
+
+    python benchmarks/get_values.py [--fields N] [--photos N] [--records N]
+"""
+
+import argparse
+import tempfile
+import timeit
+
+from pyfulcrum.lib.models import Form, Field, Record, Value, Media
+from pyfulcrum.lib.storage import Storage
+
+
+def make_record(storage, fields_count, photos_count):
+    form = Form(id='form', name='bench form', fields=[])
+    record = Record(id='record', form=form, form_id=form.id,
+                    values={}, created_by='bench')
+    for fidx in range(fields_count):
+        field = Field(id='f{}'.format(fidx), form=form, form_id=form.id,
+                      label='photos {}'.format(fidx), data_name='photos_{}'.format(fidx),
+                      type='PhotoField', required=False, disabled=False, hidden=False)
+        value = []
+        for pidx in range(photos_count):
+            media = Media(id='m{}-{}'.format(fidx, pidx), record=record,
+                          record_id=record.id, form_id=form.id,
+                          media_type=Media.MEDIA_PHOTO, content_type='image/jpeg',
+                          file_size=0, created_by='bench')
+            media.manifest = media.get_manifest(storage)
+            value.append({'photo_id': media.id, 'caption': None})
+        Value(id='v{}'.format(fidx), field=field, field_id=field.id,
+              record=record, record_id=record.id, value=value,
+              type=field.type, meta={}, removed=False)
+    return record
+
+
+def per_value_index(record, storage):
+    # each value builds its own media index
+    return dict((v.field.label, v.get_value(storage)) for v in record.values_list)
+
+
+def shared_index(record, storage):
+    return record.get_values(storage)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--fields', type=int, default=20, help="photo fields per record")
+    parser.add_argument('--photos', type=int, default=10, help="photos per field")
+    parser.add_argument('--records', type=int, default=50, help="records per run (page size)")
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        storage = Storage(root)
+        record = make_record(storage, args.fields, args.photos)
+        assert per_value_index(record, storage) == shared_index(record, storage)
+        print('{} records, {} photo fields, {} photos per field'
+              .format(args.records, args.fields, args.photos))
+        results = {}
+        for f in (per_value_index, shared_index,):
+            t = min(timeit.repeat(lambda: f(record, storage),
+                                  number=args.records, repeat=args.repeat))
+            results[f.__name__] = t
+            print(' {:<16} {:.4f}s'.format(f.__name__, t))
+        print(' speedup {:.2f}x'.format(results['per_value_index'] / results['shared_index']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark of stored payload size.
+
+Compares size of json payloads (as stored in payload column) with
+compressed payloads (payload_packed column), with and without keys
+duplicated in columns, and measures time of reading compressed payloads.
+
+Payloads are built from example api responses, with form values
+generated for given number of fields. Objects are not stored in db,
+so this measures serialization only.
+
+usage:
+
+    python benchmarks/payload_size.py [--fields N] [--records N]
+"""
+
+import argparse
+import json
+import os
+import timeit
+
+from pyfulcrum.lib import compression
+from pyfulcrum.lib.models import Record, Value
+
+EXAMPLES_DIR = os.path.join(os.path.dirname(__file__), '..', 'examples', 'api')
+
+
+def load_example(name):
+    with open(os.path.join(EXAMPLES_DIR, '{}.json'.format(name)), 'rt') as f:
+        return json.load(f)
+
+
+def make_payloads(fields_count, records_count):
+    base = load_example('records_find_4e1c33ad-5496-4818-826f-504e66239b4d')['record']
+    out = []
+    for ridx in range(records_count):
+        payload = dict(base)
+        payload['id'] = 'record-{}'.format(ridx)
+        payload['form_values'] = dict(('f{:04d}'.format(fidx),
+                                       'value {} of record {}'.format(fidx, ridx))
+                                      for fidx in range(fields_count))
+        out.append(payload)
+    return out
+
+
+def get_sizes(payloads):
+    """
+    Returns dictionary of storage variant -> total size in bytes
+    """
+    sizes = {'json': 0, 'compressed': 0, 'compressed delta': 0}
+    for payload in payloads:
+        record = Record(id=payload['id'], values=payload['form_values'])
+        sizes['json'] += len(json.dumps(payload))
+        sizes['compressed'] += len(compression.pack(payload))
+        record.set_payload(payload, compress=True)
+        sizes['compressed delta'] += len(record.payload_packed)
+        assert record.payload == payload
+        for field_id, field_value in payload['form_values'].items():
+            meta = {'key': field_id, 'value': field_value}
+            value = Value(id='{}_{}'.format(payload['id'], field_id), meta=meta)
+            sizes['json'] += len(json.dumps({'meta': meta}))
+            sizes['compressed'] += len(compression.pack({'meta': meta}))
+            value.set_payload({'meta': meta}, compress=True)
+            sizes['compressed delta'] += len(value.payload_packed)
+    return sizes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--fields', type=int, default=50, help="form fields per record")
+    parser.add_argument('--records', type=int, default=1000, help="number of records")
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    payloads = make_payloads(args.fields, args.records)
+    print('{} records, {} fields, codec: {}'
+          .format(args.records, args.fields, 'zstd' if compression.zstandard else 'zlib'))
+    sizes = get_sizes(payloads)
+    for name, size in sizes.items():
+        print(' {:<18} {:>12} bytes {:>6.1f}%'.format(name, size, 100.0 * size / sizes['json']))
+
+    texts = [json.dumps(p) for p in payloads]
+    packed = [compression.pack(p) for p in payloads]
+    t = min(timeit.repeat(lambda: [json.loads(p) for p in texts],
+                          number=1, repeat=args.repeat))
+    print(' {:<18} {:.4f}s'.format('json read', t))
+    t = min(timeit.repeat(lambda: [compression.unpack(p) for p in packed],
+                          number=1, repeat=args.repeat))
+    print(' {:<18} {:.4f}s'.format('compressed read', t))
+
+
+if __name__ == '__main__':
+    main()
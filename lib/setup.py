@@ -24,6 +24,8 @@ setup(
     packages=['pyfulcrum.lib'],
     setup_requires=['pytest-runner'],
     tests_requires=['pytest'],
+    extras_require={'zstd': ['zstandard'],
+                    'arrow': ['pyarrow']},
     test_packages=['pyfulcrum.lib.tests'],
     package_dir={'pyfulcrum': mpath('src/pyfulcrum/'),
                  'pyfulcrum.lib': mpath('src/pyfulcrum/lib'),
@@ -4,10 +4,11 @@
 import logging
 
 from fulcrum import Fulcrum as FC
-from .models import Session, Base, Project, Form, Record, Media, Field
+from .models import Session, Base, Project, Form, Record, Media, Field, Change
 from sqlalchemy.engine import Engine, create_engine
 from .storage import Storage
-from .formats import FORMATS
+from . import compression, flat, sqlite
+from .formats import FORMATS, STREAM_FORMATS
 
 
 log = logging.getLogger(__name__)
@@ -70,6 +71,11 @@ class BaseObjectManager(object):
         return self.model.get(obj_id, session=self.session, if_removed=if_removed)
 
     def remove(self, obj_id, cached=True, *args, **kwargs):
+        """
+        Marks object and its children as removed.
+        Returns number of rows marked as removed, or None if
+        object doesn't exist.
+        """
         obj = self.get(obj_id, cached=True)
         if obj:
             return obj.remove(self.session)
@@ -117,7 +123,7 @@ class BaseObjectManager(object):
         sync_removed = kwargs.pop('sync_removed', True)
 
         up = kwargs.get('url_params')
-        params = self.model.get_q_params(up)
+        params = self.model.get_q_params(up, session=self.session)
         if params:
             q = q.filter(*params)
         
@@ -182,7 +188,7 @@ class BaseObjectManager(object):
         
         if kwargs.get('url_params'):
             up = kwargs.get('url_params')
-            params = self.model.get_q_params(up)
+            params = self.model.get_q_params(up, session=self.session)
 
             return self.get_query().order_by('updated_at').filter(self.model.removed == True).filter(*params)
         return self.get_query().order_by('updated_at').filter(self.model.removed == True)
@@ -191,7 +197,7 @@ class BaseObjectManager(object):
     def get_query(self, session=None, is_spatial=False):
         if session is None:
             session = self.session
-        q = session.query(self.model)
+        q = session.query(self.model).options(*self.model.get_load_options())
         if is_spatial and getattr(self.model, 'point', None) is not None:
             q = q.filter(self.model.point != None)
         if self.default_item_args:
@@ -282,13 +288,25 @@ class ApiManager(object):
                 SignatureManager,
                 )
 
-    def __init__(self, db, client, storage):
+    def __init__(self, db, client, storage, flat_tables=False, compress_payloads=False):
+        """
+        @param db database url or Engine
+        @param client Fulcrum API key or client instance
+        @param storage Storage instance or storage configuration
+        @param flat_tables if True, flat per-form records tables will be
+               maintained, see pyfulcrum.lib.flat
+        @param compress_payloads if True, payloads will be stored compressed,
+               see pyfulcrum.lib.compression
+        """
         if isinstance(db, Engine):
             self.db = db
         else:
             self.db = create_engine(db)
+        sqlite.setup_engine(self.db)
         Session.configure(bind=self.db)
         self.session = Session()
+        self.session.info[flat.SESSION_KEY] = flat_tables
+        self.session.info[compression.SESSION_KEY] = compress_payloads
         Base.metadata.bind = db
         if isinstance(client, str):
             client = FC(client)
@@ -342,6 +360,28 @@ class ApiManager(object):
     def get_manager(self, mgr_name):
         return getattr(self, mgr_name)
 
+    def get_changes(self, since=None, resource=None):
+        """
+        Returns query with changes logged after given change id, in order.
+
+        @param since id of last read change, all changes are returned if None
+        @param resource optional resource name (records, photos..)
+        """
+        if resource is not None and resource not in self.manager_names:
+            raise ValueError("Invalid resource: {}".format(resource))
+        return Change.list(self.session, since=since, resource=resource)
+
+    def iter_changes(self, since=None, resource=None, batch_size=PER_PAGE):
+        """
+        Yields changes logged after given change id, read in batches
+        """
+        while True:
+            batch = self.get_changes(since=since, resource=resource).limit(batch_size).all()
+            if not batch:
+                return
+            yield from batch
+            since = batch[-1].id
+
     def initialize_managers(self):
         for el_cls in self.MANAGERS:
             el_name = el_cls.get_name()
@@ -366,6 +406,9 @@ class ApiManager(object):
         storage_cfg = {}
         storage_cfg['root_dir'] = str(cfg['root_dir'])
         storage_cfg['url_base'] = cfg.get('url_base')
+        for opt in ('layout', 'previous_layout', 'shard_depth', 'shard_width',):
+            if cfg.get(opt) is not None:
+                storage_cfg[opt] = cfg[opt]
         self.storage = Storage(**storage_cfg)
         return self.storage
 
@@ -373,5 +416,20 @@ class ApiManager(object):
         formatter = self.get_formatter(format)
         return formatter(item, self.storage, multiple, *args, **kwargs)
 
+    def as_stream(self, format, item, multiple=False, *args, **kwargs):
+        """
+        Returns iterable of encoded chunks of item(s) in given format.
+        Formats without streaming variant are returned in one chunk.
+        """
+        formatter = STREAM_FORMATS.get(format)
+        if formatter is None:
+            out = self.as_format(format, item, multiple, *args, **kwargs)
+            if not out:
+                return []
+            if isinstance(out, str):
+                out = out.encode('utf-8')
+            return [out]
+        return formatter(item, self.storage, multiple, *args, **kwargs)
+
     def get_formatter(self, format_name):
         return FORMATS[format_name]
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import csv
+import time
+import zipfile
+from io import StringIO
+
+from .storage import LAYOUT_FLAT
+
+# size of chunks read from files
+CHUNK_SIZE = 256 * 1024
+# number of rows fetched from db at once
+BATCH_SIZE = 500
+
+MANIFEST_NAME = 'manifest.csv'
+MANIFEST_HEADER = ('id', 'form_id', 'record_id', 'media_type', 'size',
+                   'content_type', 'file_size', 'path',)
+
+
+class StreamBuffer(object):
+    """
+    Write-only file-like object, which keeps written data until
+    it's drained. This allows to stream output of writers, which
+    expect file object (like zipfile.ZipFile), without keeping
+    whole output in memory or on disk.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        """
+        Returns data written since last call
+        """
+        out = b''.join(self._chunks)
+        self._chunks = []
+        return out
+
+
+def iter_file(path, chunk_size=CHUNK_SIZE):
+    """
+    Yields contents of file in chunks
+    """
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def iter_zip(entries, compression=zipfile.ZIP_STORED):
+    """
+    Streams zip archive. Yields chunks of archive as soon as they're
+    written, so memory usage doesn't depend on archive size.
+
+    @param entries iterable of (archive name, content) pairs, where content
+           is a path to file or iterable of bytes chunks
+    @param compression zipfile compression type
+    """
+    out = StreamBuffer()
+    with zipfile.ZipFile(out, mode='w', compression=compression, allowZip64=True) as zf:
+        for name, content in entries:
+            if isinstance(content, str):
+                date_time = time.localtime(os.path.getmtime(content))[:6]
+                content = iter_file(content)
+            else:
+                date_time = time.localtime()[:6]
+            zinfo = zipfile.ZipInfo(name, date_time=date_time)
+            zinfo.compress_type = compression
+            # size is not known upfront, so zip64 extensions are forced
+            with zf.open(zinfo, mode='w', force_zip64=True) as dest:
+                for chunk in content:
+                    dest.write(chunk)
+                    data = out.drain()
+                    if data:
+                        yield data
+            data = out.drain()
+            if data:
+                yield data
+    yield out.drain()
+
+
+def _iter_media_files(items, storage, sizes=None):
+    """
+    Yields (media, size, archive name, local path) for each stored file
+    in media query.
+    """
+    for item in items.yield_per(BATCH_SIZE):
+        for size in item.sizes:
+            if sizes and size not in sizes:
+                continue
+            # archive is always in flat layout
+            name = storage.get_common_path(item.form_id, item.record_id,
+                                           item.media_type, size,
+                                           item.content_type,
+                                           layout=LAYOUT_FLAT)
+            yield item, size, name, item.get_path(storage, size)
+
+
+def _iter_manifest(items, storage, sizes=None):
+    """
+    Yields manifest csv content for media bundle. Missing files are
+    listed with empty path.
+    """
+    out = StringIO()
+    w = csv.writer(out)
+    w.writerow(MANIFEST_HEADER)
+    for item, size, name, path in _iter_media_files(items, storage, sizes):
+        try:
+            file_size = os.path.getsize(path)
+        except OSError:
+            file_size, name = None, None
+        w.writerow((item.id, item.form_id, item.record_id, item.media_type, size,
+                    item.content_type, file_size, name,))
+        yield out.getvalue().encode('utf-8')
+        out.seek(0)
+        out.truncate()
+
+
+def iter_media_bundle(items, storage, sizes=None):
+    """
+    Streams zip archive with media files and manifest csv.
+
+    Query is iterated twice (first for manifest, then for files), so
+    neither memory nor temporary disk usage depend on bundle size.
+
+    @param items Media query
+    @param storage Storage instance
+    @param sizes list of sizes to include in bundle. All sizes are
+           included if empty.
+    """
+    def entries():
+        yield MANIFEST_NAME, _iter_manifest(items, storage, sizes)
+        for item, size, name, path in _iter_media_files(items, storage, sizes):
+            if os.path.exists(path):
+                yield name, path
+
+    return iter_zip(entries())
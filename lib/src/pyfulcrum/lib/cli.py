@@ -3,7 +3,12 @@
 
 import os
 import sys
+import gzip
+import json
+import time
+import logging
 import argparse
+from datetime import datetime, timedelta, timezone
 
 from cliff.app import App
 from cliff.command import Command
@@ -12,11 +17,18 @@ from cliff.show import ShowOne
 
 from fulcrum import Fulcrum
 from .api import Storage, ApiManager
-from .formats import FORMATS
+from .formats import FORMATS, LINE_FORMATS
+from .models import Media, Form, Project, Field, Record, Value
+from .archive import iter_media_bundle
+from .flat import get_table_name
+from .purge import purge
+from .storage import LAYOUTS, LAYOUT_FLAT
 
 
 AVAILABLE_FORMATS = list(sorted(FORMATS.keys()))
 
+log = logging.getLogger(__name__)
+
 def valid_format(value):
     if value in AVAILABLE_FORMATS:
         return value
@@ -46,11 +58,25 @@ class PyFulcrumApp(App):
                                  "only record objects.".format(','.join(AVAILABLE_FORMATS))),
         parser.add_argument('--output', type=str, nargs=1, required=False, default=tuple(),
                             help="Name of output file, standard output as default")
+        parser.add_argument('--storage-layout', type=str, nargs=1, required=False,
+                            default=(LAYOUT_FLAT,), choices=LAYOUTS, dest='storage_layout',
+                            help="Directory layout of storage (default: flat)")
+        parser.add_argument('--storage-previous-layout', type=str, nargs=1, required=False,
+                            default=(None,), choices=LAYOUTS, dest='storage_previous_layout',
+                            help="Layout storage is migrated from. Files will be looked up "
+                                 "in both layouts until migration is finished")
+        parser.add_argument('--flat-tables', action='store_true', default=False,
+                            dest='flat_tables',
+                            help="Maintain flat per-form records tables on ingest")
+        parser.add_argument('--compress-payloads', action='store_true', default=False,
+                            dest='compress_payloads',
+                            help="Store compressed payloads on ingest")
         return parser
 
 
     def initialize_app(self, argv):
-        commands = [List, Get, Remove, ListRemoved]
+        commands = [List, Get, Remove, ListRemoved, MigrateStorage, Bundle, Flatten, Purge,
+                    CompressPayloads, Changes]
 
         for command in commands:
             self.command_manager.add_command(command.__name__.lower(), command)
@@ -61,7 +87,11 @@ class PyFulcrumApp(App):
         client = Fulcrum(key=opts.apikey[0])
 
         self.api_manager = ApiManager(opts.dburl[0], client, {'root_dir': opts.storage[0],
-                                                              'url_base': opts.urlbase[0]})
+                                                              'url_base': opts.urlbase[0],
+                                                              'layout': opts.storage_layout[0],
+                                                              'previous_layout': opts.storage_previous_layout[0]},
+                                       flat_tables=opts.flat_tables,
+                                       compress_payloads=opts.compress_payloads)
 
 
 class _BaseCommand(Command):
@@ -83,6 +113,28 @@ class _BaseCommand(Command):
         else:
             print(output)
 
+    def write_stream(self, chunks, flush=False):
+        """
+        Writes iterable of bytes chunks to output as they come
+
+        @param flush if True, output is flushed after each chunk
+        """
+        output_f = self.app.options.output[0] if self.app.options.output else None
+        if output_f:
+            f = open(output_f, 'wb+')
+        else:
+            f = sys.stdout.buffer
+        try:
+            for chunk in chunks:
+                f.write(chunk)
+                if flush:
+                    f.flush()
+        finally:
+            if output_f:
+                f.close()
+            else:
+                f.flush()
+
     @staticmethod
     def is_urlparam(value):
         if len(value.split('=')) == 2:
@@ -138,8 +190,9 @@ class List(_BaseCommand):
                              url_params=url_params,
                              flush=True,
                              sync_removed=True)
-            output = api.as_format(format, items, multiple=True)
-            self.write_output(output)
+            # line formats are flushed per item, so consumer can read them as they come
+            self.write_stream(api.as_stream(format, items, multiple=True),
+                              flush=format in LINE_FORMATS)
 
 class Get(_BaseCommand):
     """
@@ -186,7 +239,11 @@ class Remove(_BaseCommand):
         with self.app.api_manager as api:
             mgr = api.get_manager(parsed_args.resource[0])
             obj_id = parsed_args.id[0]
-            item = mgr.remove(obj_id)
+            count = mgr.remove(obj_id)
+            item = None
+            if count is not None:
+                log.info("%s rows marked as removed", count)
+                item = mgr.get(obj_id, if_removed=True)
             output = api.as_format(format, item)
             self.write_output(output)
 
@@ -214,8 +271,215 @@ class ListRemoved(_BaseCommand):
             for un, uv in (parsed_args.urlparams or []):
                 url_params[un] = uv
             item = mgr.list_removed(url_params=url_params)
-            output = api.as_format(format, item, multiple=True)
-            self.write_output(output)
+            self.write_stream(api.as_stream(format, item, multiple=True))
+
+
+class Bundle(_BaseCommand):
+    """
+    Writes zip archive with media files and manifest csv
+    """
+
+    def get_parser(self, prog_name):
+        parser = super().get_parser(prog_name)
+        parser.add_argument('--urlparams',
+                            type=self.is_urlparam,
+                            required=False,
+                            nargs='+',
+                            help="list of name=value pairs of url params to pass to list")
+        parser.add_argument('--sizes',
+                            type=str,
+                            required=False,
+                            nargs='+',
+                            help="list of media sizes to include (default: all sizes)")
+        return parser
+
+    def take_action(self, parsed_args):
+        with self.app.api_manager as api:
+            mgr = api.get_manager(parsed_args.resource[0])
+            if mgr.model is not Media:
+                raise ValueError("Cannot bundle {} resource, only media resources are allowed"
+                                 .format(parsed_args.resource[0]))
+            url_params = {}
+            for un, uv in (parsed_args.urlparams or []):
+                url_params[un] = uv
+            items = mgr.list(cached=True, url_params=url_params)
+            self.write_stream(iter_media_bundle(items, api.storage, sizes=parsed_args.sizes))
+
+
+class MigrateStorage(Command):
+    """
+    Moves media files from previous storage layout to current one
+    """
+
+    def get_parser(self, prog_name):
+        parser = super().get_parser(prog_name)
+        parser.add_argument('--batch-size',
+                            type=int,
+                            dest='batch_size',
+                            default=1000,
+                            help="Number of files moved in one batch")
+        return parser
+
+    def take_action(self, parsed_args):
+        storage = self.app.api_manager.storage
+        if storage.previous_layout is None:
+            raise ValueError("Previous storage layout is not set, use --storage-previous-layout")
+        total = 0
+        for batch in storage.migrate_layout(batch_size=parsed_args.batch_size):
+            total += len(batch)
+            print('moved {} files ({} total)'.format(len(batch), total))
+        print('storage migrated from {} to {} layout, {} files moved'
+              .format(storage.previous_layout, storage.layout, total))
+        with self.app.api_manager as api:
+            updated = Media.refresh_manifests(api.session, storage,
+                                              batch_size=parsed_args.batch_size)
+        print('{} media manifests updated'.format(updated))
+
+
+class Flatten(Command):
+    """
+    Recreates flat per-form records tables
+    """
+
+    def get_parser(self, prog_name):
+        parser = super().get_parser(prog_name)
+        parser.add_argument('form_id',
+                            type=str,
+                            nargs='*',
+                            help="IDs of forms to process (default: all forms)")
+        return parser
+
+    def take_action(self, parsed_args):
+        with self.app.api_manager as api:
+            q = api.session.query(Form).filter(Form.removed == False)
+            if parsed_args.form_id:
+                q = q.filter(Form.id.in_(parsed_args.form_id))
+            for form in q.order_by(Form.id):
+                count = form.sync_flat_table(api.session, force=True)
+                print('{} ({}): {} records in {}'.format(form.id, form.name, count,
+                                                        get_table_name(form.id)))
+
+
+class Purge(Command):
+    """
+    Deletes resources marked as removed, which weren't updated for given number of days
+    """
+
+    def get_parser(self, prog_name):
+        parser = super().get_parser(prog_name)
+        parser.add_argument('--days',
+                            type=int,
+                            default=30,
+                            help="Purge resources removed at least this number of days ago")
+        parser.add_argument('--batch-size',
+                            type=int,
+                            dest='batch_size',
+                            default=1000,
+                            help="Number of rows deleted in one transaction")
+        parser.add_argument('--archive',
+                            type=str,
+                            required=False,
+                            help="Append purged rows as json lines to this file (gzipped if name ends with .gz)")
+        parser.add_argument('--delete-files',
+                            dest='delete_files',
+                            action='store_true',
+                            default=False,
+                            help="Remove files of purged media from storage")
+        return parser
+
+    def take_action(self, parsed_args):
+        before = datetime.now(timezone.utc) - timedelta(days=parsed_args.days)
+        archive = None
+        if parsed_args.archive:
+            if parsed_args.archive.endswith('.gz'):
+                archive = gzip.open(parsed_args.archive, 'at', encoding='utf-8')
+            else:
+                archive = open(parsed_args.archive, 'at', encoding='utf-8')
+        try:
+            with self.app.api_manager as api:
+                storage = api.storage if parsed_args.delete_files else None
+                stats = purge(api.session, before, storage=storage, archive=archive,
+                              batch_size=parsed_args.batch_size)
+        finally:
+            if archive is not None:
+                archive.close()
+        files = stats.pop('files')
+        for name, item in stats.items():
+            print('{:<16} {:>10} rows {:>14} bytes'.format(name, item['count'], item['bytes']))
+        print('{:<16} {:>10} rows {:>14} bytes'.format('total',
+                                                       sum(s['count'] for s in stats.values()),
+                                                       sum(s['bytes'] for s in stats.values())))
+        if parsed_args.delete_files:
+            print('{:<16} {:>10} files {:>13} bytes'.format('storage', files['count'], files['bytes']))
+
+
+class CompressPayloads(Command):
+    """
+    Compresses payloads stored before payloads compression was enabled
+    """
+
+    def get_parser(self, prog_name):
+        parser = super().get_parser(prog_name)
+        parser.add_argument('--batch-size',
+                            type=int,
+                            dest='batch_size',
+                            default=1000,
+                            help="Number of rows updated in one transaction")
+        return parser
+
+    def take_action(self, parsed_args):
+        with self.app.api_manager as api:
+            for model in (Project, Form, Field, Record, Value, Media,):
+                count = model.pack_payloads(api.session, batch_size=parsed_args.batch_size)
+                print('{:<16} {:>10} payloads compressed'.format(model.__tablename__, count))
+
+
+class Changes(_BaseCommand):
+    """
+    Writes changes logged after given change id as json lines
+    """
+
+    def get_parser(self, prog_name):
+        parser = super().get_parser(prog_name)
+        parser.add_argument('--since',
+                            type=int,
+                            required=False,
+                            help="ID of last read change (default: all changes)")
+        parser.add_argument('--resource',
+                            type=self.is_allowed_resource,
+                            required=False,
+                            help="Show only changes of this resource")
+        parser.add_argument('--batch-size',
+                            type=int,
+                            dest='batch_size',
+                            default=1000,
+                            help="Number of changes read in one query")
+        parser.add_argument('--follow',
+                            action='store_true',
+                            default=False,
+                            help="Wait for new changes")
+        parser.add_argument('--interval',
+                            type=float,
+                            default=10,
+                            help="Interval between checks for new changes in seconds")
+        return parser
+
+    def iter_changes(self, api, parsed_args):
+        since = parsed_args.since
+        while True:
+            for change in api.iter_changes(since=since, resource=parsed_args.resource,
+                                           batch_size=parsed_args.batch_size):
+                since = change.id
+                yield '{}\n'.format(json.dumps(change.as_dict())).encode('utf-8')
+            if not parsed_args.follow:
+                return
+            # end transaction, so new changes are visible
+            api.session.rollback()
+            time.sleep(parsed_args.interval)
+
+    def take_action(self, parsed_args):
+        with self.app.api_manager as api:
+            self.write_stream(self.iter_changes(api, parsed_args), flush=parsed_args.follow)
 
 
 def main():
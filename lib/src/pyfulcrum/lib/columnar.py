@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Columnar (Parquet, Arrow IPC) export of records.
+
+Columns are typed from form fields, with the same kinds as flat tables
+(see flat.get_field_kind()). Records are read from db in batches with
+column projection, and each batch is written as one row group (record
+batch in Arrow), so memory usage doesn't depend on number of records.
+
+Requires pyarrow, which is installed with `arrow` extra.
+"""
+
+import json
+
+from shapely import wkb, wkt
+from sqlalchemy.orm import Query, object_session
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+from . import flat
+from .archive import StreamBuffer
+from .models import Record, Field
+
+# number of records in one row group
+BATCH_SIZE = 10000
+
+PARQUET = 'parquet'
+ARROW = 'arrow'
+
+# record attribute -> column, the same names as in flat tables
+RECORD_COLUMNS = (('form_id', '_form_id',),) + flat.RECORD_COLUMNS
+GEOMETRY_COLUMN = '_point'
+
+# GeoParquet metadata for geometry column
+GEO_METADATA = {'version': '1.0.0',
+                'primary_column': GEOMETRY_COLUMN,
+                'columns': {GEOMETRY_COLUMN: {'encoding': 'WKB',
+                                              'geometry_types': ['Point']}}}
+
+
+def is_available():
+    return pyarrow is not None
+
+
+def _get_record_types():
+    """
+    Returns dictionary of record column -> arrow type
+    """
+    pa = pyarrow
+    types = dict((cname, pa.string()) for _, cname in RECORD_COLUMNS)
+    types.update({'_created_at': pa.timestamp('us', tz='UTC'),
+                  '_updated_at': pa.timestamp('us', tz='UTC'),
+                  '_altitude': pa.int64(),
+                  GEOMETRY_COLUMN: pa.binary()})
+    return types
+
+
+def _to_float(value):
+    value = flat.get_converter('numeric')(value)
+    if value is not None:
+        return float(value)
+
+
+def _to_json_text(value):
+    if value is None or value == '':
+        return
+    return json.dumps(value)
+
+
+def _boolean_converter(fields):
+    """
+    Yes/No values are converted with positive/negative values
+    configured in fields
+    """
+    values = {}
+    for field in fields:
+        payload = field.payload or {}
+        for key, flag in (('positive', True,), ('negative', False,)):
+            value = (payload.get(key) or {}).get('value')
+            if value is not None:
+                values[value] = flag
+
+    def _to_boolean(value):
+        return values.get(value)
+    return _to_boolean
+
+
+def _get_arrow_kind(kind, fields):
+    """
+    Returns (arrow type, value converter) for kind of column
+    """
+    pa = pyarrow
+    if kind == 'boolean':
+        return pa.bool_(), _boolean_converter(fields)
+    if kind == 'numeric':
+        return pa.float64(), _to_float
+    if kind == 'date':
+        return pa.date32(), flat.get_converter(kind)
+    if kind == 'time':
+        return pa.time32('s'), flat.get_converter(kind)
+    if kind == 'json':
+        # repeatables and other structured values are stored as json text
+        return pa.string(), _to_json_text
+    return pa.string(), flat.get_converter(kind)
+
+
+def get_schema(fields):
+    """
+    Returns list of (column name, {form id: field id}, arrow type,
+    converter) for fields of one or more forms. Fields are matched
+    between forms by data name. If kinds differ, column is a string.
+    """
+    columns = {}
+    for form_id in set(field.form_id for field in fields):
+        form_fields = [f for f in fields if f.form_id == form_id]
+        by_id = dict((f.id, f) for f in form_fields)
+        for name, field_id, kind in flat.get_schema(form_fields):
+            if by_id[field_id].type == 'YesNoField':
+                kind = 'boolean'
+            column = columns.setdefault(name, [kind, {}, []])
+            if column[0] != kind:
+                column[0] = 'string'
+            column[1][form_id] = field_id
+            column[2].append(by_id[field_id])
+    out = []
+    for name in sorted(columns):
+        kind, field_ids, column_fields = columns[name]
+        atype, convert = _get_arrow_kind(kind, column_fields)
+        out.append((name, field_ids, atype, convert,))
+    return out
+
+
+def get_fields(items):
+    """
+    Returns active fields of all forms of records in items, read with one query
+    """
+    if isinstance(items, Query):
+        session = items.session
+        form_ids = items.with_entities(Record.form_id)
+    else:
+        session = object_session(items[0])
+        form_ids = list(set(item.form_id for item in items))
+    return (session.query(Field)
+                   .filter(Field.form_id.in_(form_ids),
+                           Field.removed == False)
+                   .order_by(Field.form_id, Field.id)
+                   .all())
+
+
+def _iter_rows(items, batch_size):
+    """
+    Yields (record columns, values) tuples for records. Query is read
+    with column projection in batches.
+    """
+    attrs = [attr for attr, _ in RECORD_COLUMNS]
+    if not isinstance(items, Query):
+        for item in items:
+            yield [getattr(item, attr) for attr in attrs], item.values
+        return
+    cols = [getattr(Record, attr) for attr in attrs] + [Record.values]
+    for row in items.with_entities(*cols).yield_per(batch_size):
+        yield row[:-1], row[-1]
+
+
+def _to_wkb(point):
+    """
+    Returns WKB (without SRID) of point from model. Point can be
+    (E)WKT string (for objects not loaded from db yet) or WKBElement.
+    """
+    if point is None:
+        return
+    if isinstance(point, str):
+        return wkt.loads(point.split(';')[-1]).wkb
+    return wkb.loads(bytes(point.data)).wkb
+
+
+def iter_batches(items, schema, batch_size=BATCH_SIZE):
+    """
+    Yields arrow record batches of records
+
+    @param items Record query or list of records
+    @param schema schema from get_schema()
+    @param batch_size number of records in batch
+    """
+    arrow_schema = get_arrow_schema(schema)
+    names = arrow_schema.names
+    types = [field.type for field in arrow_schema]
+
+    def make_batch(rows):
+        columns = [[] for _ in names]
+        for record, values in rows:
+            values = values or {}
+            form_id = record[0]
+            for idx, value in enumerate(record):
+                if names[idx] == GEOMETRY_COLUMN:
+                    value = _to_wkb(value)
+                columns[idx].append(value)
+            offset = len(record)
+            for idx, (name, field_ids, atype, convert) in enumerate(schema, offset):
+                field_id = field_ids.get(form_id)
+                columns[idx].append(convert(values.get(field_id)) if field_id else None)
+        arrays = [pyarrow.array(col, type=atype) for col, atype in zip(columns, types)]
+        return pyarrow.RecordBatch.from_arrays(arrays, schema=arrow_schema)
+
+    rows = []
+    for row in _iter_rows(items, batch_size):
+        rows.append(row)
+        if len(rows) == batch_size:
+            yield make_batch(rows)
+            rows = []
+    if rows:
+        yield make_batch(rows)
+
+
+def get_arrow_schema(schema):
+    """
+    Returns arrow schema for schema from get_schema()
+    """
+    record_types = _get_record_types()
+    fields = [pyarrow.field(cname, record_types[cname]) for _, cname in RECORD_COLUMNS]
+    fields.extend(pyarrow.field(name, atype) for name, _, atype, _ in schema)
+    return pyarrow.schema(fields, metadata={'geo': json.dumps(GEO_METADATA)})
+
+
+def iter_export(items, format=PARQUET, batch_size=BATCH_SIZE):
+    """
+    Returns iterator of chunks of Parquet or Arrow IPC file with records,
+    written as record batches are created. Arguments and schema are
+    checked before iterator is returned.
+
+    @param items Record query or list of records
+    @param format PARQUET or ARROW
+    @param batch_size number of records in one row group
+    """
+    if pyarrow is None:
+        raise ValueError("pyarrow is required for {} format".format(format))
+    if format not in (PARQUET, ARROW,):
+        raise ValueError("Invalid columnar format: {}".format(format))
+    if isinstance(items, Query):
+        cls = items.column_descriptions[0]['entity']
+    else:
+        # objects are collected to get fields of their forms
+        items = list(items)
+        if not items:
+            return iter(())
+        cls = items[0].__class__
+    if cls is not Record:
+        raise TypeError("Cannot use class {} with {}".format(cls.__name__, format))
+    schema = get_schema(get_fields(items))
+    return _iter_export(items, format, schema, batch_size)
+
+
+def _iter_export(items, format, schema, batch_size):
+    out = StreamBuffer()
+    sink = pyarrow.PythonFile(out, mode='w')
+    arrow_schema = get_arrow_schema(schema)
+    if format == PARQUET:
+        writer = pyarrow.parquet.ParquetWriter(sink, arrow_schema)
+    else:
+        writer = pyarrow.ipc.new_file(sink, arrow_schema)
+    for batch in iter_batches(items, schema, batch_size):
+        if format == PARQUET:
+            # each table is written as separate row group
+            writer.write_table(pyarrow.Table.from_batches([batch]))
+        else:
+            writer.write_batch(batch)
+        yield out.drain()
+    writer.close()
+    yield out.drain()
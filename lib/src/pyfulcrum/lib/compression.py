@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compression of stored payloads.
+
+Payloads are serialized to compact json and compressed with zstandard,
+if it's installed, or with zlib. Codec is detected from stored data,
+so payloads packed with zlib can be read after zstandard is installed
+(and vice versa, as long as zstandard is available).
+"""
+
+import json
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# session.info key with flag enabling compression of saved payloads
+SESSION_KEY = 'compress_payloads'
+
+# zstandard frame header
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+ZSTD_LEVEL = 3
+ZLIB_LEVEL = 6
+
+
+def is_enabled(session):
+    return bool(session.info.get(SESSION_KEY))
+
+
+def compress(data):
+    if zstandard is not None:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return zlib.compress(data, ZLIB_LEVEL)
+
+
+def decompress(data):
+    data = bytes(data)
+    if data.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise ValueError("Payload is compressed with zstandard, which is not installed")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+def pack(payload):
+    """
+    Returns payload serialized to json and compressed
+    """
+    return compress(json.dumps(payload, separators=(',', ':')).encode('utf-8'))
+
+
+def unpack(data):
+    """
+    Returns payload from data returned by pack()
+    """
+    return json.loads(decompress(data).decode('utf-8'))
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Flat per-form record tables, with one typed column per field.
+Table schema is a list of [column name, field key, kind] elements,
+which is stored in Form.flat_schema.
+"""
+
+import json
+import logging
+from decimal import Decimal, InvalidOperation
+from datetime import datetime
+
+from sqlalchemy import (Table, Column, MetaData, String, Integer,
+                        Date, Time, Numeric, JSON)
+from geoalchemy2 import Geometry
+
+from .sqlite import DateTimeType
+
+log = logging.getLogger(__name__)
+
+FLAT_TABLE_PREFIX = 'fulcrum_flat_'
+# session.info key, which enables flat tables
+SESSION_KEY = 'flat_tables'
+# number of records inserted at once when table is rebuilt
+BATCH_SIZE = 500
+
+# record column -> flat table column
+RECORD_COLUMNS = (('id', '_id',),
+                  ('project_id', '_project_id',),
+                  ('status', '_status',),
+                  ('created_at', '_created_at',),
+                  ('updated_at', '_updated_at',),
+                  ('created_by', '_created_by',),
+                  ('updated_by', '_updated_by',),
+                  ('assigned_to', '_assigned_to',),
+                  ('altitude', '_altitude',),
+                  ('point', '_point',),
+                  )
+
+
+def _to_string(value):
+    if value is None or value == '':
+        return
+    if isinstance(value, (dict, list,)):
+        return json.dumps(value)
+    return str(value)
+
+
+def _to_numeric(value):
+    if value is None or value == '':
+        return
+    try:
+        return Decimal(str(value))
+    except InvalidOperation:
+        return
+
+
+def _to_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except (TypeError, ValueError):
+        return
+
+
+def _to_time(value):
+    try:
+        return datetime.strptime(value, '%H:%M').time()
+    except (TypeError, ValueError):
+        return
+
+
+def _to_choices(value):
+    """
+    Choice values are stored as comma-separated list of selected
+    and other values
+    """
+    if isinstance(value, dict):
+        value = (value.get('choice_values') or []) + (value.get('other_values') or [])
+    if isinstance(value, list):
+        return ', '.join(str(v) for v in value) or None
+    return _to_string(value)
+
+
+def _to_json(value):
+    if value is None or value == '':
+        return
+    return value
+
+
+def _media_converter(media_key):
+    """
+    Media values are stored as comma-separated list of media ids
+    """
+    def _to_media(value):
+        if isinstance(value, dict):
+            value = [value]
+        if not isinstance(value, list):
+            return
+        return ','.join(v[media_key] for v in value if v.get(media_key)) or None
+    return _to_media
+
+
+# kind of column -> (column type, value converter)
+KINDS = {'string': (String, _to_string,),
+         'numeric': (Numeric, _to_numeric,),
+         'date': (Date, _to_date,),
+         'time': (Time, _to_time,),
+         'choice': (String, _to_choices,),
+         'json': (JSON, _to_json,),
+         }
+
+# field type -> kind of column
+FIELD_KINDS = {'TextField': 'string',
+               'YesNoField': 'string',
+               'BarcodeField': 'string',
+               'HyperlinkField': 'string',
+               'ChoiceField': 'choice',
+               'ClassificationField': 'choice',
+               'DateTimeField': 'date',
+               'TimeField': 'time',
+               'AddressField': 'json',
+               'Repeatable': 'json',
+               'RecordLinkField': 'json',
+               }
+
+# CalculatedField display style -> kind of column
+CALCULATED_KINDS = {'number': 'numeric',
+                    'currency': 'numeric',
+                    'date': 'date',
+                    }
+
+
+def is_enabled(session):
+    """
+    Returns True if flat tables should be maintained in session
+    """
+    return bool(session.info.get(SESSION_KEY))
+
+
+def get_table_name(form_id):
+    return '{}{}'.format(FLAT_TABLE_PREFIX, form_id.replace('-', '_').lower())
+
+
+def get_field_kind(field):
+    """
+    Returns kind of column for Field, or None if field doesn't hold
+    values (like Label or Section)
+    """
+    if field.is_media:
+        return 'media:{}'.format(field.media_key)
+    payload = field.payload or {}
+    if field.type == 'TextField' and payload.get('numeric'):
+        return 'numeric'
+    if field.type == 'CalculatedField':
+        display = payload.get('display') or {}
+        return CALCULATED_KINDS.get(display.get('style'), 'string')
+    return FIELD_KINDS.get(field.type)
+
+
+def get_schema(fields):
+    """
+    Returns flat table schema for list of fields: list of
+    [column name, field key, kind] elements
+    """
+    reserved = set(c for _, c in RECORD_COLUMNS)
+    used = set()
+    out = []
+    for field in sorted(fields, key=lambda f: f.data_name):
+        kind = get_field_kind(field)
+        name = field.data_name
+        if kind is None:
+            continue
+        if name in reserved or name in used:
+            log.warning("Cannot use data name %s of %s as flat table column", name, field)
+            continue
+        used.add(name)
+        out.append([name, field.id, kind])
+    return out
+
+
+def _get_kind(kind):
+    if kind.startswith('media:'):
+        return String, _media_converter(kind[len('media:'):])
+    return KINDS[kind]
+
+
+def get_converter(kind):
+    """
+    Returns value converter for kind of column
+    """
+    return _get_kind(kind)[1]
+
+
+def get_table(form_id, schema):
+    """
+    Returns Table for flat table of given form
+    """
+    columns = [Column('_id', String, primary_key=True),
+               Column('_project_id', String, nullable=True),
+               Column('_status', String, nullable=True, index=True),
+               Column('_created_at', DateTimeType(), nullable=False),
+               Column('_updated_at', DateTimeType(), nullable=False),
+               Column('_created_by', String, nullable=True),
+               Column('_updated_by', String, nullable=True),
+               Column('_assigned_to', String, nullable=True),
+               Column('_altitude', Integer, nullable=True),
+               Column('_point', Geometry('POINT', srid=4326, management=True), nullable=True),
+               ]
+    for name, key, kind in schema:
+        ctype, _ = _get_kind(kind)
+        columns.append(Column(name, ctype, nullable=True))
+    return Table(get_table_name(form_id), MetaData(), *columns)
+
+
+def get_row(record, schema):
+    """
+    Returns flat table row for Record
+    """
+    row = dict((cname, getattr(record, attr)) for attr, cname in RECORD_COLUMNS)
+    values = record.values or {}
+    for name, key, kind in schema:
+        _, convert = _get_kind(kind)
+        row[name] = convert(values.get(key))
+    return row
+
+
+def create_table(session, form_id, schema, records=None, batch_size=BATCH_SIZE):
+    """
+    (Re)creates flat table for form and fills it with records.
+
+    @param form_id id of form
+    @param schema flat table schema from get_schema()
+    @param records optional iterable of records to insert
+    @param batch_size number of rows inserted at once
+
+    @returns number of inserted rows
+    """
+    conn = session.connection()
+    table = get_table(form_id, schema)
+    table.drop(conn, checkfirst=True)
+    table.create(conn)
+    count = insert_records(session, form_id, schema, records or [], batch_size)
+    log.info("flat table %s created with %s rows", table.name, count)
+    return count
+
+
+def insert_records(session, form_id, schema, records, batch_size=BATCH_SIZE):
+    """
+    Inserts rows of records into flat table of form, in batches
+
+    @returns number of inserted rows
+    """
+    conn = session.connection()
+    table = get_table(form_id, schema)
+    count = 0
+    batch = []
+    for record in records:
+        batch.append(get_row(record, schema))
+        if len(batch) >= batch_size:
+            conn.execute(table.insert(), batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        conn.execute(table.insert(), batch)
+        count += len(batch)
+    return count
+
+
+def drop_table(session, form_id):
+    get_table(form_id, []).drop(session.connection(), checkfirst=True)
+
+
+def upsert_record(session, record, schema):
+    """
+    Replaces row of record in flat table
+    """
+    conn = session.connection()
+    table = get_table(record.form_id, schema)
+    conn.execute(table.delete().where(table.c._id == record.id))
+    conn.execute(table.insert(), [get_row(record, schema)])
+
+
+def delete_record(session, record):
+    """
+    Removes row of record from flat table
+    """
+    delete_records(session, record.form_id, [record.id])
+
+
+def delete_records(session, form_id, ids):
+    """
+    Removes rows of records from flat table of form
+
+    @param ids list of ids or subquery selecting ids of records
+    """
+    table = get_table(form_id, [])
+    session.connection().execute(table.delete().where(table.c._id.in_(ids)))
@@ -1,24 +1,39 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import os
 import sys
 import json
-import tempfile
-import zipfile
 import csv
+import uuid
 from datetime import datetime
 from itertools import chain
 from functools import wraps
-from shapely import wkb
-from osgeo import ogr, osr
+from shapely import wkb, wkt
+from osgeo import ogr, osr, gdal
 from io import StringIO
+from sqlalchemy import null
+from sqlalchemy.orm import Query, undefer_group, object_session
+from .models import PAYLOAD_GROUP, Record, Field
+from .archive import CHUNK_SIZE, iter_zip
+from . import columnar
 ogr.UseExceptions()
 
+GEOJSON_PREFIX = '{"type": "FeatureCollection", "features": ['
+GEOJSON_SUFFIX = ']}'
+
+# GDAL in-memory filesystem directory for OGR exports
+VSIMEM_DIR = '/vsimem/pyfulcrum'
+
+# features written in one transaction by OGR exports
+OGR_BATCH_SIZE = 10000
+
+# rows read at once by csv export
+CSV_BATCH_SIZE = 500
+
 print_attrs = ('id', 'status', 'name', 'media_type', 'content_type', 'form_id', 'project_id', 'record_id', 'records_count', 'values_processed', 'created_at', 'updated_at',)
 
 
-def formatter(*allowed_classes):
+def formatter(*allowed_classes, payloads=False, stream=False):
     """
     Decorator for formatter callable - provides
     common checks and returns if item passed is
@@ -27,6 +42,11 @@ def formatter(*allowed_classes):
     @param allowed_classes list of allowed class names
         that format supports. If ommited, all classes
         can be used
+    @param payloads if True, formatter uses payloads, so compressed
+        payloads are loaded with items query instead of one query per item
+    @param stream if True, formatter is a generator of encoded chunks.
+        Empty list of items is still passed to it, so it can output
+        valid empty document
 
     usage:
 
@@ -48,14 +68,38 @@ def formatter(*allowed_classes):
         ...
 
     """
+    def _check_class(cls_name, f):
+        if allowed_classes and cls_name not in allowed_classes:
+            raise TypeError("Cannot use class {} with {}"
+                            .format(cls_name, f.__name__))
+
+    def _stream(f, items, storage):
+        # items are read once, without counting them. Class of query
+        # is checked without running it.
+        if isinstance(items, Query):
+            _check_class(items.column_descriptions[0]['entity'].__name__, f)
+            return f(items, storage, multiple=True)
+        items = iter(items)
+        first_item = next(items, None)
+        if first_item is None:
+            return f(iter(()), storage, multiple=True)
+        _check_class(first_item.__class__.__name__, f)
+        return f(chain([first_item], items), storage, multiple=True)
+
     def _formatter(f):
         @wraps(f)    
         def _wrap(items, storage, multiple=False):
+            if payloads and isinstance(items, Query):
+                items = items.options(undefer_group(PAYLOAD_GROUP))
+            if stream and multiple:
+                return _stream(f, items, storage)
             try:
                 not_items = items.count() == 0
             except AttributeError:
                 not_items = not items
             if not_items:
+                if stream:
+                    return iter(())
                 if multiple:
                     return []
                 return
@@ -132,15 +176,22 @@ def json_item(obj, storage):
     return out
 
 
+def get_point_coords(point):
+    """
+    Returns (lon, lat) tuple for point from model. Point can be
+    (E)WKT string (for objects not loaded from db yet) or WKBElement.
+    """
+    if isinstance(point, str):
+        # strip SRID=XXXX; prefix of EWKT
+        geom = wkt.loads(point.split(';')[-1])
+    else:
+        geom = wkb.loads(bytes(point.data))
+    return geom.x, geom.y
+
+
 def geojson_item(obj, storage):
     if getattr(obj, 'point', None) is None:
         return
-    if isinstance(obj.point, str):
-        geom = ogr.CreateGeometryFromWkt(obj.point)
-    else:
-        geom = ogr.CreateGeometryFromWkb(obj.point.data.tobytes())
-    x,y = geom.GetX(), geom.GetY()
-    geom.SetPoint(0, y, x)
 
     props = {'id': obj.id}
     props.update(obj.payload)
@@ -154,11 +205,60 @@ def geojson_item(obj, storage):
 
     out = {'type': 'Feature',
            'id': obj.id,
-           'geometry': json.loads(geom.ExportToJson()),
+           'geometry': {'type': 'Point',
+                        'coordinates': list(get_point_coords(obj.point))},
            'properties': props}
     out['properties']['id'] = obj.id
     return out
 
+
+def iter_json_array(values, prefix='[', suffix=']'):
+    """
+    Yields json array of values in chunks, one chunk per value, so
+    values can be serialized without collecting them first.
+
+    @param values iterable of json-serializable values
+    @param prefix opening of array, can contain enclosing document
+    @param suffix closing of array
+    """
+    yield prefix
+    sep = ''
+    for value in values:
+        yield '{}{}'.format(sep, json.dumps(value))
+        sep = ', '
+    yield suffix
+
+
+def iter_json(values, multiple=False, prefix='[', suffix=']'):
+    """
+    Yields json chunks of values, as array if multiple is True,
+    or single value otherwise.
+    """
+    if multiple:
+        return iter_json_array(values, prefix, suffix)
+    return (json.dumps(value) for value in values)
+
+
+def iter_lines(values):
+    """
+    Yields json values one per line (JSON Lines)
+    """
+    for value in values:
+        yield '{}\n'.format(json.dumps(value))
+
+
+def iter_encoded(chunks):
+    for chunk in chunks:
+        yield chunk.encode('utf-8')
+
+
+def iter_features(items, storage):
+    for item in items:
+        val = geojson_item(item, storage)
+        if val is not None:
+            yield val
+
+
 @formatter()
 def format_str(items, storage, multiple=False):
     out = []
@@ -173,102 +273,330 @@ def format_str(items, storage, multiple=False):
 
 @formatter()
 def format_json(items, storage, multiple=False):
-    out = []
-    for item in items:
-        out.append(json_item(item, storage))
-    if not multiple:
-        return json.dumps(out[0])
-    return json.dumps(out)
+    values = (json_item(item, storage) for item in items)
+    return ''.join(iter_json(values, multiple))
 
 
-@formatter()
+@formatter(payloads=True)
 def format_raw(items, storage, multiple=False):
-    out = []
-    for item in items:
-        out.append(item.payload)
-    if not multiple:
-        return json.dumps(out[0])
-    return json.dumps(out)
+    values = (item.payload for item in items)
+    return ''.join(iter_json(values, multiple))
 
 
-@formatter('Record', 'Media')
+@formatter('Record', 'Media', payloads=True)
 def format_geojson(items, storage, multiple=False):
-    out = []
-    for item in items:
-        val = geojson_item(item, storage)
-        if val is not None:
-            out.append(val)
-    if not multiple:
-        return json.dumps(out[0])
-    return json.dumps({'type': 'FeatureCollection', 'features': out})
+    features = iter_features(items, storage)
+    return ''.join(iter_json(features, multiple, GEOJSON_PREFIX, GEOJSON_SUFFIX))
+
 
 @formatter()
-def format_csv(items, storage, multiple=False):
-    out = StringIO()
-    w = csv.writer(out, quoting=csv.QUOTE_NONNUMERIC)
-    header = ['id']
+def format_ndjson(items, storage, multiple=False):
+    return ''.join(iter_lines(json_item(item, storage) for item in items))
 
-    try:
-        item_row = next(items)
-        items = chain([item_row], items)
-    except TypeError:
-        item_row = items[0]
 
-    record_fields = {}
+@formatter('Record', 'Media', payloads=True)
+def format_geojsonseq(items, storage, multiple=False):
+    return ''.join(iter_lines(iter_features(items, storage)))
 
-    for fname in item_row.payload.keys():
-        # skip id, form_values will be processed later
-        if fname in ('id', 'form_values',): 
-            continue
-        header.append(fname)
-    if item_row.__class__.__name__ == 'Record':
-        for field in item_row.form.fields_list:
-            label = field.label
-            record_fields[label] = field.id
-            header.append('field.{}'.format(label))
-
-    header = header[:1] + list(sorted(header[1:]))
-    w.writerow(header)
 
+@formatter(stream=True)
+def stream_str(items, storage, multiple=False):
+    sep = ''
     for item in items:
-        row = [item.id]
-        payload = item.payload
+        output = StringIO()
+        print_item(item, storage, output)
+        yield '{}{}'.format(sep, output.getvalue()).encode('utf-8')
+        sep = '\n'
+
+
+@formatter(stream=True)
+def stream_json(items, storage, multiple=False):
+    values = (json_item(item, storage) for item in items)
+    yield from iter_encoded(iter_json(values, multiple))
+
+
+@formatter(payloads=True, stream=True)
+def stream_raw(items, storage, multiple=False):
+    values = (item.payload for item in items)
+    yield from iter_encoded(iter_json(values, multiple))
+
+
+@formatter('Record', 'Media', payloads=True, stream=True)
+def stream_geojson(items, storage, multiple=False):
+    features = iter_features(items, storage)
+    yield from iter_encoded(iter_json(features, multiple, GEOJSON_PREFIX, GEOJSON_SUFFIX))
+
+
+@formatter(stream=True)
+def stream_ndjson(items, storage, multiple=False):
+    yield from iter_encoded(iter_lines(json_item(item, storage) for item in items))
+
+
+@formatter('Record', 'Media', payloads=True, stream=True)
+def stream_geojsonseq(items, storage, multiple=False):
+    yield from iter_encoded(iter_lines(iter_features(items, storage)))
+
+
+def iter_payload_rows(items):
+    """
+    Yields (id, form_id, payload) tuples for items. Query is read with
+    column projection in batches, without loading objects.
+    """
+    if not isinstance(items, Query):
+        for item in items:
+            yield item.id, getattr(item, 'form_id', None), item.payload
+        return
+    model = items.column_descriptions[0]['entity']
+    form_id = getattr(model, 'form_id', null())
+    q = items.with_entities(model.id, form_id, *model.get_payload_columns())
+    for row in q.yield_per(CSV_BATCH_SIZE):
+        yield row[0], row[1], model.restore_payload(*row[2:])
+
+
+def get_csv_fields(items):
+    """
+    Returns dictionary of field label -> {form id: field id} for fields
+    of all forms of records in items, read with one query.
+    """
+    if isinstance(items, Query):
+        model = items.column_descriptions[0]['entity']
+        session = items.session
+        form_ids = items.with_entities(Record.form_id)
+    else:
+        model = items[0].__class__
+        session = object_session(items[0])
+        form_ids = [items[0].form_id]
+    if model is not Record:
+        return {}
+    q = (session.query(Field.form_id, Field.id, Field.label)
+                .filter(Field.form_id.in_(form_ids))
+                .order_by(Field.form_id, Field.id))
+    fields = {}
+    for form_id, field_id, label in q:
+        fields.setdefault(label, {})[form_id] = field_id
+    return fields
+
+
+def get_csv_columns(model):
+    """
+    Returns sorted payload keys of model, which are written to csv:
+    sources of model's mapped columns and model's PAYLOAD_KEYS.
+    Form values are written to `field.<label>` columns.
+    """
+    columns = set(model.PAYLOAD_KEYS)
+    for m in model.MAPPED_COLUMNS:
+        columns.add(m[0] if isinstance(m, (list, tuple,)) else m)
+    columns.difference_update(('id', 'point', 'values', 'form_values',))
+    return sorted(columns)
+
+
+def iter_csv(items):
+    """
+    Yields encoded csv lines for items. Header is the same for all items
+    of a model: id, payload keys from get_csv_columns() and
+    `field.<label>` columns for fields of forms of records.
+    """
+    out = StringIO()
+    w = csv.writer(out, quoting=csv.QUOTE_NONNUMERIC)
+
+    def line(row):
+        out.seek(0)
+        out.truncate()
+        w.writerow(row)
+        return out.getvalue().encode('utf-8')
+
+    if isinstance(items, Query):
+        model = items.column_descriptions[0]['entity']
+        fields = get_csv_fields(items)
+    else:
+        # first object is peeked to get fields of its form
+        items = iter(items)
+        try:
+            first_item = next(items)
+        except StopIteration:
+            return
+        items = chain([first_item], items)
+        model = first_item.__class__
+        fields = get_csv_fields([first_item])
+
+    header = get_csv_columns(model)
+    header.extend('field.{}'.format(label) for label in fields)
+    header = ['id'] + list(sorted(header))
+    yield line(header)
+
+    for item_id, form_id, payload in iter_payload_rows(items):
+        row = [item_id]
+        form_values = payload.get('form_values') or {}
         for k in header[1:]:
             if k.startswith('field.'):
-                fname = k[6:]
-                fid = record_fields[fname]
-                row.append(payload['form_values'].get(fid))
+                fid = fields[k[6:]].get(form_id)
+                row.append(form_values.get(fid) if fid else None)
             else:
                 row.append(payload.get(k))
-        w.writerow(row)
-    return bytes(out.getvalue(), 'utf-8')
+        yield line(row)
+
+
+@formatter()
+def format_csv(items, storage, multiple=False):
+    return b''.join(iter_csv(items))
+
 
+@formatter(stream=True)
+def stream_csv(items, storage, multiple=False):
+    yield from iter_csv(items)
 
-@formatter('Record', 'Media')
+
+@formatter('Record', 'Media', payloads=True)
 def format_shapefile(items, storage, multiple=False):
     """
     Output to shapefile as zip
     """
 
+    return b''.join(_export_ogr(items, storage, multiple,
+                                driver='ESRI Shapefile',
+                                extension='shp',
+                                use_zip=True))
+
+
+@formatter('Record', 'Media', payloads=True)
+def format_kml(items, storage, multiple=False):
+    """
+    Output to kml
+    """
+
+    return b''.join(_export_ogr(items, storage, multiple,
+                                driver='KML',
+                                extension='kml',
+                                use_zip=False))
+
+
+@formatter('Record', 'Media', payloads=True, stream=True)
+def stream_shapefile(items, storage, multiple=False):
+    """
+    Streams shapefile as zip
+    """
     return _export_ogr(items, storage, multiple,
                        driver='ESRI Shapefile',
                        extension='shp',
                        use_zip=True)
 
 
-@formatter('Record', 'Media')
-def format_kml(items, storage, multiple=False):
+@formatter('Record', 'Media', payloads=True, stream=True)
+def stream_kml(items, storage, multiple=False):
     """
-    Output to shapefile as zip
+    Streams kml
     """
-
     return _export_ogr(items, storage, multiple,
                        driver='KML',
                        extension='kml',
                        use_zip=False)
 
-def _export_ogr(items, storage, multiple=False, driver=None, extension=None, use_zip=False):
-    item_row = next(items)
+
+@formatter('Record', 'Media', payloads=True)
+def format_gpkg(items, storage, multiple=False):
+    """
+    Output to GeoPackage
+    """
+    return b''.join(_export_gpkg(items, storage, multiple))
+
+
+@formatter('Record', 'Media', payloads=True)
+def format_fgb(items, storage, multiple=False):
+    """
+    Output to FlatGeobuf
+    """
+    return b''.join(_export_fgb(items, storage, multiple))
+
+
+@formatter('Record', 'Media', payloads=True, stream=True)
+def stream_gpkg(items, storage, multiple=False):
+    """
+    Streams GeoPackage
+    """
+    return _export_gpkg(items, storage, multiple)
+
+
+@formatter('Record', 'Media', payloads=True, stream=True)
+def stream_fgb(items, storage, multiple=False):
+    """
+    Streams FlatGeobuf
+    """
+    return _export_fgb(items, storage, multiple)
+
+
+@formatter()
+def format_parquet(items, storage, multiple=False):
+    """
+    Output records to Parquet, one row group per batch of records
+    """
+    return b''.join(columnar.iter_export(items, columnar.PARQUET))
+
+
+@formatter()
+def format_arrow(items, storage, multiple=False):
+    """
+    Output records to Arrow IPC file
+    """
+    return b''.join(columnar.iter_export(items, columnar.ARROW))
+
+
+@formatter(stream=True)
+def stream_parquet(items, storage, multiple=False):
+    """
+    Streams Parquet file with records
+    """
+    return columnar.iter_export(items, columnar.PARQUET)
+
+
+@formatter(stream=True)
+def stream_arrow(items, storage, multiple=False):
+    """
+    Streams Arrow IPC file with records
+    """
+    return columnar.iter_export(items, columnar.ARROW)
+
+
+def _export_gpkg(items, storage, multiple=False):
+    return _export_ogr(items, storage, multiple,
+                       driver='GPKG',
+                       extension='gpkg',
+                       use_zip=False,
+                       layer_options=['SPATIAL_INDEX=YES'])
+
+
+def _export_fgb(items, storage, multiple=False):
+    return _export_ogr(items, storage, multiple,
+                       driver='FlatGeobuf',
+                       extension='fgb',
+                       use_zip=False,
+                       layer_options=['SPATIAL_INDEX=YES'])
+
+
+def _export_ogr(items, storage, multiple=False, driver=None, extension=None, use_zip=False,
+                layer_options=None):
+    """
+    Returns iterator of chunks of file(s) written with OGR driver. Features
+    are written in transactions of OGR_BATCH_SIZE features (for drivers,
+    which support them). Driver is checked before iterator is returned,
+    and ValueError is raised if GDAL doesn't provide it (FlatGeobuf
+    requires GDAL 3.1+).
+
+    @param layer_options list of layer creation options
+    """
+    drv = ogr.GetDriverByName(driver)
+    if drv is None:
+        raise ValueError("{} format is not available, GDAL has no {} driver"
+                         .format(extension, driver))
+    return _iter_ogr(items, storage, drv, driver, extension, use_zip, layer_options)
+
+
+def _iter_ogr(items, storage, drv, driver, extension, use_zip, layer_options):
+    items = iter(items)
+    try:
+        item_row = next(items)
+    except StopIteration:
+        # layer is defined by first item, so nothing is written for no items
+        return
     item_class = item_row.__class__.__name__
 
     # need to extract field names from first item in list
@@ -300,15 +628,21 @@ def _export_ogr(items, storage, multiple=False, driver=None, extension=None, use
             item_idx += 1
     basename = '{}s'.format(item_class.lower())
     outfile = '{}.{}'.format(basename, extension)
-    zfile = '{}.zip'.format(outfile)
 
-    drv = ogr.GetDriverByName(driver)
-    with tempfile.TemporaryDirectory() as tmpdirname:
-        full_path = os.path.join(tmpdirname, outfile)
+    # dataset is written to GDAL's in-memory filesystem and streamed
+    # from there, so nothing is written to disk
+    dirname = '{}/{}'.format(VSIMEM_DIR, uuid.uuid4().hex)
+    gdal.Mkdir(dirname, 0o755)
+    data = None
+    try:
+        full_path = '{}/{}'.format(dirname, outfile)
         data = drv.CreateDataSource(full_path)
         srs = osr.SpatialReference()
         srs.ImportFromEPSG(4326)
-        layer = data.CreateLayer(basename, srs, ogr.wkbPoint)
+        # points are stored as lon/lat, GDAL 3 expects lat/lon for EPSG:4326
+        if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+            srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        layer = data.CreateLayer(basename, srs, ogr.wkbPoint, options=layer_options or [])
 
         # create layer definitions from fields from above
         for fname, fdef, fidx, field_id in item_defs:
@@ -316,13 +650,15 @@ def _export_ogr(items, storage, multiple=False, driver=None, extension=None, use
         layer.CreateField(ogr.FieldDefn('type', ogr.OFTString))
 
         ldef = layer.GetLayerDefn()
+        written = 0
+        layer.StartTransaction()
         for item in chain([item_row], items):
 
             # we don't want to process entries without geometry
             if getattr(item, 'point', None) is None:
                 continue
 
-            feat = ogr.Feature(layer.GetLayerDefn())
+            feat = ogr.Feature(ldef)
             has_values_list = hasattr(item, 'values_list')
             if has_values_list:
                 values = dict( (v.field_id, v) for v in item.values_list)
@@ -355,34 +691,48 @@ def _export_ogr(items, storage, multiple=False, driver=None, extension=None, use
                     value = json.dumps(value)
                 feat.SetField(fidx, value)
             feat.SetField(fidx + 1, item.__class__.__name__)
-            if isinstance(item.point, str):
-                point = item.point
-                geom = ogr.CreateGeometryFromWkt(point)
-            else:
-                point = item.point.data.tobytes()
-                geom = ogr.CreateGeometryFromWkb(point)
-            # swap xy
-            x, y = geom.GetX(), geom.GetY()
-            geom.SetPoint(0, y, x)
+            geom = ogr.Geometry(ogr.wkbPoint)
+            geom.AddPoint_2D(*get_point_coords(item.point))
             feat.SetGeometry(geom)
             layer.CreateFeature(feat)
+            written += 1
+            if written % OGR_BATCH_SIZE == 0:
+                layer.CommitTransaction()
+                layer.StartTransaction()
+        layer.CommitTransaction()
+        # files are complete when dataset is closed
         data.Destroy()
+        data = None
 
         if use_zip:
+            entries = ((fname, iter_vsi_file('{}/{}'.format(dirname, fname)),)
+                       for fname in sorted(gdal.ReadDir(dirname) or []))
+            yield from iter_zip(entries)
+        else:
+            yield from iter_vsi_file(full_path)
+    finally:
+        if data is not None:
+            data.Destroy()
+        for fname in gdal.ReadDir(dirname) or []:
+            gdal.Unlink('{}/{}'.format(dirname, fname))
+        gdal.Rmdir(dirname)
 
-            files = os.listdir(tmpdirname)
-            zfile = os.path.join(tmpdirname, zfile)
 
-            with zipfile.ZipFile(zfile, mode='w') as zf:
-                for fname in files:
-                    # no subpath for archive names by using arcname
-                    zf.write(os.path.join(tmpdirname, fname), arcname='/{}'.format(fname))
-            
-            with open(zfile, 'rb') as zf:
-                return zf.read()
-        else:
-            with open(full_path, 'rb') as f:
-                return f.read()
+def iter_vsi_file(path, chunk_size=CHUNK_SIZE):
+    """
+    Yields contents of file from GDAL virtual filesystem in chunks
+    """
+    f = gdal.VSIFOpenL(path, 'rb')
+    if f is None:
+        raise IOError("Cannot open {}".format(path))
+    try:
+        while True:
+            chunk = gdal.VSIFReadL(1, chunk_size, f)
+            if not chunk:
+                return
+            yield chunk
+    finally:
+        gdal.VSIFCloseL(f)
 
 FORMATS = {'str': format_str,
            'json': format_json,
@@ -390,4 +740,28 @@ FORMATS = {'str': format_str,
            'shapefile': format_shapefile,
            'kml': format_kml,
            'csv': format_csv,
-           'raw': format_raw}
+           'raw': format_raw,
+           'ndjson': format_ndjson,
+           'geojsonseq': format_geojsonseq,
+           'gpkg': format_gpkg,
+           'fgb': format_fgb,
+           'parquet': format_parquet,
+           'arrow': format_arrow}
+
+# generator variants of formats, which yield encoded chunks
+STREAM_FORMATS = {'str': stream_str,
+                  'json': stream_json,
+                  'geojson': stream_geojson,
+                  'raw': stream_raw,
+                  'ndjson': stream_ndjson,
+                  'geojsonseq': stream_geojsonseq,
+                  'csv': stream_csv,
+                  'shapefile': stream_shapefile,
+                  'kml': stream_kml,
+                  'gpkg': stream_gpkg,
+                  'fgb': stream_fgb,
+                  'parquet': stream_parquet,
+                  'arrow': stream_arrow}
+
+# formats with one item per line, which can be consumed as they're written
+LINE_FORMATS = ('ndjson', 'geojsonseq',)
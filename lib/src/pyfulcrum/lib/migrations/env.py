@@ -2,15 +2,20 @@ from __future__ import with_statement
 from alembic import context
 from sqlalchemy import engine_from_config, pool
 from logging.config import fileConfig
+from alembic.script import ScriptDirectory
 from pyfulcrum.lib.models import Base
+from pyfulcrum.lib.flat import FLAT_TABLE_PREFIX
+from pyfulcrum.lib import sqlite
 
 # this is the Alembic Config object, which provides
 # access to the values within the .ini file in use.
 config = context.config
 
 # Interpret the config file for Python logging.
-# This line sets up loggers basically.
-fileConfig(config.config_file_name)
+# This line sets up loggers basically. Config can be created
+# without file, i.e. when migrations are run in tests
+if config.config_file_name is not None:
+    fileConfig(config.config_file_name)
 
 # add your model's MetaData object here
 # for 'autogenerate' support
@@ -24,6 +29,16 @@ target_metadata = Base.metadata
 # ... etc.
 
 
+def include_object(object, name, type_, reflected, compare_to):
+    # flat records tables are managed by pyfulcrum.lib.flat
+    if type_ == 'table' and name.startswith(FLAT_TABLE_PREFIX):
+        return False
+    # values index is created with DDL in PostgreSQL only, see models
+    if type_ == 'index' and name == 'ix_fulcrum_record_values':
+        return False
+    return True
+
+
 def run_migrations_offline():
     """Run migrations in 'offline' mode.
 
@@ -38,7 +53,8 @@ def run_migrations_offline():
     """
     url = config.get_main_option("sqlalchemy.url")
     context.configure(
-        url=url, target_metadata=target_metadata, literal_binds=True)
+        url=url, target_metadata=target_metadata, literal_binds=True,
+        include_object=include_object)
 
     with context.begin_transaction():
         context.run_migrations()
@@ -55,13 +71,26 @@ def run_migrations_online():
         config.get_section(config.config_ini_section),
         prefix='sqlalchemy.',
         poolclass=pool.NullPool)
+    sqlite.setup_engine(connectable)
 
     with connectable.connect() as connection:
+        is_sqlite = sqlite.is_sqlite(connection)
         context.configure(
             connection=connection,
-            target_metadata=target_metadata
+            target_metadata=target_metadata,
+            include_object=include_object,
+            # sqlite can't alter columns and constraints in place
+            render_as_batch=is_sqlite
         )
 
+        if is_sqlite and not connection.dialect.has_table(connection, 'fulcrum_form'):
+            # migrations older than SQLite support use PostgreSQL-only sql,
+            # so new SQLite database is created from models at head revision
+            with context.begin_transaction():
+                target_metadata.create_all(connection)
+                context.get_context().stamp(ScriptDirectory.from_config(config), 'head')
+            return
+
         with context.begin_transaction():
             context.run_migrations()
 
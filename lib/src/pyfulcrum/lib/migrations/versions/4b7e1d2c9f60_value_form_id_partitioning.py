@@ -0,0 +1,184 @@
+"""value_form_id_partitioning
+
+Revision ID: 4b7e1d2c9f60
+Revises: e2a9c4f7b813
+Create Date: 2026-10-19 21:05:41.220118
+
+Adds form_id to values. Records and values tables can be partitioned
+by form_id with `-x partitioning=list` or `-x partitioning=hash`
+(and optional `-x partitions=N`) alembic args, see pyfulcrum.lib.partitions.
+"""
+from alembic import op, context
+import sqlalchemy as sa
+
+from pyfulcrum.lib import partitions
+
+
+# revision identifiers, used by Alembic.
+revision = '4b7e1d2c9f60'
+down_revision = 'e2a9c4f7b813'
+branch_labels = None
+depends_on = None
+
+# number of records, which values are updated in one transaction
+BATCH_SIZE = 1000
+
+# indexes of rebuilt tables: (table, name, columns, options)
+INDEXES = (('fulcrum_record', 'ix_fulcrum_record_removed', ['removed'], {}),
+           ('fulcrum_record', 'ix_fulcrum_record_status', ['status'], {}),
+           ('fulcrum_record', 'ix_fulcrum_record_form_id', ['form_id'], {}),
+           ('fulcrum_record', 'ix_fulcrum_record_form_id_updated_at', ['form_id', 'updated_at'],
+            {'postgresql_where': sa.text('removed = false')}),
+           ('fulcrum_record', 'idx_fulcrum_record_point', ['point'],
+            {'postgresql_using': 'gist'}),
+           ('fulcrum_record', 'ix_fulcrum_record_values', ['values'],
+            {'postgresql_using': 'gin', 'postgresql_ops': {'values': 'jsonb_path_ops'}}),
+           ('fulcrum_value', 'ix_fulcrum_value_removed', ['removed'], {}),
+           ('fulcrum_value', 'ix_fulcrum_value_type', ['type'], {}),
+           ('fulcrum_value', 'ix_fulcrum_value_field_id', ['field_id'], {}),
+           ('fulcrum_value', 'ix_fulcrum_value_record_id', ['record_id'], {}),
+           ('fulcrum_value', 'ix_fulcrum_value_form_id', ['form_id'], {}),
+           )
+
+# foreign keys of rebuilt tables: (table, name, columns, referred table)
+FOREIGN_KEYS = (('fulcrum_record', 'fulcrum_record_form_id_fkey', ['form_id'], 'fulcrum_form'),
+                ('fulcrum_record', 'fulcrum_record_project_id_fkey', ['project_id'], 'fulcrum_project'),
+                ('fulcrum_value', 'fulcrum_value_field_id_fkey', ['field_id'], 'fulcrum_field'),
+                ('fulcrum_value', 'fulcrum_value_form_id_fkey', ['form_id'], 'fulcrum_form'),
+                )
+
+# foreign keys referencing records. In partitioned tables, unique
+# constraints must contain partition key, so they reference (id, form_id)
+RECORD_REFERENCES = (('fulcrum_value', 'fulcrum_value_record_id_fkey',),
+                     ('fulcrum_media', 'fulcrum_media_record_id_fkey',),
+                     )
+
+
+def _get_partitioning():
+    """
+    Returns (strategy, modulus) from alembic -x args
+    """
+    args = context.get_x_argument(as_dictionary=True)
+    strategy = args.get('partitioning')
+    if strategy not in (None, partitions.LIST, partitions.HASH):
+        raise ValueError("Invalid partitioning: {}".format(strategy))
+    return strategy, int(args.get('partitions') or partitions.DEFAULT_MODULUS)
+
+
+def _add_values_form_id():
+    """
+    Adds form_id column to unpartitioned values table. Values are
+    updated in batches of records, each committed separately.
+    Column is committed before batches, so it may exist already, when
+    migration is run again after failure.
+    """
+    conn = op.get_bind()
+    if 'form_id' not in [c['name'] for c in sa.inspect(conn).get_columns('fulcrum_value')]:
+        op.add_column('fulcrum_value', sa.Column('form_id', sa.String(), nullable=True))
+    update = ("UPDATE fulcrum_value SET form_id = fulcrum_record.form_id "
+              "FROM fulcrum_record "
+              "WHERE fulcrum_value.record_id = fulcrum_record.id "
+              "AND fulcrum_value.form_id IS NULL")
+    with op.get_context().autocommit_block():
+        last_id = ''
+        while True:
+            ids = [r[0] for r in conn.execute(sa.text("SELECT id FROM fulcrum_record "
+                                                      "WHERE id > :last_id "
+                                                      "ORDER BY id LIMIT :limit"),
+                                              last_id=last_id, limit=BATCH_SIZE)]
+            if not ids:
+                break
+            conn.execute(sa.text("{} AND fulcrum_record.id > :last_id "
+                                 "AND fulcrum_record.id <= :next_id".format(update)),
+                         last_id=last_id, next_id=ids[-1])
+            last_id = ids[-1]
+    # values added since batches were updated. Writes are blocked
+    # until column is not null, so no values without form_id are added
+    op.execute('LOCK TABLE fulcrum_value IN SHARE ROW EXCLUSIVE MODE')
+    op.execute(update)
+    op.alter_column('fulcrum_value', 'form_id', existing_type=sa.String(), nullable=False)
+    op.create_index('ix_fulcrum_value_form_id', 'fulcrum_value', ['form_id'], unique=False)
+    op.create_foreign_key('fulcrum_value_form_id_fkey', 'fulcrum_value', 'fulcrum_form',
+                          ['form_id'], ['id'])
+
+
+def _create_partitions(strategy, modulus):
+    conn = op.get_bind()
+    if strategy == partitions.LIST:
+        for form_id, in conn.execute(sa.text("SELECT id FROM fulcrum_form")):
+            for sql in partitions.get_create_ddl(form_id):
+                op.execute(sql)
+        return
+    for table_name in partitions.PARTITIONED_TABLES:
+        for remainder in range(modulus):
+            op.execute('CREATE TABLE {0}_p{1} PARTITION OF {0} '
+                       'FOR VALUES WITH (MODULUS {2}, REMAINDER {1})'
+                       .format(table_name, remainder, modulus))
+
+
+def _rebuild_tables(strategy=None, modulus=None):
+    """
+    Recreates records and values tables, partitioned with given strategy
+    or unpartitioned, and copies rows to them.
+    """
+    conn = op.get_bind()
+    for table_name, name in RECORD_REFERENCES:
+        op.drop_constraint(name, table_name, type_='foreignkey')
+
+    has_form_id = 'form_id' in [c['name'] for c in sa.inspect(conn).get_columns('fulcrum_value')]
+    for table_name in partitions.PARTITIONED_TABLES:
+        columns = ''
+        if table_name == 'fulcrum_value' and not has_form_id:
+            columns = ', form_id VARCHAR NOT NULL'
+        partition_by = ''
+        if strategy:
+            partition_by = ' PARTITION BY {} ({})'.format(strategy.upper(), partitions.PARTITION_KEY)
+        op.rename_table(table_name, '{}_old'.format(table_name))
+        op.execute('CREATE TABLE {0} (LIKE {0}_old INCLUDING DEFAULTS INCLUDING CONSTRAINTS{1}){2}'
+                   .format(table_name, columns, partition_by))
+    if strategy:
+        _create_partitions(strategy, modulus)
+
+    op.execute('INSERT INTO fulcrum_record SELECT * FROM fulcrum_record_old')
+    if has_form_id:
+        op.execute('INSERT INTO fulcrum_value SELECT * FROM fulcrum_value_old')
+    else:
+        op.execute('INSERT INTO fulcrum_value '
+                   'SELECT fulcrum_value_old.*, fulcrum_record.form_id '
+                   'FROM fulcrum_value_old '
+                   'JOIN fulcrum_record ON fulcrum_record.id = fulcrum_value_old.record_id')
+    op.drop_table('fulcrum_value_old')
+    op.drop_table('fulcrum_record_old')
+
+    pkey = ['id', partitions.PARTITION_KEY] if strategy else ['id']
+    for table_name in partitions.PARTITIONED_TABLES:
+        op.create_primary_key('{}_pkey'.format(table_name), table_name, pkey)
+    for table_name, name, columns, kwargs in INDEXES:
+        op.create_index(name, table_name, columns, unique=False, **kwargs)
+    for table_name, name, columns, referred in FOREIGN_KEYS:
+        op.create_foreign_key(name, table_name, referred, columns, ['id'])
+    for table_name, name in RECORD_REFERENCES:
+        if strategy:
+            op.create_foreign_key(name, table_name, 'fulcrum_record',
+                                  ['record_id', 'form_id'], ['id', 'form_id'])
+        else:
+            op.create_foreign_key(name, table_name, 'fulcrum_record', ['record_id'], ['id'])
+
+
+def upgrade():
+    strategy, modulus = _get_partitioning()
+    if strategy is None:
+        _add_values_form_id()
+    else:
+        _rebuild_tables(strategy, modulus)
+
+
+def downgrade():
+    conn = op.get_bind()
+    partitioned = conn.execute(sa.text("SELECT count(*) FROM pg_partitioned_table "
+                                       "WHERE partrelid = to_regclass('fulcrum_record')")).scalar()
+    if partitioned:
+        _rebuild_tables()
+    op.drop_constraint('fulcrum_value_form_id_fkey', 'fulcrum_value', type_='foreignkey')
+    op.drop_index('ix_fulcrum_value_form_id', table_name='fulcrum_value')
+    op.drop_column('fulcrum_value', 'form_id')
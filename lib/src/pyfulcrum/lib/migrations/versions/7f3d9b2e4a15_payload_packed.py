@@ -0,0 +1,69 @@
+"""payload_packed
+
+Revision ID: 7f3d9b2e4a15
+Revises: 4b7e1d2c9f60
+Create Date: 2026-10-19 22:31:17.504862
+
+Adds column for compressed payloads. Existing payloads are compressed
+with `compresspayloads` cli command.
+"""
+import json
+
+from alembic import op
+import sqlalchemy as sa
+
+from pyfulcrum.lib import compression
+
+
+# revision identifiers, used by Alembic.
+revision = '7f3d9b2e4a15'
+down_revision = '4b7e1d2c9f60'
+branch_labels = None
+depends_on = None
+
+# number of rows decompressed in one transaction
+BATCH_SIZE = 1000
+
+# table -> (payload key, column) pairs, which are not stored in compressed payload
+TABLES = (('fulcrum_project', (),),
+          ('fulcrum_form', (),),
+          ('fulcrum_field', (),),
+          ('fulcrum_record', (('form_values', 'values',),),),
+          ('fulcrum_value', (('meta', 'meta',),),),
+          ('fulcrum_media', (),),
+          )
+
+
+def upgrade():
+    for table_name, columns in TABLES:
+        op.add_column(table_name, sa.Column('payload_packed', sa.LargeBinary(), nullable=True))
+
+
+def _unpack_payloads(table_name, columns):
+    """
+    Moves compressed payloads back to payload column
+    """
+    conn = op.get_bind()
+    select = sa.text('SELECT id, payload_packed{} FROM {} '
+                     'WHERE payload_packed IS NOT NULL '
+                     'ORDER BY id LIMIT :limit'
+                     .format(''.join(', "{}"'.format(c) for k, c in columns), table_name))
+    update = sa.text('UPDATE {} SET payload = CAST(:payload AS jsonb), payload_packed = NULL '
+                     'WHERE id = :id'.format(table_name))
+    with op.get_context().autocommit_block():
+        while True:
+            rows = conn.execute(select, limit=BATCH_SIZE).fetchall()
+            if not rows:
+                break
+            with conn.begin():
+                for row in rows:
+                    payload = compression.unpack(row['payload_packed'])
+                    for key, column in columns:
+                        payload.setdefault(key, row[column])
+                    conn.execute(update, payload=json.dumps(payload), id=row['id'])
+
+
+def downgrade():
+    for table_name, columns in TABLES:
+        _unpack_payloads(table_name, columns)
+        op.drop_column(table_name, 'payload_packed')
@@ -0,0 +1,49 @@
+"""jsonb_columns
+
+Revision ID: 9d41a7c3e5b2
+Revises: 6c2e8f4b1d37
+Create Date: 2026-10-19 18:21:47.530912
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '9d41a7c3e5b2'
+down_revision = '6c2e8f4b1d37'
+branch_labels = None
+depends_on = None
+
+# table -> json columns stored as jsonb
+COLUMNS = (('fulcrum_project', ('payload',),),
+           ('fulcrum_form', ('payload',),),
+           ('fulcrum_field', ('payload',),),
+           ('fulcrum_record', ('payload', 'values',),),
+           ('fulcrum_media', ('payload',),),
+           ('fulcrum_value', ('payload', 'meta',),),
+           )
+
+
+def upgrade():
+    for table_name, columns in COLUMNS:
+        for column in columns:
+            op.alter_column(table_name, column,
+                            type_=postgresql.JSONB(),
+                            existing_type=sa.JSON(),
+                            postgresql_using='"{}"::jsonb'.format(column))
+    op.create_index('ix_fulcrum_record_values', 'fulcrum_record', ['values'],
+                    unique=False,
+                    postgresql_using='gin',
+                    postgresql_ops={'values': 'jsonb_path_ops'})
+
+
+def downgrade():
+    op.drop_index('ix_fulcrum_record_values', table_name='fulcrum_record')
+    for table_name, columns in COLUMNS:
+        for column in columns:
+            op.alter_column(table_name, column,
+                            type_=sa.JSON(),
+                            existing_type=postgresql.JSONB(),
+                            postgresql_using='"{}"::json'.format(column))
@@ -0,0 +1,36 @@
+"""change_log
+
+Revision ID: a8c61e5f0d29
+Revises: 7f3d9b2e4a15
+Create Date: 2026-10-19 23:02:48.116930
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a8c61e5f0d29'
+down_revision = '7f3d9b2e4a15'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('fulcrum_change',
+    sa.Column('id', sa.BigInteger(), nullable=False),
+    sa.Column('txid', sa.BigInteger(), server_default=sa.text('txid_current()'), nullable=False),
+    sa.Column('resource', sa.String(), nullable=False),
+    sa.Column('resource_id', sa.String(), nullable=False),
+    sa.Column('op', sa.Enum('update', 'remove', 'restore', name='change_ops'), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=True),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_fulcrum_change_txid_id', 'fulcrum_change', ['txid', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_fulcrum_change_txid_id', table_name='fulcrum_change')
+    op.drop_table('fulcrum_change')
+    op.execute('DROP TYPE change_ops')
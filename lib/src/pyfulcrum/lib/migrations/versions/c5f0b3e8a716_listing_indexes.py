@@ -0,0 +1,53 @@
+"""listing_indexes
+
+Revision ID: c5f0b3e8a716
+Revises: 9d41a7c3e5b2
+Create Date: 2026-10-19 19:02:33.118450
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5f0b3e8a716'
+down_revision = '9d41a7c3e5b2'
+branch_labels = None
+depends_on = None
+
+# table -> indexed foreign key columns
+FK_INDEXES = (('fulcrum_field', 'form_id',),
+              ('fulcrum_record', 'form_id',),
+              ('fulcrum_value', 'field_id',),
+              ('fulcrum_value', 'record_id',),
+              ('fulcrum_media', 'record_id',),
+              ('fulcrum_media', 'form_id',),
+              )
+
+
+def upgrade():
+    # indexes are built concurrently, so tables are not locked for writes
+    # while they're created. CREATE INDEX CONCURRENTLY cannot run in
+    # transaction.
+    with op.get_context().autocommit_block():
+        for table_name, column in FK_INDEXES:
+            op.create_index(op.f('ix_{}_{}'.format(table_name, column)),
+                            table_name, [column],
+                            unique=False,
+                            postgresql_concurrently=True)
+        op.create_index('ix_fulcrum_record_form_id_updated_at',
+                        'fulcrum_record', ['form_id', 'updated_at'],
+                        unique=False,
+                        postgresql_where=sa.text('removed = false'),
+                        postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_fulcrum_record_form_id_updated_at',
+                      table_name='fulcrum_record',
+                      postgresql_concurrently=True)
+        for table_name, column in reversed(FK_INDEXES):
+            op.drop_index(op.f('ix_{}_{}'.format(table_name, column)),
+                          table_name=table_name,
+                          postgresql_concurrently=True)
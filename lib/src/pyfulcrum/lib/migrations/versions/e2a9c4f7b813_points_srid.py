@@ -0,0 +1,110 @@
+"""points_srid
+
+Revision ID: e2a9c4f7b813
+Revises: c5f0b3e8a716
+Create Date: 2026-10-19 20:14:06.730291
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import geoalchemy2
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2a9c4f7b813'
+down_revision = 'c5f0b3e8a716'
+branch_labels = None
+depends_on = None
+
+SRID = 4326
+# number of rows updated in one transaction
+BATCH_SIZE = 10000
+TABLES = ('fulcrum_record', 'fulcrum_media',)
+
+TRIGGER_FUNCTION = """
+CREATE FUNCTION {name}() RETURNS trigger AS $$
+BEGIN
+    NEW.{column}_new := {expression};
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql
+"""
+TRIGGER = """
+CREATE TRIGGER {name} BEFORE INSERT OR UPDATE OF {column} ON {table}
+FOR EACH ROW EXECUTE PROCEDURE {name}()
+"""
+
+
+def _copy_column(table_name, column, expression, batch_size):
+    """
+    Copies converted values of column to new column in batches, so table
+    is not locked for whole migration.
+    """
+    conn = op.get_bind()
+    sql = ("UPDATE {table} SET {column}_new = {expression} "
+           "WHERE id IN (SELECT id FROM {table} WHERE {column} IS NOT NULL "
+           "AND {column}_new IS NULL LIMIT :limit)").format(table=table_name,
+                                                             column=column,
+                                                             expression=expression.format(column))
+    while conn.execute(sa.text(sql), limit=batch_size).rowcount:
+        pass
+
+
+def _replace_columns(columns):
+    """
+    Replaces geometry columns with new ones, with values converted with
+    expressions. Rows are copied in batches, while trigger keeps new column
+    in sync with rows written meanwhile. Tables are locked only when columns
+    are swapped.
+
+    @param columns list of (table name, column name, new geometry type,
+        conversion expression with {} placeholder for value)
+    """
+    for table_name, column, geometry, expression in columns:
+        name = '{}_{}_new'.format(table_name, column)
+        op.add_column(table_name, sa.Column('{}_new'.format(column), geometry, nullable=True))
+        op.execute(TRIGGER_FUNCTION.format(name=name, column=column,
+                                           expression=expression.format('NEW.{}'.format(column))))
+        op.execute(TRIGGER.format(name=name, table=table_name, column=column))
+
+    # each batch is committed separately
+    with op.get_context().autocommit_block():
+        for table_name, column, geometry, expression in columns:
+            _copy_column(table_name, column, expression, BATCH_SIZE)
+
+    for table_name, column, geometry, expression in columns:
+        name = '{}_{}_new'.format(table_name, column)
+        # blocks writes until migration is committed
+        op.execute('DROP TRIGGER {} ON {}'.format(name, table_name))
+        op.execute('DROP FUNCTION {}()'.format(name))
+        op.drop_column(table_name, column)
+        op.alter_column(table_name, '{}_new'.format(column), new_column_name=column)
+
+
+def _create_point_indexes():
+    for table_name in TABLES:
+        op.create_index('idx_{}_point'.format(table_name), table_name, ['point'],
+                        unique=False, postgresql_using='gist')
+
+
+def upgrade():
+    # points were stored as POINT(lat lon) without srid
+    point = geoalchemy2.types.Geometry(geometry_type='POINT', srid=SRID,
+                                       spatial_index=False)
+    track = geoalchemy2.types.Geometry(geometry_type='LINESTRING', srid=SRID,
+                                       spatial_index=False)
+    flip = 'ST_SetSRID(ST_FlipCoordinates({{}}), {})'.format(SRID)
+    _replace_columns([(table_name, 'point', point, flip) for table_name in TABLES] +
+                     [('fulcrum_media', 'track', track,
+                       'ST_SetSRID({{}}, {})'.format(SRID))])
+    _create_point_indexes()
+
+
+def downgrade():
+    point = geoalchemy2.types.Geometry(geometry_type='POINT', spatial_index=False)
+    track = geoalchemy2.types.Geometry(geometry_type='LINESTRING', spatial_index=False)
+    flip = 'ST_SetSRID(ST_FlipCoordinates({}), 0)'
+    _replace_columns([(table_name, 'point', point, flip) for table_name in TABLES] +
+                     [('fulcrum_media', 'track', track, 'ST_SetSRID({}, 0)')])
+    _create_point_indexes()
+    op.create_index(op.f('ix_fulcrum_record_point'), 'fulcrum_record', ['point'], unique=False)
@@ -3,22 +3,31 @@
 
 import json
 import logging
-
-from datetime import datetime
-from sqlalchemy import (Column, Integer, String,
-                        DateTime, Numeric, ForeignKey,
-                        JSON, Enum, Boolean,
-                        and_)
-from sqlalchemy.orm import relationship
+import math
+
+from datetime import datetime, timezone
+from decimal import Decimal, InvalidOperation
+from sqlalchemy import (Column, Integer, BigInteger, String,
+                        Numeric, ForeignKey,
+                        JSON, Enum, Boolean, Index, LargeBinary,
+                        and_, or_, false, inspect, cast, type_coerce,
+                        select, literal, literal_column, case, exists, tuple_,
+                        event, DDL)
+from sqlalchemy.orm import relationship, object_session, selectinload, joinedload, deferred
 from sqlalchemy.schema import MetaData
 from sqlalchemy.orm.session import sessionmaker
 
-from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.ext.declarative import declarative_base, declared_attr
 from sqlalchemy.sql import func
-from geoalchemy2 import Geometry
+from sqlalchemy.dialects.postgresql import JSONB
+from geoalchemy2 import Geometry, Geography
+from shapely import wkt
 
 from urllib.request import urlopen
 
+from . import compression, flat, partitions, sqlite
+from .sqlite import DateTimeType
+
 md = MetaData()
 Session = sessionmaker()
 
@@ -27,8 +36,217 @@ Base = declarative_base(metadata=md)
 # "created_at": "2015-04-16T13:20:10Z",
 DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
 
+# points are stored as lon/lat in WGS84. Geometry columns are created with
+# AddGeometryColumn() (management=True), which is required by SpatiaLite
+SRID = 4326
+
+# JSON columns, which are stored as jsonb in PostgreSQL, so they can be indexed.
+# None is stored as NULL, not as json null
+JSONType = JSON(none_as_null=True).with_variant(JSONB(none_as_null=True), 'postgresql')
+
+# deferred columns group with compressed payload, see BaseResource.payload
+PAYLOAD_GROUP = 'payload'
+
+# prefix of url params with filters on form values
+VALUES_PARAM = 'values.'
+# suffix of url param -> comparison operator
+VALUES_OPERATORS = {'gt': '__gt__',
+                    'gte': '__ge__',
+                    'lt': '__lt__',
+                    'lte': '__le__',
+                    }
+
+# text values, which can be cast to numeric
+NUMERIC_PATTERN = r'^\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?\s*$'
+
+# minimal length of one degree of latitude in meters, used to compute
+# bounding box of radius filter
+METERS_PER_DEGREE = 110574
+
 log = logging.getLogger(__name__)
 
+
+def make_point(longitude, latitude):
+    """
+    Returns EWKT point for coordinates from Fulcrum payload,
+    or None if coordinates are missing
+    """
+    if longitude is None or latitude is None:
+        return
+    return 'SRID={};POINT({} {})'.format(SRID, longitude, latitude)
+
+
+def _parse_coords(param, value, size):
+    """
+    Returns list of floats from comma-separated url param value
+    """
+    try:
+        coords = [float(v) for v in value.split(',')]
+    except ValueError:
+        coords = []
+    if len(coords) != size or not all(math.isfinite(c) for c in coords):
+        raise ValueError("Invalid {} filter: {}".format(param, value))
+    return coords
+
+
+def _get_radius_envelope(longitude, latitude, radius):
+    """
+    Returns (minx, miny, maxx, maxy) envelope, which contains all points
+    within radius (in meters) from given point. If envelope would cross
+    antimeridian or pole, it spans all longitudes.
+    """
+    dlat = radius / METERS_PER_DEGREE
+    miny, maxy = max(latitude - dlat, -90), min(latitude + dlat, 90)
+    # parallels are shortest at the latitude farthest from equator
+    cos = math.cos(math.radians(max(abs(miny), abs(maxy))))
+    dlon = dlat / cos if cos > 0 else 360
+    minx, maxx = longitude - dlon, longitude + dlon
+    if minx < -180 or maxx > 180:
+        minx, maxx = -180, 180
+    return minx, miny, maxx, maxy
+
+
+def _get_envelope_filter(column, envelope, dialect=None):
+    """
+    Returns condition for geometries, which bounding boxes intersect
+    (minx, miny, maxx, maxy) envelope
+    """
+    if sqlite.is_sqlite(dialect):
+        return sqlite.get_spatial_index_filter(column, func.BuildMbr(*envelope, SRID))
+    return column.intersects(func.ST_MakeEnvelope(*envelope, SRID))
+
+
+def get_spatial_filters(column, url_params, dialect=None):
+    """
+    Returns list of filters on geometry column from url params:
+
+    * bbox=minx,miny,maxx,maxy - geometry is within bounding box
+    * near=lon,lat&radius=m - geometry is within m meters from point
+    * intersects=WKT - geometry intersects with WKT geometry
+
+    Coordinates are lon/lat in WGS84. All filters use spatial index:
+    radius filter is prefiltered with bounding box of the circle,
+    and exact distance is computed on geography (on spheroid in SpatiaLite).
+
+    @param dialect database dialect, PostGIS functions are used if it's not SQLite
+    """
+    out = []
+    is_sqlite = sqlite.is_sqlite(dialect)
+    if url_params.get('bbox'):
+        envelope = _parse_coords('bbox', url_params['bbox'], 4)
+        out.append(_get_envelope_filter(column, envelope, dialect))
+
+    near, radius = url_params.get('near'), url_params.get('radius')
+    if near or radius:
+        if not (near and radius):
+            raise ValueError("Both near and radius params are required")
+        longitude, latitude = _parse_coords('near', near, 2)
+        try:
+            radius = float(radius)
+        except ValueError:
+            radius = -1
+        if not math.isfinite(radius) or radius < 0:
+            raise ValueError("Invalid radius filter: {}".format(url_params['radius']))
+        envelope = _get_radius_envelope(longitude, latitude, radius)
+        if is_sqlite:
+            point = func.MakePoint(longitude, latitude, SRID)
+            distance = func.PtDistWithin(column, point, radius, 1) == 1
+        else:
+            point = func.ST_SetSRID(func.ST_MakePoint(longitude, latitude), SRID)
+            distance = func.ST_DWithin(cast(column, Geography(srid=SRID)),
+                                       cast(point, Geography(srid=SRID)),
+                                       radius)
+        out.append(and_(_get_envelope_filter(column, envelope, dialect), distance))
+
+    if url_params.get('intersects'):
+        try:
+            geom = wkt.loads(url_params['intersects'])
+        except Exception:
+            raise ValueError("Invalid intersects filter: {}".format(url_params['intersects']))
+        intersects = func.ST_Intersects(column, func.ST_GeomFromText(geom.wkt, SRID))
+        if is_sqlite:
+            # SpatiaLite doesn't use spatial index implicitly
+            intersects = and_(_get_envelope_filter(column, geom.bounds, dialect),
+                              intersects == 1)
+        out.append(intersects)
+    return out
+
+
+class Change(Base):
+    """
+    Append-only log of changes of resources. Consumers can follow changes
+    incrementally with id of last read change as a cursor.
+
+    Ids are assigned when changes are inserted, but changes are visible
+    when transaction is committed, so a change with lower id can be
+    committed after changes with higher ids were read. Changes are ordered
+    by transaction and id, and only changes of transactions older than
+    any running transaction are listed (in PostgreSQL), so changes aren't
+    added before a cursor.
+    """
+    __tablename__ = 'fulcrum_change'
+
+    OP_UPDATE = 'update'
+    OP_REMOVE = 'remove'
+    OP_RESTORE = 'restore'
+    OPS = (OP_UPDATE, OP_REMOVE, OP_RESTORE,)
+
+    # sqlite autoincrements only integer primary keys
+    id = Column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True)
+    # id of transaction, which logged change
+    txid = Column(BigInteger, nullable=False, server_default=func.txid_current())
+    # name of ApiManager resource (records, photos..)
+    resource = Column(String, nullable=False)
+    resource_id = Column(String, nullable=False)
+    op = Column(Enum(*OPS, name='change_ops'), nullable=False)
+    # Fulcrum version of resource, if it's versioned
+    version = Column(Integer, nullable=True)
+    created_at = Column(DateTimeType(),
+                        nullable=False,
+                        server_default=func.now())
+
+    def __str__(self):
+        return u'Change({}: {} {}({}))'.format(self.id, self.op, self.resource, self.resource_id)
+
+    __repr__ = __str__
+
+    @classmethod
+    def list(cls, session, since=None, resource=None):
+        """
+        Returns query with changes after given cursor, in order.
+
+        @param since id of last read change
+        @param resource optional resource name to filter changes
+        """
+        q = session.query(cls)
+        if session.get_bind().dialect.name == 'postgresql':
+            q = q.filter(cls.txid < func.txid_snapshot_xmin(func.txid_current_snapshot()))
+        if since is not None:
+            txid = session.query(cls.txid).filter(cls.id == since).scalar()
+            if txid is not None:
+                q = q.filter(tuple_(cls.txid, cls.id) > tuple_(txid, since))
+            else:
+                q = q.filter(cls.id > since)
+        if resource is not None:
+            q = q.filter(cls.resource == resource)
+        return q.order_by(cls.txid, cls.id)
+
+    def as_dict(self):
+        created_at = self.created_at
+        if created_at is not None and created_at.tzinfo is not None:
+            created_at = created_at.astimezone(timezone.utc)
+        return {'id': self.id,
+                'resource': self.resource,
+                'resource_id': self.resource_id,
+                'op': self.op,
+                'version': self.version,
+                'created_at': created_at.strftime(DATE_FORMAT) if created_at else None,
+                }
+
+
+Index('ix_fulcrum_change_txid_id', Change.txid, Change.id)
+
+
 class BaseResource(Base):
     """
     Base class for data objects. This contains common tables
@@ -39,27 +257,144 @@ class BaseResource(Base):
     # with source, dest names, i.e. ('id', 'media_key',))
     MAPPED_COLUMNS = ('id', 'created_at', 'updated_at',)
 
+    # list of (payload key, attribute) pairs, which are not stored
+    # in compressed payload, because the same data is stored in column.
+    # They're restored from columns when payload is read.
+    PAYLOAD_COLUMNS = ()
+
+    # Fulcrum API payload keys, which are not in MAPPED_COLUMNS, but
+    # are exported with them (i.e. csv columns), so each export of
+    # a model has the same columns.
+    PAYLOAD_KEYS = ()
+
+    # name of resource in change log, changes are not logged if it's None
+    CHANGE_RESOURCE = None
+
     __abstract__ = True
 
     # judging from example values this is probably uuid,
     # but api schema says string
     # also, in media resources it's media_key
     id = Column(String, primary_key=True)
-    created_at = Column(DateTime(timezone=True),
+    created_at = Column(DateTimeType(),
                         nullable=False,
                         server_default=func.now())
-    updated_at = Column(DateTime(timezone=True),
+    updated_at = Column(DateTimeType(),
                         nullable=False,
                         server_default=func.now(),
                         onupdate=func.now())
-    fetched_at = Column(DateTime(timezone=True),
+    fetched_at = Column(DateTimeType(),
                         nullable=True,
                         server_default=func.now(),
                         onupdate=func.now())
-    # raw json received for object
-    payload = Column(JSON, nullable=True)
+    # raw json received for object, use .payload to access it
+    _payload = Column('payload', JSONType, nullable=True)
     removed = Column(Boolean, nullable=False, default=False, index=True)
 
+    @declared_attr
+    def payload_packed(cls):
+        """
+        Compressed payload, used instead of payload column when
+        payloads compression is enabled. It's loaded only when
+        payload is accessed, or with undefer_group(PAYLOAD_GROUP)
+        """
+        return deferred(Column(LargeBinary, nullable=True), group=PAYLOAD_GROUP)
+
+    @property
+    def payload(self):
+        """
+        Returns raw json received for object. Compressed payload
+        is decompressed on first access.
+        """
+        if self._payload is not None:
+            return self._payload
+        packed = self.payload_packed
+        if packed is None:
+            return None
+        cached = getattr(self, '_unpacked', None)
+        if cached is not None and cached[0] is packed:
+            return cached[1]
+        payload = self.restore_payload(None, packed,
+                                       *[getattr(self, attr) for key, attr in self.PAYLOAD_COLUMNS])
+        self._unpacked = (packed, payload,)
+        return payload
+
+    @payload.setter
+    def payload(self, payload):
+        self.set_payload(payload)
+
+    @classmethod
+    def get_payload_columns(cls):
+        """
+        Returns columns, from which payload is restored with
+        restore_payload(). This allows to read payloads with column
+        projection, without loading objects.
+        """
+        return ([cls._payload, cls.payload_packed] +
+                [getattr(cls, attr) for key, attr in cls.PAYLOAD_COLUMNS])
+
+    @classmethod
+    def restore_payload(cls, payload, packed, *columns):
+        """
+        Returns payload from values of get_payload_columns() columns
+
+        @param payload uncompressed payload or None
+        @param packed compressed payload or None
+        @param columns values of PAYLOAD_COLUMNS attributes
+        """
+        if payload is not None or packed is None:
+            return payload
+        payload = compression.unpack(packed)
+        for (key, attr), value in zip(cls.PAYLOAD_COLUMNS, columns):
+            if key not in payload:
+                payload[key] = value
+        return payload
+
+    def set_payload(self, payload, compress=False):
+        """
+        Sets raw payload of object.
+
+        @param payload dict with JSON payload
+        @param compress if True, payload is stored compressed, without
+               keys duplicated in columns (see PAYLOAD_COLUMNS)
+        """
+        if not compress or payload is None:
+            self._payload = payload
+            self.payload_packed = None
+            return
+        delta = dict(payload)
+        for key, attr in self.PAYLOAD_COLUMNS:
+            if key in delta and delta[key] == getattr(self, attr):
+                delta.pop(key)
+        self._payload = None
+        self.payload_packed = compression.pack(delta)
+
+    @classmethod
+    def pack_payloads(cls, session, batch_size=1000):
+        """
+        Compresses stored payloads, which are not compressed yet.
+        Rows are processed in batches ordered by id, each committed separately.
+
+        @returns number of compressed payloads
+        """
+        count = 0
+        last_id = ''
+        while True:
+            batch = (session.query(cls)
+                            .filter(cls._payload != None, cls.id > last_id)
+                            .order_by(cls.id)
+                            .limit(batch_size)
+                            .all())
+            if not batch:
+                return count
+            for obj in batch:
+                obj.set_payload(obj.payload, compress=True)
+            last_id = batch[-1].id
+            count += len(batch)
+            session.commit()
+            session.expunge_all()
+            log.info('compressed %s payloads of %s', count, cls.__tablename__)
+
     def __str__(self):
         return u'{}({})'.format(self.__class__.__name__, self.id)
 
@@ -73,6 +408,16 @@ class BaseResource(Base):
         """
         return []
 
+    @classmethod
+    def get_load_options(cls):
+        """
+        Returns list of loader options applied to list queries, so
+        related objects used in serialization are loaded with a
+        constant number of queries.
+        Subclass should override this if it uses relations when serialized.
+        """
+        return []
+
     @classmethod
     def get(cls, id, session, if_removed=False):
         """
@@ -159,7 +504,10 @@ class BaseResource(Base):
         if existing and existing.removed and not reset_removed:
             raise ValueError("Cannot process payload for {}: {}, because it's marked as removed"
                              .format(cls.__name__, id))
-        
+
+        # only actual changes are logged
+        changed = existing is None
+        previous = existing.payload if existing and cls.CHANGE_RESOURCE else None
         if not existing:
             existing = cls(id=id)
         for m in cls.MAPPED_COLUMNS:
@@ -179,32 +527,170 @@ class BaseResource(Base):
             current = existing.removed 
             existing.removed = False
             if current:
-                for cname in cls.CHILDREN_ATTRS:
-                    chandler = getattr(existing, cname, None)
-                    if chandler:
-                        for c in chandler:
-                            c.removed = False
-                            session.add(c)
+                changed = True
+                existing._set_children_removed(session, False, recursive=False)
 
+        version = payload.get('version')
         cls._post_payload(existing, payload, s, client, storage)
 
-        existing.payload = payload
+        existing.set_payload(payload, compress=compression.is_enabled(s))
         s.add(existing)
+        if changed or payload != previous:
+            existing.log_change(s, Change.OP_UPDATE,
+                                version=version if isinstance(version, int) else None)
         s.flush()
         return existing
+
+    @property
+    def change_resource(self):
+        return self.CHANGE_RESOURCE
+
+    @classmethod
+    def get_change_resource(cls):
+        """
+        Returns sql expression with change log resource name of rows
+        """
+        return literal(cls.CHANGE_RESOURCE)
+
+    def log_change(self, session, op, version=None):
+        """
+        Appends change of this object to change log
+        """
+        if self.CHANGE_RESOURCE is None:
+            return
+        session.add(Change(resource=self.change_resource, resource_id=self.id,
+                           op=op, version=version))
+
+    @classmethod
+    def _log_changes(cls, session, op, *conditions):
+        """
+        Appends changes of rows matching conditions to change log,
+        with one INSERT .. SELECT statement. Objects are not loaded.
+        """
+        if cls.CHANGE_RESOURCE is None:
+            return
+        q = select([cls.get_change_resource(), cls.id, literal(op)]).where(and_(*conditions))
+        session.execute(Change.__table__.insert()
+                                        .from_select(['resource', 'resource_id', 'op'], q))
     
     CHILDREN_ATTRS = ('records', 'fields_list', 'values_list', 'media_list',)
     PARENT_ATTRS = ('form', 'record',)
+
+    @classmethod
+    def get_children(cls):
+        """
+        Returns list of (child class, foreign key column) pairs
+        for relations listed in CHILDREN_ATTRS.
+        """
+        out = []
+        relations = inspect(cls).relationships
+        for cname in cls.CHILDREN_ATTRS:
+            rel = relations.get(cname)
+            if rel is None:
+                continue
+            for local_col, remote_col in rel.local_remote_pairs:
+                out.append((rel.mapper.class_, remote_col,))
+        return out
+
+    @classmethod
+    def get_descendants(cls, recursive=True):
+        """
+        Returns tuple of classes of children (and their children,
+        if recursive) of this class.
+        """
+        out = ()
+        for child_cls, fk in cls.get_children():
+            if child_cls in out:
+                continue
+            out += (child_cls,)
+            if recursive:
+                out += tuple(c for c in child_cls.get_descendants() if c not in out)
+        return out
+
+    @classmethod
+    def _set_removed(cls, session, ids, removed, recursive=True, exclude=()):
+        """
+        Sets removed flag on children of objects with given ids, with one
+        UPDATE statement per child table. Objects are not loaded.
+
+        @param ids list of ids or subquery selecting ids of parent objects
+        @param removed value of removed flag to set
+        @param recursive if True, children of children will be updated too
+        @param exclude child classes, which were already updated by parent
+
+        @returns number of updated rows
+        """
+        count = 0
+        children = cls.get_children()
+        # children of children, which are also direct children (like form's
+        # values and media), are updated once, by parent's foreign key
+        updated = tuple(exclude) + tuple(child_cls for child_cls, fk in children)
+        op = Change.OP_REMOVE if removed else Change.OP_RESTORE
+        for child_cls, fk in children:
+            if child_cls in exclude:
+                continue
+            child_cls._log_changes(session, op, fk.in_(ids), child_cls.removed != removed)
+            count += (session.query(child_cls)
+                             .filter(fk.in_(ids), child_cls.removed != removed)
+                             .update({child_cls.removed: removed},
+                                     synchronize_session=False))
+            child_cls._post_set_removed(session, fk.in_(ids), removed)
+            if recursive:
+                child_ids = session.query(child_cls.id).filter(fk.in_(ids))
+                count += child_cls._set_removed(session, child_ids, removed,
+                                                exclude=updated)
+        return count
+
+    @classmethod
+    def _post_set_removed(cls, session, condition, removed):
+        """
+        Hook called after removed flag is set in bulk on rows matching
+        condition by parent's _set_removed(). Objects are not loaded.
+        Subclass can override default implementation.
+
+        @param condition condition selecting updated rows
+        @param removed value of removed flag
+        """
+        pass
+
+    def _set_children_removed(self, session, removed, recursive=True):
+        """
+        Sets removed flag on children of this object in bulk, and expires
+        stale state of loaded objects.
+        """
+        count = self._set_removed(session, [self.id], removed, recursive=recursive)
+        # only objects of child classes could be updated
+        classes = self.get_descendants(recursive=recursive)
+        for obj in list(session.identity_map.values()):
+            if isinstance(obj, classes) and obj is not self:
+                session.expire(obj, ['removed', 'updated_at', 'fetched_at'])
+        return count
+
     def remove(self, session):
+        """
+        Marks object and all its children as removed.
+        Returns number of rows marked as removed.
+        """
+        count = 0 if self.removed else 1
+        if not self.removed:
+            self.log_change(session, Change.OP_REMOVE)
         self.removed = True
-        for cname in self.CHILDREN_ATTRS:
-            chandler = getattr(self, cname, None)
-            if chandler is not None:
-               for c in chandler:
-                    c.remove(session)
         session.add(self)
         session.flush()
-        return self
+        count += self._set_children_removed(session, True)
+        self._post_remove(self, session)
+        return count
+
+    @classmethod
+    def _post_remove(cls, instance, session):
+        """
+        Hook called after instance and its children are marked as removed.
+        Subclass can override default implementation.
+
+        @param instance removed instance of resource
+        @param session SQLAlchemy session
+        """
+        pass
 
 
 class Project(BaseResource):
@@ -216,6 +702,7 @@ class Project(BaseResource):
     name = Column(String, index=True)
     description = Column(String(1024))
     MAPPED_COLUMNS = BaseResource.MAPPED_COLUMNS + ('name', 'description',)
+    CHANGE_RESOURCE = 'projects'
 
 
 class Form(BaseResource):
@@ -227,18 +714,31 @@ class Form(BaseResource):
     name = Column(String, index=True)
     description = Column(String(1024))
     fields = Column(JSON, nullable=False)
+    # schema of flat records table, see pyfulcrum.lib.flat
+    flat_schema = Column(JSON, nullable=True)
     MAPPED_COLUMNS = (BaseResource.MAPPED_COLUMNS +
                       ('name', 'description', ('elements', 'fields',),)
                       )
+    PAYLOAD_KEYS = ('auto_assign', 'bounding_box', 'image', 'image_large',
+                    'image_small', 'image_thumbnail', 'record_count',
+                    'record_title_key', 'status_field', 'title_field_keys',)
+    CHANGE_RESOURCE = 'forms'
 
     @property
     def records_count(self):
         """
-        Returns number of records for this form.
+        Returns number of records for this form. Records are counted
+        in db, so they're not loaded.
         """
-        if self.removed:
-            return len([r for r in self.records])
-        return len([r for r in self.records if not r.removed])
+        session = object_session(self)
+        if session is None:
+            if self.removed:
+                return len(self.records)
+            return len([r for r in self.records if not r.removed])
+        q = session.query(func.count(Record.id)).filter(Record.form_id == self.id)
+        if not self.removed:
+            q = q.filter(Record.removed == False)
+        return q.scalar()
 
     @classmethod
     def _post_payload(cls, instance, payload, session, client, storage):
@@ -249,15 +749,52 @@ class Form(BaseResource):
         # but first, we need to add this form to db
         session.add(instance)
         session.flush()
-        session.query(Field).filter(Field.form_id== instance.id).update({Field.removed:True})
+        # fields not present in form anymore
+        removed_fields = (Field.form_id == instance.id,
+                          Field.removed == False,
+                          ~Field.id.in_([f['key'] for f in payload['elements']]))
+        Field._log_changes(session, Change.OP_REMOVE, *removed_fields)
+        session.query(Field).filter(*removed_fields).update({Field.removed: True},
+                                                            synchronize_session='fetch')
         session.flush()
         for f in payload['elements']:
             f['form_id'] = instance.id
             f['id'] = f['key']
             Field.from_payload(f, session, client, storage, reset_removed=True)
 
+        # form's records and values partitions, if tables are list-partitioned
+        partitions.create_partitions(session, instance.id)
+        if flat.is_enabled(session) and not instance.removed:
+            instance.sync_flat_table(session)
         return
 
+    @classmethod
+    def _post_remove(cls, instance, session):
+        if instance.flat_schema is not None:
+            flat.drop_table(session, instance.id)
+            instance.flat_schema = None
+
+    def sync_flat_table(self, session, force=False):
+        """
+        Recreates flat records table if form's fields changed.
+
+        @param force if True, table will be recreated even if fields didn't change
+        @returns number of records inserted, or None if table is up to date
+        """
+        fields = session.query(Field).filter(Field.form_id == self.id,
+                                             Field.removed == False)
+        schema = flat.get_schema(fields)
+        if not force and schema == self.flat_schema:
+            return
+        records = (session.query(Record)
+                          .filter(Record.form_id == self.id,
+                                  Record.removed == False)
+                          .yield_per(flat.BATCH_SIZE))
+        count = flat.create_table(session, self.id, schema, records)
+        self.flat_schema = schema
+        session.add(self)
+        return count
+
     @classmethod
     def get_q_params(cls, url_params, *args, **kwargs):
         out = []
@@ -282,7 +819,7 @@ FieldTypeEnum = Enum(*FIELD_TYPES, name='field_types')
 
 class Field(BaseResource):
     __tablename__ = 'fulcrum_field'
-    form_id = Column(String, ForeignKey('fulcrum_form.id'), nullable=False)
+    form_id = Column(String, ForeignKey('fulcrum_form.id'), nullable=False, index=True)
     label = Column(String, nullable=False, index=True)
     data_name = Column(String, nullable=False, index=True)
     description = Column(String)
@@ -296,6 +833,7 @@ class Field(BaseResource):
                        'required', 'disabled', 'hidden',
                        'type', 'form_id',)
                       )
+    CHANGE_RESOURCE = 'fields'
 
     def __str__(self):
         return 'Field({}, label={}, type={}, description={})'.format(self.id,
@@ -352,15 +890,15 @@ class Field(BaseResource):
 
 class Record(BaseResource):
     __tablename__ = 'fulcrum_record'
-    form_id = Column(String, ForeignKey('fulcrum_form.id'), nullable=False)
+    form_id = Column(String, ForeignKey('fulcrum_form.id'), nullable=False, index=True)
     project_id = Column(String,
                         ForeignKey('fulcrum_project.id'),
                         nullable=True)
-    point = Column(Geometry('POINT'), nullable=True, index=True)
+    point = Column(Geometry('POINT', srid=SRID, management=True), nullable=True)
     altitude = Column(Integer, nullable=True)
     speed = Column(Numeric, nullable=True)
     course = Column(Numeric, nullable=True)
-    values = Column(JSON, nullable=True)
+    values = Column(JSONType, nullable=True)
     status = Column(String, nullable=True, index=True)
     created_by = Column(String, nullable=False)
     updated_by = Column(String, nullable=True)
@@ -374,34 +912,45 @@ class Record(BaseResource):
                        'values', 'status', 'created_by',
                        'updated_by', 'assigned_to',)
                       )
+    PAYLOAD_COLUMNS = (('form_values', 'values',),)
+    PAYLOAD_KEYS = ('latitude', 'longitude', 'version',
+                    'horizontal_accuracy', 'vertical_accuracy',
+                    'client_created_at', 'client_updated_at',
+                    'created_by_id', 'updated_by_id', 'assigned_to_id',)
+    CHANGE_RESOURCE = 'records'
     
+    @classmethod
+    def get_load_options(cls):
+        """
+        Values with their fields and media are used by .get_values()
+        """
+        return [selectinload(cls.values_list).joinedload(Value.field),
+                selectinload(cls.media_list)]
+
+    def get_media_index(self):
+        """
+        Returns dictionary of media id -> Media for this record
+        """
+        return dict((m.id, m) for m in self.media_list)
+
     def get_values(self, storage):
         """
         Return dictionary of label -> field value.
         Each field value is a dictionary from Value.get_value()
         """
-        media = {}
-        for m in self.media_list:
-            try:
-                media[m.id].append(m)
-            except KeyError:
-                media[m.id] = [m]
+        media = self.get_media_index()
         out = {}
         for val in self.values_list:
             if val.removed:
                 continue
-            fval = val.get_value(storage)
+            fval = val.get_value(storage, media=media)
             out[fval['label']] = fval
         return out
 
     @classmethod
     def _pre_payload(cls, payload, session, client, storage):
         f = payload
-        point = None
-        if f.get('latitude') and f.get('longitude'):
-            point = 'POINT({latitude} {longitude})'.format(latitude=f['latitude'],
-                                                           longitude=f['longitude'])
-        f['point'] = point
+        f['point'] = make_point(f.get('longitude'), f.get('latitude'))
         f['values'] = f['form_values']
         return f
 
@@ -409,7 +958,8 @@ class Record(BaseResource):
     def _post_payload(cls, instance, payload, session, client, storage):
         session.add(instance)
         session.flush()
-        session.query(Value).filter(Value.record_id== instance.id).update({Value.removed:True})
+        session.query(Value).filter(Value.form_id == instance.form_id,
+                                    Value.record_id == instance.id).update({Value.removed:True})
         session.flush()
 
         for field_id, field_value in payload['form_values'].items():
@@ -420,6 +970,7 @@ class Record(BaseResource):
             f = {}
             f['type'] = fdef.type
             f['record_id'] = instance.id
+            f['form_id'] = instance.form_id
             f['value'] = field_value
             f['meta'] = {'key': field_id,
                          'value': field_value}
@@ -428,11 +979,42 @@ class Record(BaseResource):
             f['updated_at'] = instance.updated_at
             f['id'] = '{}_{}'.format(instance.id, field_id)
             Value.from_payload(f, session, client, storage, reset_removed=True)
-            
+
+        if flat.is_enabled(session) and not instance.removed:
+            form = instance.form
+            if form.flat_schema is None:
+                form.sync_flat_table(session)
+            flat.upsert_record(session, instance, form.flat_schema)
+
        # cleanup payload for saving
         payload.pop('point', None)
         payload.pop('values', None)
 
+    @classmethod
+    def _post_remove(cls, instance, session):
+        if instance.form.flat_schema is not None:
+            flat.delete_record(session, instance)
+
+    @classmethod
+    def _post_set_removed(cls, session, condition, removed):
+        """
+        Removes rows of records removed by parent from flat tables,
+        or inserts rows of restored records, with statements per form table
+        """
+        form_ids = session.query(cls.form_id).filter(condition)
+        for form in session.query(Form).filter(Form.id.in_(form_ids)):
+            if form.flat_schema is None:
+                continue
+            ids = session.query(cls.id).filter(condition, cls.form_id == form.id)
+            flat.delete_records(session, form.id, ids)
+            if not removed:
+                records = (session.query(cls)
+                                  .filter(condition,
+                                          cls.form_id == form.id,
+                                          cls.removed == False)
+                                  .yield_per(flat.BATCH_SIZE))
+                flat.insert_records(session, form.id, form.flat_schema, records)
+
     @classmethod
     def get_q_params(cls, url_params, *args, **kwargs):
         out = []
@@ -451,30 +1033,149 @@ class Record(BaseResource):
         if url_params.get('updated_since'):
             out.append(cls.updated_at > url_params['updated_since'])
 
+        session = kwargs.get('session')
+        dialect = session.get_bind().dialect if session is not None else None
+        out.extend(get_spatial_filters(cls.point, url_params, dialect))
+
+        if session is not None:
+            out.extend(cls.get_values_filters(url_params, session))
+
         if out:
             return [and_(*out)]
         return out
 
+    @classmethod
+    def get_values_filters(cls, url_params, session):
+        """
+        Returns list of filters on form values from url params:
+
+        * values.<data_name>=x - value equals x
+        * values.<data_name>__in=x,y - value is one of x, y
+        * values.<data_name>__gt=x (__gte, __lt, __lte) - value range
+
+        For choice fields x is one of selected values. Equality filters
+        use jsonb containment, so they can use GIN index on values.
+        SQLite uses json1 functions instead.
+        """
+        out = []
+        dialect = session.get_bind().dialect
+        for param, pvalue in url_params.items():
+            if not param.startswith(VALUES_PARAM):
+                continue
+            # data names can contain __, suffix is used only if it's an operator
+            data_name, _, op = param[len(VALUES_PARAM):].rpartition('__')
+            if not data_name or (op != 'in' and op not in VALUES_OPERATORS):
+                data_name, op = param[len(VALUES_PARAM):], None
+            number = None
+            if op in VALUES_OPERATORS:
+                try:
+                    number = Decimal(pvalue)
+                except InvalidOperation:
+                    pass
+                if number is None or not number.is_finite():
+                    raise ValueError("Invalid values filter: {}={}".format(param, pvalue))
+            fields = session.query(Field).filter(Field.data_name == data_name,
+                                                 Field.removed == False)
+            if url_params.get('form_id'):
+                fields = fields.filter(Field.form_id == url_params['form_id'])
+            conditions = []
+            for field in fields:
+                if op in VALUES_OPERATORS:
+                    numeric = flat.get_field_kind(field) == 'numeric'
+                    conditions.append(cls._get_value_range(field, VALUES_OPERATORS[op],
+                                                           number if numeric else pvalue,
+                                                           dialect))
+                else:
+                    pvalues = pvalue.split(',') if op == 'in' else [pvalue]
+                    conditions.extend(cls._get_value_match(field, v, dialect) for v in pvalues)
+            # unknown data name should not match anything
+            out.append(or_(*conditions) if conditions else false())
+        return out
+
+    @classmethod
+    def _get_value_match(cls, field, value, dialect=None):
+        choice = field.type in ('ChoiceField', 'ClassificationField',)
+        if sqlite.is_sqlite(dialect):
+            path = '$."{}"'.format(field.id)
+            if choice:
+                choices = func.json_each(cls.values, '{}.choice_values'.format(path))
+                match = exists(select([literal_column('1')])
+                               .select_from(choices)
+                               .where(literal_column('json_each.value') == value))
+            else:
+                match = func.json_extract(cls.values, path) == value
+            return and_(cls.form_id == field.form_id, match)
+        if choice:
+            value = {'choice_values': [value]}
+        return and_(cls.form_id == field.form_id,
+                    type_coerce(cls.values, JSONB).contains({field.id: value}))
+
+    @staticmethod
+    def _cast_numeric(column, dialect=None):
+        """
+        Returns numeric expression for text value, which is NULL
+        for non-numeric values, so they don't fail the cast
+        """
+        if sqlite.is_sqlite(dialect):
+            # SQLite casts any text without error, but to 0
+            is_numeric = and_(func.trim(column) != '',
+                              func.trim(column, '0123456789.+-eE ') == '')
+        else:
+            is_numeric = column.op('~')(NUMERIC_PATTERN)
+        return case([(is_numeric, cast(column, Numeric))], else_=None)
+
+    @classmethod
+    def _get_value_range(cls, field, op, value, dialect=None):
+        if sqlite.is_sqlite(dialect):
+            column = func.json_extract(cls.values, '$."{}"'.format(field.id))
+        else:
+            column = type_coerce(cls.values, JSONB)[field.id].astext
+        if flat.get_field_kind(field) == 'numeric':
+            column = cls._cast_numeric(column, dialect)
+        return and_(cls.form_id == field.form_id, getattr(column, op)(value))
+
+# jsonb_path_ops index supports containment (@>) used in values filters.
+# It's created in PostgreSQL only, SQLite filters values without index
+event.listen(Record.__table__, 'after_create',
+             DDL('CREATE INDEX ix_fulcrum_record_values ON %(table)s '
+                 'USING gin ("values" jsonb_path_ops)')
+             .execute_if(dialect='postgresql'))
+# default records listing: active records of a form ordered by update time
+Index('ix_fulcrum_record_form_id_updated_at', Record.form_id, Record.updated_at,
+      postgresql_where=Record.removed == False,
+      sqlite_where=Record.removed == False)
+
+
 class Value(BaseResource):
     __tablename__ = 'fulcrum_value'
 
     field_id = Column(String,
                       ForeignKey('fulcrum_field.id'),
-                      nullable=False)
+                      nullable=False,
+                      index=True)
     record_id = Column(String,
                        ForeignKey('fulcrum_record.id'),
-                       nullable=False)
+                       nullable=False,
+                       index=True)
+    # copied from record, used as partitioning key, see pyfulcrum.lib.partitions
+    form_id = Column(String, ForeignKey('fulcrum_form.id'), nullable=False, index=True)
     # value can be any type (dict, list, number, string..)
     value = Column(JSON, nullable=False, default='')
     type = Column(FieldTypeEnum, nullable=False, index=True)
-    meta = Column(JSON, nullable=False)
+    meta = Column(JSONType, nullable=False)
     field = relationship(Field, backref='values_list')
     record = relationship(Record, backref='values_list')
+    form = relationship(Form, backref='values_list')
 
 
     MAPPED_COLUMNS = (BaseResource.MAPPED_COLUMNS +
-                      ('field_id', 'record_id',
+                      ('field_id', 'record_id', 'form_id',
                        'value', 'meta', 'type',))
+    PAYLOAD_COLUMNS = (('meta', 'meta',),)
+
+    @classmethod
+    def get_load_options(cls):
+        return [joinedload(cls.field)]
 
     @classmethod
     def _post_payload(cls, instance, payload, session, client, storage):
@@ -501,11 +1202,14 @@ class Value(BaseResource):
                     pdata['media_type'] = media_type.rstrip('s')
                     media = Media.from_payload(pdata, session, client, storage)
 
-    def get_value(self, storage):
+    def get_value(self, storage, media=None):
         """
         Returns dictionary with field value information:
 
         @param storage Storage instance to calculate paths and urls for media files
+        @param media optional dictionary of media id -> Media from
+               Record.get_media_index(). Should be passed when values of the
+               same record are serialized, so index is not rebuilt for each value
 
         * field key (short alphanumeric code)
         * description of field
@@ -531,8 +1235,8 @@ class Value(BaseResource):
         # name of key in values list with media id
         media_key = field.media_key
         if media_key:
-
-            media = dict((m.id, m) for m in self.record.media_list)
+            if media is None:
+                media = self.record.get_media_index()
             # iterate over items in value
             values = self.value
             if isinstance(self.value, dict):
@@ -561,15 +1265,18 @@ class Media(BaseResource):
     # access_key = Column(String, nullable=False, unique=True)
     created_by = Column(String, nullable=False)
     updated_by = Column(String, nullable=True)
-    point = Column(Geometry('POINT'), nullable=True)
+    point = Column(Geometry('POINT', srid=SRID, management=True), nullable=True)
     record_id = Column(String,
                        ForeignKey('fulcrum_record.id'),
-                       nullable=False)
-    form_id = Column(String, ForeignKey('fulcrum_form.id'), nullable=False)
+                       nullable=False,
+                       index=True)
+    form_id = Column(String, ForeignKey('fulcrum_form.id'), nullable=False, index=True)
     file_size = Column(Integer, nullable=False)
     content_type = Column(String, nullable=False)
-    track = Column(Geometry('LINESTRING'), nullable=True)
+    track = Column(Geometry('LINESTRING', srid=SRID, management=True), nullable=True)
     media_type = Column(Enum(*MEDIA_TYPES, name='media_types'), nullable=False, index=True)
+    # storage paths for each size, see Storage.get_manifest()
+    manifest = Column(JSON, nullable=True)
     form = relationship(Form, backref='media_list')
     record = relationship(Record, backref='media_list')
 
@@ -578,6 +1285,20 @@ class Media(BaseResource):
                        'record_id', 'form_id',
                        'file_size', 'content_type',
                        'media_type'))
+    # media type -> name of resource in change log
+    CHANGE_RESOURCES = {MEDIA_PHOTO: 'photos',
+                        MEDIA_AUDIO: 'audio',
+                        MEDIA_VIDEO: 'videos',
+                        MEDIA_SIGNATURE: 'signatures'}
+    CHANGE_RESOURCE = 'media'
+
+    @property
+    def change_resource(self):
+        return self.CHANGE_RESOURCES.get(self.media_type, self.CHANGE_RESOURCE)
+
+    @classmethod
+    def get_change_resource(cls):
+        return case(cls.CHANGE_RESOURCES, value=cls.media_type, else_=cls.CHANGE_RESOURCE)
 
     SIZES_PHOTO = ('large', 'thumbnail', 'original',)
     SIZES_SIGNATURE = SIZES_PHOTO
@@ -595,16 +1316,17 @@ class Media(BaseResource):
              'audio': SIZES_AUDIO,
              'signature': SIZES_SIGNATURE,
              'video': SIZES_VIDEO}
+    # urls of sizes are payload keys too
+    PAYLOAD_KEYS = (('access_key', 'latitude', 'longitude',
+                     'created_by_id', 'updated_by_id', 'deleted_at',
+                     'exif', 'processed', 'stored', 'uploaded', 'url',) +
+                    tuple(sorted(SIZES_ALL)))
 
     @classmethod
     def _pre_payload(cls, payload, session, client, storage):
         f = payload
         f['id'] = f['access_key']
-        point = None
-        if f.get('latitude') and f.get('longitude'):
-            point = 'POINT({latitude} {longitude})'.format(latitude=f['latitude'],
-                                                           longitude=f['longitude'])
-        f['point'] = point
+        f['point'] = make_point(f.get('longitude'), f.get('latitude'))
         return payload
 
     @property
@@ -615,41 +1337,65 @@ class Media(BaseResource):
         """
         Returns size-specific path to media file
         """
-        return storage.get_path(self.form_id,
-                                self.record_id,
-                                self.media_type,
-                                size,
-                                self.content_type)
+        return storage.get_path_for(self.get_common_path(storage, size))
 
     def get_common_path(self, storage, size):
         """
         Returns common path in storage
         """
-        return storage.get_common_path(self.form_id,
-                                       self.record_id,
-                                       self.media_type,
-                                       size,
-                                       self.content_type)
+        manifest = self.manifest
+        if storage.is_current_manifest(manifest) and size in manifest['paths']:
+            return manifest['paths'][size]
+        return storage.resolve_common_path(self.form_id,
+                                           self.record_id,
+                                           self.media_type,
+                                           size,
+                                           self.content_type)
 
     def get_url(self, storage, size):
         """
         Returns size-specific url to media file
         """
-        return storage.get_url(self.form_id,
-                               self.record_id,
-                               self.media_type,
-                               size,
-                               self.content_type)
+        return storage.get_url_for(self.get_common_path(storage, size))
+
+    def get_manifest(self, storage, resolve=False):
+        """
+        Returns storage paths manifest for all sizes of this media
+        """
+        return storage.get_manifest(self.form_id,
+                                    self.record_id,
+                                    self.media_type,
+                                    self.sizes,
+                                    self.content_type,
+                                    resolve=resolve)
 
     def get_paths(self, storage):
         """
         Return mapping of size->{path, url} for this media.
+        Stored manifest is used if it matches storage configuration.
         """
-        out = {}
-        for s in self.sizes:
-            out[s] = {'path': self.get_path(storage, s),
-                      'url': self.get_url(storage, s)}
-        return out
+        manifest = self.manifest
+        if not storage.is_current_manifest(manifest):
+            manifest = self.get_manifest(storage, resolve=True)
+        return storage.get_manifest_paths(manifest)
+
+    @classmethod
+    def refresh_manifests(cls, session, storage, batch_size=1000):
+        """
+        Updates stored manifests which don't match storage layout
+        (for example, after storage layout migration).
+        Returns number of updated media.
+        """
+        count = 0
+        q = session.query(cls).order_by(cls.id).yield_per(batch_size)
+        for idx, media in enumerate(q):
+            if (media.manifest or {}).get('layout') != storage.layout_key:
+                media.manifest = media.get_manifest(storage)
+                count += 1
+            if idx % batch_size == batch_size - 1:
+                session.flush()
+        session.flush()
+        return count
 
     def save_to_storage(self, storage, fhandle, size):
         """
@@ -660,17 +1406,27 @@ class Media(BaseResource):
         """
         return storage.save(fhandle, self.form_id, self.record_id, self.media_type, size, self.content_type)
 
+    def fetch_to_storage(self, storage, opener, size):
+        """
+        Shorthand to store file in storage, if it's not stored yet.
+        Media files don't change, so each size is fetched only once.
+        @param storage Storage instance
+        @param opener callable returning file-like object
+        @param size name of size to save to
+        """
+        return storage.fetch(opener, self.form_id, self.record_id, self.media_type, size, self.content_type)
+
     @classmethod
     def _post_payload(cls, instance, payload, session, client, storage):
         # handle storage
         media_type = payload['media_type']
         sizes = cls.SIZES[media_type]
+        instance.manifest = instance.get_manifest(storage)
         for s in sizes:
             media_url = payload.get(s)
             if media_url is None:
                 continue
-            u = urlopen(media_url)
-            instance.save_to_storage(storage, u, s)
+            instance.fetch_to_storage(storage, lambda url=media_url: urlopen(url), s)
 
         return payload
 
@@ -690,8 +1446,12 @@ class Media(BaseResource):
             out.append(and_(cls.id==url_params['audio_id'], cls.media_type == 'audio'))
         if url_params.get('signature_id'):
             out.append(and_(cls.id==url_params['signature_id'], cls.media_type == 'signature'))
+
+        session = kwargs.get('session')
+        dialect = session.get_bind().dialect if session is not None else None
+        out.extend(get_spatial_filters(cls.point, url_params, dialect))
         return out
 
 
 __all__ = ['Media', 'Value', 'Record', 'Field',
-           'Project', 'Form', 'Base', 'Session']
+           'Project', 'Form', 'Change', 'Base', 'Session']
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Optional partitioning of records and values tables by form (PostgreSQL 12+).
+
+Tables are partitioned by `4b7e1d2c9f60` migration, when it's run with
+`-x partitioning=list` or `-x partitioning=hash` alembic argument:
+
+* with list partitioning each form has own record and value partitions,
+  which are created when form is fetched and dropped when form is purged.
+* with hash partitioning tables are split into fixed number of partitions
+  (`-x partitions=N`, default 16), which are created by the migration.
+"""
+
+import logging
+import re
+
+from sqlalchemy import text
+
+log = logging.getLogger(__name__)
+
+PARTITIONED_TABLES = ('fulcrum_record', 'fulcrum_value',)
+PARTITION_KEY = 'form_id'
+
+LIST = 'list'
+HASH = 'hash'
+# pg_partitioned_table.partstrat -> strategy
+STRATEGIES = {'l': LIST, 'h': HASH}
+DEFAULT_MODULUS = 16
+
+# session.info key with cached partitioning strategy
+SESSION_KEY = 'partitioning'
+
+
+def get_strategy(session):
+    """
+    Returns partitioning strategy of records table (LIST, HASH) or None
+    if tables are not partitioned. Catalog is queried once per session.
+    """
+    if SESSION_KEY not in session.info:
+        strategy = None
+        if session.get_bind().dialect.name == 'postgresql':
+            partstrat = session.execute(text("SELECT partstrat FROM pg_partitioned_table "
+                                             "WHERE partrelid = to_regclass(:table_name)"),
+                                        {'table_name': PARTITIONED_TABLES[0]}).scalar()
+            strategy = STRATEGIES.get(partstrat)
+        session.info[SESSION_KEY] = strategy
+    return session.info[SESSION_KEY]
+
+
+def get_partition_name(table_name, form_id):
+    return '{}_{}'.format(table_name, re.sub('[^a-z0-9_]', '_', form_id.lower()))
+
+
+def _quote(value):
+    # DDL statements don't accept bind params
+    return "'{}'".format(value.replace("'", "''"))
+
+
+def get_create_ddl(form_id):
+    """
+    Returns list of statements creating list partitions for form
+    """
+    return ['CREATE TABLE IF NOT EXISTS {} PARTITION OF {} FOR VALUES IN ({})'
+            .format(get_partition_name(table_name, form_id), table_name, _quote(form_id))
+            for table_name in PARTITIONED_TABLES]
+
+
+def get_drop_ddl(table_name, form_id):
+    """
+    Returns list of statements dropping list partition of form. Partition
+    is detached first, because partitions referenced by foreign keys
+    cannot be dropped directly.
+    """
+    partition_name = get_partition_name(table_name, form_id)
+    return ['ALTER TABLE {} DETACH PARTITION {}'.format(table_name, partition_name),
+            'DROP TABLE {}'.format(partition_name)]
+
+
+def create_partitions(session, form_id):
+    """
+    Creates form's partitions if tables are list-partitioned.
+    Returns True if partitioning is used.
+    """
+    if get_strategy(session) != LIST:
+        return False
+    for sql in get_create_ddl(form_id):
+        session.execute(text(sql))
+    return True
+
+
+def drop_partitions(session, form_id):
+    """
+    Drops form's partitions with all their rows if tables are list-partitioned.
+    Returns True if partitions were dropped.
+    """
+    if get_strategy(session) != LIST:
+        return False
+    log.info('dropping partitions of form %s', form_id)
+    # values partition is dropped first, because it references records
+    for table_name in reversed(PARTITIONED_TABLES):
+        partition_name = get_partition_name(table_name, form_id)
+        exists = session.execute(text("SELECT to_regclass(:name)"),
+                                 {'name': partition_name}).scalar()
+        if exists is None:
+            continue
+        for sql in get_drop_ddl(table_name, form_id):
+            session.execute(text(sql))
+    return True
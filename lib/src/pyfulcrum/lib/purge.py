@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Hard removal of rows marked as removed. Rows are purged when they were
+not updated (so also not removed) since given time.
+"""
+
+import json
+import logging
+from collections import OrderedDict
+
+from sqlalchemy import select, exists, and_, func, cast, literal_column, String
+
+from . import compression, partitions
+from .models import Project, Form, Field, Record, Value, Media
+
+log = logging.getLogger(__name__)
+
+# number of rows deleted in one transaction
+BATCH_SIZE = 1000
+
+# children are purged before parents
+MODELS = (Value, Media, Record, Field, Form, Project,)
+
+# label of row size column in selected rows
+SIZE_COLUMN = '_purged_size'
+
+
+class Purge(object):
+    """
+    Deletes removed rows in batches, each committed separately.
+    Rows can be archived to a file as json lines, and media files
+    can be removed from storage.
+    """
+
+    def __init__(self, session, before, storage=None, archive=None, batch_size=BATCH_SIZE):
+        """
+        @param session SQLAlchemy session
+        @param before datetime, rows updated after it are kept
+        @param storage Storage instance. If set, files of purged media are removed
+        @param archive optional text file, to which purged rows are written
+        @param batch_size number of rows deleted in one transaction
+        """
+        self.session = session
+        self.before = before
+        self.storage = storage
+        self.archive = archive
+        self.batch_size = batch_size
+        self.stats = OrderedDict((model.__tablename__, {'count': 0, 'bytes': 0},)
+                                 for model in MODELS)
+        self.stats['files'] = {'count': 0, 'bytes': 0}
+
+    def get_row_size(self, table):
+        """
+        Returns expression with size of row in bytes. Size is exact in
+        PostgreSQL, elsewhere size of payload is used.
+        """
+        if self.session.get_bind().dialect.name == 'postgresql':
+            return func.pg_column_size(literal_column(table.name))
+        return func.coalesce(func.length(cast(table.c.payload, String)), 0)
+
+    def get_condition(self, model):
+        """
+        Returns condition for rows, which can be purged: removed before
+        cutoff time, with no children left
+        """
+        out = [model.removed == True, model.updated_at < self.before]
+        for child_cls, fk in model.get_children():
+            out.append(~exists().where(fk == model.id))
+        return and_(*out)
+
+    def iter_batches(self, model, condition):
+        """
+        Yields lists of rows matching condition, ordered by id
+        """
+        table = model.__table__
+        columns = list(table.c) + [self.get_row_size(table).label(SIZE_COLUMN)]
+        last_id = None
+        while True:
+            q = select(columns).where(condition)
+            if last_id is not None:
+                q = q.where(table.c.id > last_id)
+            rows = self.session.execute(q.order_by(table.c.id).limit(self.batch_size)).fetchall()
+            if not rows:
+                return
+            last_id = rows[-1]['id']
+            yield rows
+
+    def process(self, model, rows):
+        """
+        Updates stats with purged rows and writes them to archive.
+        Returns list of media files to remove.
+        """
+        table_name = model.__tablename__
+        stats = self.stats[table_name]
+        stats['count'] += len(rows)
+        stats['bytes'] += sum(row[SIZE_COLUMN] or 0 for row in rows)
+        if self.archive is not None:
+            for row in rows:
+                data = dict((k, v,) for k, v in row.items() if k != SIZE_COLUMN)
+                packed = data.pop('payload_packed', None)
+                if packed is not None:
+                    data['payload'] = compression.unpack(packed)
+                self.archive.write(json.dumps({'table': table_name, 'row': data}, default=str))
+                self.archive.write('\n')
+        files = []
+        if self.storage is not None and model is Media:
+            for row in rows:
+                media = Media(id=row['id'],
+                              form_id=row['form_id'],
+                              record_id=row['record_id'],
+                              media_type=row['media_type'],
+                              content_type=row['content_type'],
+                              manifest=row['manifest'])
+                paths = [p['path'] for p in media.get_paths(self.storage).values()]
+                files.append((row['form_id'], paths,))
+        return files
+
+    def remove_files(self, files):
+        stats = self.stats['files']
+        for form_id, paths in files:
+            count, size = self.storage.remove_files(paths, form_id)
+            stats['count'] += count
+            stats['bytes'] += size
+
+    def purge_rows(self, model, condition):
+        """
+        Deletes rows of model matching condition in batches
+        """
+        table = model.__table__
+        for rows in self.iter_batches(model, condition):
+            files = self.process(model, rows)
+            ids = [row['id'] for row in rows]
+            if model is Form:
+                # empty partitions of form
+                for form_id in ids:
+                    partitions.drop_partitions(self.session, form_id)
+            q = table.delete().where(table.c.id.in_(ids))
+            if 'form_id' in table.c:
+                # allows partition pruning
+                q = q.where(table.c.form_id.in_(set(row['form_id'] for row in rows)))
+            self.session.execute(q)
+            self.session.commit()
+            self.remove_files(files)
+            log.info('purged %s rows from %s', len(rows), table.name)
+
+    def get_dropped_forms(self):
+        """
+        Returns ids of forms, which rows are all purgeable
+        """
+        out = [Form.removed == True, Form.updated_at < self.before]
+        for child_cls, fk in Form.get_children():
+            out.append(~exists().where(and_(fk == Form.id,
+                                            (child_cls.removed == False) |
+                                            (child_cls.updated_at >= self.before))))
+        return [r[0] for r in self.session.query(Form.id).filter(*out).order_by(Form.id)]
+
+    def drop_form(self, form_id):
+        """
+        Purges form, which records and values are stored in list partitions,
+        by dropping them.
+        """
+        self.purge_rows(Media, Media.form_id == form_id)
+        for model in (Value, Record,):
+            for rows in self.iter_batches(model, model.form_id == form_id):
+                self.process(model, rows)
+        partitions.drop_partitions(self.session, form_id)
+        self.session.commit()
+        self.purge_rows(Field, Field.form_id == form_id)
+        self.purge_rows(Form, Form.id == form_id)
+
+    def run(self):
+        """
+        Purges all tables. Returns dictionary of table name (or 'files')
+        -> {'count': number of purged rows, 'bytes': size of purged rows}
+        """
+        if partitions.get_strategy(self.session) == partitions.LIST:
+            for form_id in self.get_dropped_forms():
+                self.drop_form(form_id)
+        for model in MODELS:
+            self.purge_rows(model, self.get_condition(model))
+        return self.stats
+
+
+def purge(session, before, storage=None, archive=None, batch_size=BATCH_SIZE):
+    """
+    Deletes rows marked as removed, which were not updated since `before`.
+    Parent rows (records, forms..) are deleted only if they have no children.
+    With list partitioning, forms with all rows purgeable are deleted
+    with their partitions. See Purge for params.
+    """
+    return Purge(session, before, storage=storage, archive=archive,
+                 batch_size=batch_size).run()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+SQLite/SpatiaLite backend support.
+
+SpatiaLite extension is loaded for each connection of SQLite engines
+set up with setup_engine(). Extension library can be set with
+SPATIALITE_LIBRARY_PATH env variable (default: mod_spatialite).
+"""
+
+import os
+import re
+import logging
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import event, BigInteger, DateTime, select, and_
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql import table, column
+from sqlalchemy.sql.functions import GenericFunction
+from sqlalchemy.types import TypeDecorator
+
+log = logging.getLogger(__name__)
+
+SPATIALITE_LIBRARY_ENV = 'SPATIALITE_LIBRARY_PATH'
+SPATIALITE_LIBRARY = 'mod_spatialite'
+
+# SpatiaLite virtual table for spatial index queries
+SPATIAL_INDEX = table('SpatialIndex',
+                      column('rowid'),
+                      column('f_table_name'),
+                      column('f_geometry_column'),
+                      column('search_frame'))
+
+
+def is_sqlite(bind):
+    """
+    Returns True if engine, connection or dialect is SQLite
+    """
+    dialect = getattr(bind, 'dialect', bind)
+    return getattr(dialect, 'name', None) == 'sqlite'
+
+
+def load_spatialite(dbapi_conn, connection_record):
+    """
+    Connection event listener, which loads SpatiaLite and initializes
+    spatial metadata tables in new database.
+    """
+    dbapi_conn.enable_load_extension(True)
+    dbapi_conn.load_extension(os.getenv(SPATIALITE_LIBRARY_ENV) or SPATIALITE_LIBRARY)
+    dbapi_conn.enable_load_extension(False)
+    cursor = dbapi_conn.cursor()
+    try:
+        # readers don't block writer, so web app can serve data during ingest
+        cursor.execute('PRAGMA journal_mode=WAL')
+        if not cursor.execute('SELECT CheckSpatialMetaData()').fetchone()[0]:
+            log.info('initializing spatial metadata')
+            cursor.execute('SELECT InitSpatialMetaData(1)')
+    finally:
+        cursor.close()
+
+
+def setup_engine(engine):
+    """
+    Sets up SpatiaLite for SQLite engine. Other engines are not changed.
+    """
+    if not is_sqlite(engine):
+        return
+    if not event.contains(engine, 'connect', load_spatialite):
+        event.listen(engine, 'connect', load_spatialite)
+
+
+# ISO 8601 date or datetime, with optional fraction and offset
+ISO_DATETIME = re.compile(r'(\d{4})-(\d{2})-(\d{2})'
+                          r'(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:\.(\d+))?)?)?'
+                          r'(Z|[+-]\d{2}(?::?\d{2})?)?$')
+
+
+def parse_datetime(value):
+    """
+    Returns datetime from ISO 8601 string, like 2015-04-16T13:20:10Z.
+    Datetime is naive if string has no offset.
+    """
+    match = ISO_DATETIME.match(value.strip())
+    if match is None:
+        raise ValueError("Invalid datetime: {}".format(value))
+    year, month, day, hour, minute, second, fraction, offset = match.groups()
+    tzinfo = None
+    if offset == 'Z':
+        tzinfo = timezone.utc
+    elif offset:
+        digits = offset[1:].replace(':', '')
+        delta = timedelta(hours=int(digits[:2]), minutes=int(digits[2:] or 0))
+        tzinfo = timezone(-delta if offset[0] == '-' else delta)
+    return datetime(int(year), int(month), int(day),
+                    int(hour or 0), int(minute or 0), int(second or 0),
+                    int((fraction or '0')[:6].ljust(6, '0')),
+                    tzinfo=tzinfo)
+
+
+class DateTimeType(TypeDecorator):
+    """
+    Timezone-aware datetime. SQLite stores naive datetimes and accepts only
+    datetime objects, so values are converted to naive UTC, and strings from
+    payloads and url params are parsed. Other databases get values as they are.
+    """
+    impl = DateTime(timezone=True)
+
+    def process_bind_param(self, value, dialect):
+        if value is None or not is_sqlite(dialect):
+            return value
+        if isinstance(value, str):
+            value = parse_datetime(value)
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value
+
+    def process_result_value(self, value, dialect):
+        if value is not None and is_sqlite(dialect) and value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value
+
+
+class txid_current(GenericFunction):
+    """
+    Id of current transaction, stored in change log. SQLite writers
+    are serialized, so changes are committed in order of ids, and
+    transaction id is not needed.
+    """
+    type = BigInteger()
+
+
+@compiles(txid_current, 'sqlite')
+def _compile_txid_current(element, compiler, **kw):
+    return '0'
+
+
+def get_spatial_index_filter(geom_column, frame):
+    """
+    Returns condition for rows, which bounding boxes intersect frame
+    geometry, using SpatiaLite spatial index of column.
+
+    @param geom_column geometry column with spatial index
+    @param frame geometry expression, like BuildMbr()
+    """
+    geom_column = getattr(geom_column, 'expression', geom_column)
+    # column can be selected from aliased table
+    selectable = geom_column.table
+    table_name = getattr(selectable, 'original', selectable).name
+    ids = (select([SPATIAL_INDEX.c.rowid])
+           .where(and_(SPATIAL_INDEX.c.f_table_name == table_name,
+                       SPATIAL_INDEX.c.f_geometry_column == geom_column.name,
+                       SPATIAL_INDEX.c.search_frame == frame)))
+    return column('rowid', _selectable=selectable).in_(ids)
@@ -2,15 +2,48 @@
 # -*- coding: utf-8 -*-
 
 import os
+import uuid
+import fcntl
+import shutil
+import hashlib
 import mimetypes
+from contextlib import contextmanager
 
 mimetypes.init()
 
+# mime type -> extension cache, mimetypes lookup is surprisingly slow
+_EXTENSIONS = {}
+
+# files are stored in ${form_id}/${record_id}/ directories
+LAYOUT_FLAT = 'flat'
+# files are stored in ${form_id}/${shard1}/../${shardN}/${record_id}/
+# directories, where shards are hex prefixes of record_id hash
+LAYOUT_HASHED = 'hashed'
+LAYOUTS = (LAYOUT_FLAT, LAYOUT_HASHED,)
+
 
 class Storage(object):
-    def __init__(self, root_dir, url_base=None):
+    def __init__(self, root_dir, url_base=None, layout=LAYOUT_FLAT,
+                 previous_layout=None, shard_depth=2, shard_width=2):
+        """
+        @param root_dir path to storage root directory
+        @param url_base optional web root for storage
+        @param layout name of directory layout used to store files
+        @param previous_layout name of layout that is being migrated from.
+               If set, paths will be resolved against both layouts, until
+               files are moved with .migrate_layout()
+        @param shard_depth number of shard directories for hashed layout
+        @param shard_width number of hex chars in each shard directory name
+        """
+        for l in (layout, previous_layout,):
+            if l is not None and l not in LAYOUTS:
+                raise ValueError("Invalid storage layout: {}".format(l))
         self.root_dir = os.path.abspath(root_dir)
         self.url_base = url_base
+        self.layout = layout
+        self.previous_layout = previous_layout if previous_layout != layout else None
+        self.shard_depth = int(shard_depth)
+        self.shard_width = int(shard_width)
         self.initialize_storage(self.root_dir)
 
     def initialize_storage(self, dir_name):
@@ -21,23 +54,286 @@ class Storage(object):
 
     def get_url(self, form_id, record_id, media_type, size, mime_type):
         if self.url_base:
-            common = self.get_common_path(form_id, record_id, media_type, size, mime_type)
-            return os.path.join(self.url_base, common)
+            common = self.resolve_common_path(form_id, record_id, media_type, size, mime_type)
+            return self.get_url_for(common)
 
     def get_path(self, form_id, record_id, media_type, size, mime_type):
-        common = self.get_common_path(form_id, record_id, media_type, size, mime_type)
+        common = self.resolve_common_path(form_id, record_id, media_type, size, mime_type)
+        return self.get_path_for(common)
+
+    def get_url_for(self, common):
+        """
+        Returns url for common path, or None if storage has no web root
+        """
+        if self.url_base:
+            return os.path.join(self.url_base, common)
+
+    def get_path_for(self, common):
+        """
+        Returns local path for common path
+        """
         return os.path.join(self.root_dir, common)
 
-    def get_common_path(self, form_id, record_id, media_type, size, mime_type):
+    def resolve_common_path(self, form_id, record_id, media_type, size, mime_type):
+        """
+        Returns common path for file in current layout. If storage is
+        in transition from previous layout, and file is not moved yet,
+        path in previous layout is returned.
+        """
+        common = self.get_common_path(form_id, record_id, media_type, size, mime_type)
+        if self.previous_layout is None:
+            return common
+        if os.path.exists(os.path.join(self.root_dir, common)):
+            return common
+        previous = self.get_common_path(form_id, record_id, media_type, size, mime_type,
+                                        layout=self.previous_layout)
+        if os.path.exists(os.path.join(self.root_dir, previous)):
+            return previous
+        return common
+
+    def get_common_path(self, form_id, record_id, media_type, size, mime_type, layout=None):
         ext = self.get_extension(mime_type)
-        return os.path.join(form_id, record_id, '{}_{}{}'.format(media_type, size, ext))
+        return os.path.join(self.get_record_dir(form_id, record_id, layout=layout),
+                            '{}_{}{}'.format(media_type, size, ext))
+
+    def get_record_dir(self, form_id, record_id, layout=None):
+        """
+        Returns directory for record's files, relative to storage root
+        """
+        layout = layout or self.layout
+        if layout == LAYOUT_HASHED:
+            return os.path.join(form_id, *self.get_shards(record_id), record_id)
+        return os.path.join(form_id, record_id)
+
+    def get_shards(self, record_id):
+        """
+        Returns list of shard directory names for given record id
+        """
+        digest = hashlib.md5(record_id.encode('utf-8')).hexdigest()
+        w = self.shard_width
+        return [digest[idx * w:(idx + 1) * w] for idx in range(self.shard_depth)]
 
     def get_extension(self, mime_type):
-        return mimetypes.guess_extension(mime_type) or '.bin'
+        try:
+            return _EXTENSIONS[mime_type]
+        except KeyError:
+            ext = _EXTENSIONS[mime_type] = mimetypes.guess_extension(mime_type) or '.bin'
+            return ext
+
+    @property
+    def layout_key(self):
+        """
+        Identifies layout configuration, so stored manifests can be validated
+        """
+        if self.layout == LAYOUT_HASHED:
+            return '{}:{}:{}'.format(self.layout, self.shard_depth, self.shard_width)
+        return self.layout
+
+    def get_manifest(self, form_id, record_id, media_type, sizes, mime_type, resolve=False):
+        """
+        Returns manifest with common path for each size of media file.
+        Manifest is meant to be stored with media metadata, so paths
+        don't have to be calculated on each serialization.
+
+        @param resolve if True, paths will be resolved against previous layout
+        """
+        get_common = self.resolve_common_path if resolve else self.get_common_path
+        return {'layout': self.layout_key,
+                'paths': dict((size, get_common(form_id, record_id, media_type, size, mime_type))
+                              for size in sizes)}
+
+    def is_current_manifest(self, manifest):
+        """
+        Returns True if manifest can be used with this storage as-is
+        """
+        return (bool(manifest) and self.previous_layout is None
+                and manifest.get('layout') == self.layout_key)
+
+    def get_manifest_paths(self, manifest):
+        """
+        Returns mapping of size -> {path, url} from manifest
+        """
+        root = os.path.join(self.root_dir, '')
+        url_base = self.url_base and os.path.join(self.url_base, '')
+        out = {}
+        for size, common in manifest['paths'].items():
+            out[size] = {'path': root + common,
+                         'url': url_base + common if url_base else None}
+        return out
 
     def save(self, fh, form_id, record_id, media_type, size, mime_type):
-        path = self.get_path(form_id, record_id, media_type, size, mime_type)
-        self.initialize_storage(os.path.dirname(path))
-        with open(path, 'wb') as f:
-            f.write(fh.read())
+        """
+        Writes file to storage. File is written to temporary file
+        first, and then renamed, so readers will never see partial content.
+        """
+        path = os.path.join(self.root_dir,
+                            self.get_common_path(form_id, record_id, media_type, size, mime_type))
+        dir_name, fname = os.path.split(path)
+        self.initialize_storage(dir_name)
+        tmp_path = os.path.join(dir_name, '.{}.{}.tmp'.format(fname, uuid.uuid4().hex))
+        try:
+            with open(tmp_path, 'xb') as f:
+                shutil.copyfileobj(fh, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
         return path
+
+    def fetch(self, opener, form_id, record_id, media_type, size, mime_type, overwrite=False):
+        """
+        Stores file from opener() if it's not stored yet. Concurrent
+        calls for the same file (also from other processes) are
+        serialized, so file is fetched only once.
+
+        @param opener callable returning file-like object. It's called
+               only if file has to be written
+        @param overwrite if True, existing file will be replaced
+        """
+        path = os.path.join(self.root_dir,
+                            self.get_common_path(form_id, record_id, media_type, size, mime_type))
+        with self.lock(path):
+            if not overwrite:
+                existing = self.get_path(form_id, record_id, media_type, size, mime_type)
+                if os.path.exists(existing):
+                    return existing
+            fh = opener()
+            try:
+                return self.save(fh, form_id, record_id, media_type, size, mime_type)
+            finally:
+                if hasattr(fh, 'close'):
+                    fh.close()
+
+    @contextmanager
+    def lock(self, path):
+        """
+        Exclusive lock on storage path, shared between threads and processes.
+        Lock file is a hidden file next to locked path, and it's removed
+        on release.
+        """
+        dir_name, fname = os.path.split(path)
+        lock_path = os.path.join(dir_name, '.{}.lock'.format(fname))
+        self.initialize_storage(dir_name)
+        while True:
+            f = open(lock_path, 'a')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                # previous holder could remove lock file while we were waiting
+                if os.fstat(f.fileno()).st_ino == os.stat(lock_path).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            except BaseException:
+                f.close()
+                raise
+            f.close()
+        try:
+            yield lock_path
+        finally:
+            os.remove(lock_path)
+            f.close()
+
+    def _list_dir(self, path, dirs=True):
+        """
+        Returns sorted names of subdirectories (or files) in path.
+        Hidden entries are skipped.
+        """
+        try:
+            entries = list(os.scandir(path))
+        except (FileNotFoundError, NotADirectoryError):
+            return []
+        out = []
+        for e in entries:
+            if e.name.startswith('.'):
+                continue
+            if (dirs and e.is_dir()) or (not dirs and e.is_file()):
+                out.append(e.name)
+        return sorted(out)
+
+    def iter_layout_files(self, layout):
+        """
+        Yields (form_id, record_id, file name) for each file stored
+        with given layout.
+        """
+        for form_id in self._list_dir(self.root_dir):
+            form_dir = os.path.join(self.root_dir, form_id)
+            if layout == LAYOUT_HASHED:
+                record_dirs = [[]]
+                for level in range(self.shard_depth):
+                    record_dirs = [parts + [name] for parts in record_dirs
+                                   for name in self._list_dir(os.path.join(form_dir, *parts))
+                                   if len(name) == self.shard_width]
+                record_dirs = [parts + [name] for parts in record_dirs
+                               for name in self._list_dir(os.path.join(form_dir, *parts))
+                               if self.get_shards(name) == parts]
+            else:
+                record_dirs = [[name] for name in self._list_dir(form_dir)]
+            for parts in record_dirs:
+                record_id = parts[-1]
+                for fname in self._list_dir(os.path.join(form_dir, *parts), dirs=False):
+                    yield form_id, record_id, fname
+
+    def migrate_layout(self, batch_size=1000):
+        """
+        Moves files stored with previous layout to current one.
+        This is a generator, which yields list of (source, destination)
+        paths for each batch of moved files, so caller can report progress
+        or throttle migration. Storage can be used while files are moved,
+        because paths are resolved against both layouts.
+        """
+        if self.previous_layout is None:
+            return
+        batch = []
+        for form_id, record_id, fname in self.iter_layout_files(self.previous_layout):
+            src_dir = os.path.join(self.root_dir,
+                                   self.get_record_dir(form_id, record_id,
+                                                       layout=self.previous_layout))
+            dst_dir = os.path.join(self.root_dir, self.get_record_dir(form_id, record_id))
+            src, dst = os.path.join(src_dir, fname), os.path.join(dst_dir, fname)
+            self.initialize_storage(dst_dir)
+            # file in current layout takes precedence, so old copy is stale
+            if os.path.exists(dst):
+                os.remove(src)
+            else:
+                os.replace(src, dst)
+            self._remove_empty_dirs(src_dir, form_id)
+            batch.append((src, dst,))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def remove_files(self, paths, form_id):
+        """
+        Removes files of form from storage, with directories left empty.
+        Missing files are skipped.
+
+        @returns tuple of number and total size of removed files
+        """
+        count = size = 0
+        for path in paths:
+            try:
+                file_size = os.path.getsize(path)
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            count += 1
+            size += file_size
+            self._remove_empty_dirs(os.path.dirname(path), form_id)
+        return count, size
+
+    def _remove_empty_dirs(self, path, form_id):
+        """
+        Removes empty directories from path up to form directory
+        """
+        stop = os.path.join(self.root_dir, form_id)
+        while path != stop and path.startswith(stop):
+            try:
+                os.rmdir(path)
+            except OSError:
+                return
+            path = os.path.dirname(path)
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import csv
+import zipfile
+from io import BytesIO, StringIO
+
+from . import BaseTestCase, STATIC_FILE
+from ..archive import iter_zip, iter_media_bundle, MANIFEST_NAME
+
+
+class ArchiveTestCase(BaseTestCase):
+
+    def test_iter_zip(self):
+        chunks = iter_zip([('first.txt', [b'first ', b'file']),
+                           ('static.file', STATIC_FILE)])
+        zf = zipfile.ZipFile(BytesIO(b''.join(chunks)), mode='r')
+        self.assertEqual(zf.namelist(), ['first.txt', 'static.file'])
+        self.assertEqual(zf.read('first.txt'), b'first file')
+        with open(STATIC_FILE, 'rb') as f:
+            self.assertEqual(zf.read('static.file'), f.read())
+        self.assertIsNone(zf.testzip())
+
+    def test_media_bundle(self):
+        self.api_manager.forms.list(cached=False)
+        self.api_manager.records.list(cached=False)
+        self.api_manager.photos.list(cached=False)
+
+        photos = self.api_manager.photos.list(url_params={'form_id': '7a0c3378-b63a-4707-b459-df499698f23c'})
+        chunks = iter_media_bundle(photos, self._storage, sizes=['original', 'large'])
+        zf = zipfile.ZipFile(BytesIO(b''.join(chunks)), mode='r')
+        names = zf.namelist()
+        self.assertEqual(names[0], MANIFEST_NAME)
+        # two sizes of one photo
+        self.assertEqual(len(names), 3, names)
+
+        manifest = list(csv.reader(StringIO(zf.read(MANIFEST_NAME).decode('utf-8'))))
+        self.assertEqual(manifest[0][0], 'id')
+        self.assertEqual(len(manifest), 3, manifest)
+        self.assertEqual(set(row[4] for row in manifest[1:]), set(['original', 'large']))
+        self.assertEqual(set(row[-1] for row in manifest[1:]), set(names[1:]))
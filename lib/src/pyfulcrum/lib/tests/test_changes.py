@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from datetime import datetime, timedelta, timezone
+
+from . import BaseTestCase
+from ..models import Change, Media, Session
+
+RECORD_ID = '4e1c33ad-5496-4818-826f-504e66239b4d'
+
+
+class ChangesTestCase(BaseTestCase):
+
+    def test_changes(self):
+        self.api_manager.forms.list(cached=False)
+        self.api_manager.records.list(cached=False)
+        self.api_manager.photos.list(cached=False)
+        # changes are listed when they're committed
+        self.api_manager.session.commit()
+
+        changes = self.api_manager.get_changes().all()
+        self.assertTrue(changes)
+        self.assertEqual(set(c.op for c in changes), set([Change.OP_UPDATE]))
+        # values are not logged
+        self.assertEqual(set(c.resource for c in changes),
+                         set(['forms', 'fields', 'records', 'photos']))
+        record_change = [c for c in changes if c.resource_id == RECORD_ID][0]
+        self.assertEqual(record_change.version,
+                         self.api_manager.records.get(RECORD_ID).payload['version'])
+        self.assertEqual(record_change.as_dict()['resource'], 'records')
+
+        cursor = changes[-1].id
+        self.assertEqual(self.api_manager.get_changes(since=cursor).count(), 0)
+
+        # unchanged resources are not logged
+        self.api_manager.forms.list(cached=False)
+        self.api_manager.records.list(cached=False)
+        self.api_manager.photos.list(cached=False)
+        self.api_manager.session.commit()
+        self.assertEqual(self.api_manager.get_changes(since=cursor).count(), 0)
+
+        # children are logged with parent
+        self.api_manager.records.remove(RECORD_ID)
+        self.api_manager.session.commit()
+        removed = self.api_manager.get_changes(since=cursor).all()
+        photos = (self.api_manager.session.query(Media.id)
+                                          .filter(Media.record_id == RECORD_ID,
+                                                  Media.media_type == Media.MEDIA_PHOTO))
+        self.assertEqual(set((c.resource, c.resource_id, c.op,) for c in removed),
+                         set([('records', RECORD_ID, Change.OP_REMOVE,)] +
+                             [('photos', p.id, Change.OP_REMOVE,) for p in photos]))
+
+        self.assertEqual([c.id for c in self.api_manager.iter_changes(resource='records',
+                                                                      batch_size=1)],
+                         [c.id for c in changes + removed if c.resource == 'records'])
+        with self.assertRaises(ValueError):
+            self.api_manager.get_changes(resource='values')
+
+    def test_change_as_dict(self):
+        change = Change(id=1, resource='records', resource_id=RECORD_ID, op=Change.OP_UPDATE,
+                        created_at=datetime(2018, 11, 20, 12, 11, 12,
+                                            tzinfo=timezone(timedelta(hours=2))))
+        self.assertEqual(change.as_dict()['created_at'], '2018-11-20T10:11:12Z')
+
+    def test_changes_concurrent(self):
+        if self._conn.dialect.name != 'postgresql':
+            self.skipTest("Concurrent transactions are tested in PostgreSQL")
+        sync, webhook, reader = [Session(bind=self._conn) for _ in range(3)]
+        try:
+            # long running transaction logs change first
+            sync.add(Change(resource='records', resource_id='a', op=Change.OP_UPDATE))
+            sync.flush()
+            webhook.add(Change(resource='records', resource_id='b', op=Change.OP_UPDATE))
+            webhook.commit()
+
+            # change of newer transaction is not listed before older one is finished
+            self.assertEqual(Change.list(reader).all(), [])
+            reader.rollback()
+
+            # changes of older transaction are listed first
+            sync.add(Change(resource='records', resource_id='c', op=Change.OP_UPDATE))
+            sync.commit()
+            changes = Change.list(reader).all()
+            self.assertEqual([c.resource_id for c in changes], ['a', 'c', 'b'])
+            for idx, change in enumerate(changes):
+                self.assertEqual(Change.list(reader, since=change.id).all(), changes[idx + 1:])
+        finally:
+            for session in (sync, webhook, reader):
+                session.rollback()
+                session.close()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from io import BytesIO
+from unittest import skipIf
+
+from shapely import wkb
+
+from . import BaseTestCase
+from .. import columnar
+from ..formats import FORMATS, STREAM_FORMATS
+from ..models import Field
+
+RECORD_ID = '4e1c33ad-5496-4818-826f-504e66239b4d'
+
+
+@skipIf(not columnar.is_available(), "pyarrow is not installed")
+class ColumnarTestCase(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.api_manager.forms.list(cached=False)
+        self.api_manager.records.list(cached=False)
+        self.api_manager.photos.list(cached=False)
+
+    def test_format_parquet(self):
+        import pyarrow
+        import pyarrow.parquet
+
+        q = self.api_manager.records.list()
+        record = self.api_manager.records.get(RECORD_ID)
+        out = FORMATS['parquet'](q, self._storage, multiple=True)
+        table = pyarrow.parquet.read_table(BytesIO(out))
+        self.assertEqual(table.num_rows, q.count())
+        self.assertEqual(table.schema.field('_created_at').type, pyarrow.timestamp('us', tz='UTC'))
+        # typed column from numeric field
+        self.assertEqual(table.schema.field('diameter').type, pyarrow.float64())
+        row = table.to_pylist()[0]
+        self.assertEqual(row['_id'], RECORD_ID)
+        self.assertEqual(row['_form_id'], record.form_id)
+        self.assertEqual(row['hydrant_type'], 'Pillar')
+        self.assertEqual(row['diameter'], 4.0)
+        point = wkb.loads(row['_point'])
+        self.assertEqual((point.x, point.y,),
+                         (record.payload['longitude'], record.payload['latitude'],))
+        self.assertIn(b'geo', table.schema.metadata)
+
+        # one row group per batch
+        out = b''.join(columnar.iter_export(q, columnar.PARQUET, batch_size=1))
+        self.assertEqual(pyarrow.parquet.ParquetFile(BytesIO(out)).num_row_groups, q.count())
+
+    def test_removed_fields(self):
+        import pyarrow.parquet
+
+        record = self.api_manager.records.get(RECORD_ID)
+        # field removed from form, which used the same data name
+        session = self.api_manager.session
+        session.add(Field(id='0000', form_id=record.form_id, label='Diameter',
+                          data_name='diameter', type='TextField',
+                          required=False, disabled=False, hidden=False, removed=True))
+        session.flush()
+        fields = columnar.get_fields(self.api_manager.records.list())
+        self.assertNotIn('0000', [f.id for f in fields])
+
+        out = FORMATS['parquet'](self.api_manager.records.list(), self._storage, multiple=True)
+        table = pyarrow.parquet.read_table(BytesIO(out))
+        self.assertEqual(table.column('diameter').to_pylist(), [4.0])
+
+    def test_format_arrow(self):
+        import pyarrow
+
+        q = self.api_manager.records.list()
+        out = b''.join(STREAM_FORMATS['arrow'](q, self._storage, multiple=True))
+        table = pyarrow.ipc.open_file(BytesIO(out)).read_all()
+        self.assertEqual(table.column('_id').to_pylist(), [r.id for r in q])
+
+        with self.assertRaises(TypeError):
+            FORMATS['parquet'](self.api_manager.forms.list(), self._storage, multiple=True)
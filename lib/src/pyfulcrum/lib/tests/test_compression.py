@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+
+from . import BaseTestCase
+from .. import compression
+from ..formats import FORMATS
+from ..models import Project, Form, Field, Record, Value, Media
+
+RECORD_ID = '4e1c33ad-5496-4818-826f-504e66239b4d'
+
+
+class CompressionTestCase(BaseTestCase):
+
+    def test_pack(self):
+        payload = {'id': 'x', 'values': [1, 2.5, None, u'zażółć'], 'nested': {'a': True}}
+        packed = compression.pack(payload)
+        self.assertIsInstance(packed, bytes)
+        self.assertEqual(compression.unpack(packed), payload)
+
+    def test_compressed_payloads(self):
+        session = self.api_manager.session
+        session.info[compression.SESSION_KEY] = True
+        self.api_manager.forms.list(cached=False)
+        self.api_manager.records.list(cached=False)
+        self.api_manager.photos.list(cached=False)
+        session.commit()
+        session.expire_all()
+
+        record = self.api_manager.records.get(RECORD_ID)
+        self.assertIsNone(record._payload)
+        self.assertIsNotNone(record.payload_packed)
+        # form values are stored in values column only
+        self.assertNotIn('form_values', compression.unpack(record.payload_packed))
+        self.assertEqual(record.payload['id'], RECORD_ID)
+        self.assertEqual(record.payload['form_values'], record.values)
+
+        value = session.query(Value).filter(Value.record_id == RECORD_ID).first()
+        self.assertEqual(compression.unpack(value.payload_packed), {})
+        self.assertEqual(value.payload, {'meta': value.meta})
+
+    def test_pack_payloads(self):
+        session = self.api_manager.session
+        self.api_manager.forms.list(cached=False)
+        self.api_manager.records.list(cached=False)
+        self.api_manager.photos.list(cached=False)
+        session.commit()
+        raw = FORMATS['raw'](self.api_manager.records.list(), self._storage, multiple=True)
+        csv = FORMATS['csv'](self.api_manager.records.list(), self._storage, multiple=True)
+
+        for model in (Project, Form, Field, Record, Value, Media,):
+            count = model.pack_payloads(session, batch_size=2)
+            self.assertEqual(count, session.query(model).count())
+            self.assertEqual(session.query(model).filter(model._payload != None).count(), 0)
+            self.assertEqual(model.pack_payloads(session), 0)
+
+        self.assertEqual(json.loads(FORMATS['raw'](self.api_manager.records.list(),
+                                                   self._storage, multiple=True)),
+                         json.loads(raw))
+        self.assertEqual(FORMATS['csv'](self.api_manager.records.list(), self._storage, multiple=True),
+                         csv)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from decimal import Decimal
+from sqlalchemy import inspect, select
+
+from . import BaseTestCase
+from .. import flat
+from ..models import Record
+
+FORM_ID = '7a0c3378-b63a-4707-b459-df499698f23c'
+RECORD_ID = '4e1c33ad-5496-4818-826f-504e66239b4d'
+PROJECT_ID = '60786571-46b4-43b8-8f49-7d8f0f45987e'
+
+
+class FlatTestCase(BaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.api_manager.session.info[flat.SESSION_KEY] = True
+
+    def get_rows(self, form):
+        table = flat.get_table(form.id, form.flat_schema)
+        return list(self.api_manager.session.execute(select([table])))
+
+    def has_table(self, form_id):
+        conn = self.api_manager.session.connection()
+        return flat.get_table_name(form_id) in inspect(conn).get_table_names()
+
+    def test_flat_table(self):
+        self.api_manager.forms.list(cached=False)
+        form = self.api_manager.forms.get(FORM_ID)
+        self.assertEqual([c[0] for c in form.flat_schema],
+                         ['diameter', 'hydrant_type', 'id_tag', 'photo', 'position'])
+        self.assertTrue(self.has_table(FORM_ID))
+        self.assertEqual(self.get_rows(form), [])
+
+        self.api_manager.records.list(cached=False)
+        rows = self.get_rows(form)
+        self.assertEqual(len(rows), 1)
+        row = rows[0]
+        self.assertEqual(row['_id'], RECORD_ID)
+        self.assertEqual(row['id_tag'], '183')
+        self.assertEqual(row['diameter'], Decimal('4'))
+        self.assertEqual(row['hydrant_type'], 'Pillar')
+        self.assertEqual(row['position'], 'Green Space')
+        self.assertEqual(row['photo'], '622997aa-929f-4758-bd86-859cc7435e3f')
+
+        # schema didn't change, table is not recreated
+        self.assertIsNone(form.sync_flat_table(self.api_manager.session))
+        self.assertEqual(form.sync_flat_table(self.api_manager.session, force=True), 1)
+
+        self.api_manager.records.remove(RECORD_ID)
+        self.assertEqual(self.get_rows(form), [])
+        self.api_manager.records.get(RECORD_ID, cached=False, if_removed=True)
+        self.assertEqual(len(self.get_rows(form)), 1)
+
+        self.api_manager.forms.remove(FORM_ID)
+        self.assertFalse(self.has_table(FORM_ID))
+        self.assertIsNone(form.flat_schema)
+
+    def test_flat_table_cascade(self):
+        session = self.api_manager.session
+        self.api_manager.projects.list(cached=False)
+        self.api_manager.forms.list(cached=False)
+        self.api_manager.records.list(cached=False)
+        session.query(Record).update({Record.project_id: PROJECT_ID})
+        form = self.api_manager.forms.get(FORM_ID)
+        self.assertEqual(len(self.get_rows(form)), 1)
+
+        # records of active form are removed with project
+        self.api_manager.projects.remove(PROJECT_ID)
+        self.assertFalse(form.removed)
+        self.assertEqual(self.get_rows(form), [])
+
+        # and restored with it
+        self.api_manager.projects.get(PROJECT_ID, cached=False, if_removed=True)
+        rows = self.get_rows(form)
+        self.assertEqual([row['_id'] for row in rows], [RECORD_ID])
+        self.assertEqual(rows[0]['id_tag'], '183')
+
+    def test_flat_table_disabled(self):
+        self.api_manager.session.info[flat.SESSION_KEY] = False
+        self.api_manager.forms.list(cached=False)
+        self.api_manager.records.list(cached=False)
+        form = self.api_manager.forms.get(FORM_ID)
+        self.assertIsNone(form.flat_schema)
+        self.assertFalse(self.has_table(FORM_ID))
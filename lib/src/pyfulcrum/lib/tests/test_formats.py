@@ -6,8 +6,11 @@ import csv
 from io import BytesIO, StringIO
 import zipfile
 
-from . import BaseTestCase
-from ..formats import FORMATS
+from sqlalchemy import event
+
+from . import BaseTestCase, MockedResource, mock
+from .. import columnar
+from ..formats import FORMATS, STREAM_FORMATS
 from ..models import Record, Project
 
 
@@ -60,6 +63,10 @@ class FormatTestCase(BaseTestCase):
         self.assertTrue(isinstance(out, dict), out)
         self.assertEqual(out.get('type'), 'Feature')
         self.assertEqual(out['properties']['id'], r.id)
+        # lon, lat order
+        self.assertEqual(out['geometry']['type'], 'Point')
+        self.assertEqual(out['geometry']['coordinates'],
+                         [r.payload['longitude'], r.payload['latitude']])
         r = self.api_manager.records.list()
         out = json.loads(f(r, self._storage, multiple=True))
         self.assertTrue(isinstance(out, dict))
@@ -81,6 +88,11 @@ class FormatTestCase(BaseTestCase):
         names = zf.namelist()
         self.assertEqual(set(names), set(['records.shp', 'records.dbf', 'records.prj', 'records.shx']))
 
+        out = BytesIO(b''.join(STREAM_FORMATS['shapefile'](r, self._storage, multiple=False)))
+        zf = zipfile.ZipFile(out, mode='r')
+        self.assertEqual(set(zf.namelist()), set(names))
+        self.assertIsNone(zf.testzip())
+
 
     def test_format_str(self):
         self.api_manager.forms.list(cached=False)
@@ -108,6 +120,18 @@ class FormatTestCase(BaseTestCase):
         self.assertEqual(out.read(5), b'<?xml')
 
 
+    def test_format_gpkg_fgb(self):
+
+        self.api_manager.forms.list(cached=False)
+        self.api_manager.records.list(cached=False)
+        self.api_manager.photos.list(cached=False)
+
+        r = self.api_manager.records.list()
+        out = FORMATS['gpkg'](r, self._storage, multiple=True)
+        self.assertEqual(out[:16], b'SQLite format 3\x00')
+        out = FORMATS['fgb'](r, self._storage, multiple=True)
+        self.assertEqual(out[:3], b'fgb')
+
     def test_format_csv(self):
     
         self.api_manager.forms.list(cached=False)
@@ -127,6 +151,136 @@ class FormatTestCase(BaseTestCase):
         self.assertEqual(row[0], '4e1c33ad-5496-4818-826f-504e66239b4d')
         self.assertRaises(StopIteration, next, reader)
 
+        # query is read with column projection, output is the same as for objects
+        q = self.api_manager.records.list()
+        out = f(q, self._storage, multiple=True)
+        self.assertEqual(out, f(iter(q.all()), self._storage, multiple=True))
+        header = next(csv.reader(StringIO(out.decode('utf-8'))))
+        # all keys of payload are written
+        payload = MockedResource('records').find(r.id)['record']
+        labels = ['field.{}'.format(field.label) for field in r.form.fields_list]
+        self.assertEqual(header,
+                         ['id'] + sorted(set(payload) - {'id', 'form_values'} |
+                                         set(labels)))
+
+        # header doesn't depend on payloads of items
+        r.payload = dict(r.payload, extra='value')
+        out = f(self.api_manager.records.list(), self._storage, multiple=True)
+        self.assertEqual(next(csv.reader(StringIO(out.decode('utf-8')))), header)
+        empty = b''.join(STREAM_FORMATS['csv'](q.filter(Record.id == 'missing'),
+                                               self._storage, multiple=True))
+        # there are no forms of records, so there are no field columns
+        self.assertEqual(list(csv.reader(StringIO(empty.decode('utf-8')))),
+                         [[h for h in header if not h.startswith('field.')]])
+
+        photo = self.api_manager.photos.list()[0]
+        payload = MockedResource('photos').find(photo.id)['photo']
+        out = f(self.api_manager.photos.list(), self._storage, multiple=True)
+        header = next(csv.reader(StringIO(out.decode('utf-8'))))
+        self.assertTrue(set(payload) - {'id'} <= set(header), header)
+        self.assertNotIn('point', header)
+
+
+    def test_format_ndjson(self):
+
+        self.api_manager.forms.list(cached=False)
+        self.api_manager.records.list(cached=False)
+        self.api_manager.photos.list(cached=False)
+
+        r = self.api_manager.records.list()
+        lines = FORMATS['ndjson'](r, self._storage, multiple=True).splitlines()
+        self.assertEqual(len(lines), r.count())
+        self.assertEqual(json.loads(lines[0])['id'], r[0].id)
+
+        lines = FORMATS['geojsonseq'](r, self._storage, multiple=True).splitlines()
+        self.assertEqual(len(lines), r.count())
+        feature = json.loads(lines[0])
+        self.assertEqual(feature['type'], 'Feature')
+        self.assertEqual(feature['properties']['id'], r[0].id)
+
+    def test_stream_formats(self):
+
+        self.api_manager.forms.list(cached=False)
+        self.api_manager.records.list(cached=False)
+        self.api_manager.photos.list(cached=False)
+
+        r = self.api_manager.records.get('4e1c33ad-5496-4818-826f-504e66239b4d')
+        def encoded(out):
+            if isinstance(out, str):
+                return out.encode('utf-8')
+            return out
+
+        for fname, f in STREAM_FORMATS.items():
+            # zip entries have timestamps of export, see test_format_shapefile
+            if fname == 'shapefile':
+                continue
+            # see test_columnar
+            if fname in ('parquet', 'arrow',) and not columnar.is_available():
+                continue
+            out = b''.join(f(r, self._storage, multiple=False))
+            self.assertEqual(out, encoded(FORMATS[fname](r, self._storage, multiple=False)))
+            out = b''.join(f(self.api_manager.records.list(), self._storage, multiple=True))
+            self.assertEqual(out, encoded(FORMATS[fname](self.api_manager.records.list(),
+                                                         self._storage, multiple=True)))
+
+        # empty list is still valid document
+        empty = self.api_manager.records.list().filter(Record.id == 'missing')
+        self.assertEqual(json.loads(b''.join(STREAM_FORMATS['json'](empty, self._storage, multiple=True))), [])
+        self.assertEqual(json.loads(b''.join(STREAM_FORMATS['geojson'](empty, self._storage, multiple=True))),
+                         {'type': 'FeatureCollection', 'features': []})
+        self.assertEqual(b''.join(self.api_manager.as_stream('raw', r)),
+                         bytes(FORMATS['raw'](r, self._storage), 'utf-8'))
+
+    def test_ogr_formats_empty(self):
+
+        self.api_manager.forms.list(cached=False)
+        self.api_manager.records.list(cached=False)
+
+        empty = self.api_manager.records.list().filter(Record.id == 'missing')
+        for fname in ('shapefile', 'kml', 'gpkg', 'fgb',):
+            self.assertEqual(b''.join(STREAM_FORMATS[fname](empty, self._storage, multiple=True)),
+                             b'', fname)
+            self.assertEqual(b''.join(STREAM_FORMATS[fname](iter(()), self._storage, multiple=True)),
+                             b'', fname)
+
+    def test_ogr_driver_missing(self):
+
+        self.api_manager.forms.list(cached=False)
+        self.api_manager.records.list(cached=False)
+
+        # i.e. FlatGeobuf driver in GDAL < 3.1, error is raised before output
+        with mock.patch('pyfulcrum.lib.formats.ogr.GetDriverByName', return_value=None):
+            for fname in ('shapefile', 'kml', 'gpkg', 'fgb',):
+                self.assertRaises(ValueError, STREAM_FORMATS[fname],
+                                  self.api_manager.records.list(), self._storage, multiple=True)
+                self.assertRaises(ValueError, FORMATS[fname],
+                                  self.api_manager.records.list(), self._storage, multiple=True)
+
+    def test_stream_formats_single_pass(self):
+
+        self.api_manager.forms.list(cached=False)
+        self.api_manager.records.list(cached=False)
+        session = self.api_manager.session
+        session.commit()
+
+        statements = []
+        def log_statement(*args, **kwargs):
+            statements.append(args[2])
+
+        event.listen(session.bind, 'before_cursor_execute', log_statement)
+        try:
+            for fname in ('json', 'geojson', 'ndjson',):
+                statements[:] = []
+                out = b''.join(STREAM_FORMATS[fname](self.api_manager.records.list(),
+                                                     self._storage, multiple=True))
+                self.assertTrue(out)
+                # items are not counted before they're read
+                self.assertFalse([s for s in statements if 'count(' in s.lower()], statements)
+        finally:
+            event.remove(session.bind, 'before_cursor_execute', log_statement)
+
+        with self.assertRaises(TypeError):
+            STREAM_FORMATS['geojson'](self.api_manager.forms.list(), self._storage, multiple=True)
 
     def test_invalid_format_class(self):
 
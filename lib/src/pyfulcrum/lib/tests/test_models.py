@@ -2,6 +2,8 @@
 # -*- coding: utf-8 -*-
 
 import json
+from sqlalchemy import event, inspect
+from pyfulcrum.lib.models import Field, Record, Value, get_spatial_filters
 from . import BaseTestCase
 
 
@@ -64,14 +66,154 @@ class ModelsTestCase(BaseTestCase):
         self.assertEqual(len(list(self.api_manager.records.list())), 0)
         self.assertEqual(len(list(self.api_manager.records.list(cached=False))), 1)
 
+    def test_records_eager_load(self):
+        self.assertEqual(len(list(self.api_manager.forms.list(cached=False))), 1)
+        self.assertEqual(len(list(self.api_manager.records.list(cached=False))), 1)
+        self.assertEqual(len(list(self.api_manager.photos.list(cached=False))), 1)
+        session = self.api_manager.session
+        session.commit()
+        session.expunge_all()
+
+        statements = []
+        def count_statements(*args, **kwargs):
+            statements.append(args[2])
+
+        event.listen(session.bind, 'before_cursor_execute', count_statements)
+        try:
+            for record in self.api_manager.records.list():
+                values = record.get_values(self.api_manager.storage)
+                self.assertTrue(values)
+        finally:
+            event.remove(session.bind, 'before_cursor_execute', count_statements)
+        # records, values with fields, media
+        self.assertEqual(len(statements), 3, statements)
+
+    def test_records_values_filters(self):
+        self.assertEqual(len(list(self.api_manager.forms.list(cached=False))), 1)
+        self.assertEqual(len(list(self.api_manager.records.list(cached=False))), 1)
+
+        def count(**url_params):
+            return self.api_manager.records.list(url_params=url_params).count()
+
+        self.assertEqual(count(**{'values.id_tag': '183'}), 1)
+        self.assertEqual(count(**{'values.id_tag': '184'}), 0)
+        self.assertEqual(count(**{'values.id_tag__in': '182,183'}), 1)
+        self.assertEqual(count(**{'values.hydrant_type': 'Pillar'}), 1)
+        self.assertEqual(count(**{'values.hydrant_type__in': 'Wall,Hydrant'}), 0)
+        self.assertEqual(count(**{'values.diameter__gte': '4'}), 1)
+        self.assertEqual(count(**{'values.diameter__gt': '4'}), 0)
+        self.assertEqual(count(**{'values.diameter__lt': '10'}), 1)
+        self.assertEqual(count(**{'values.id_tag': '183',
+                                  'form_id': '7a0c3378-b63a-4707-b459-df499698f23c'}), 1)
+        self.assertEqual(count(**{'values.invalid': '183'}), 0)
+        # unknown suffix is a part of data name
+        self.assertEqual(count(**{'values.id_tag__like': '183'}), 0)
+        for value in ('abc', '', 'nan', 'inf'):
+            with self.assertRaises(ValueError):
+                count(**{'values.diameter__gt': value})
+
+        session = self.api_manager.session
+        session.query(Field).filter(Field.data_name == 'id_tag').update({Field.data_name: 'id__tag'})
+        self.assertEqual(count(**{'values.id__tag': '183'}), 1)
+        self.assertEqual(count(**{'values.id__tag__in': '182,183'}), 1)
+
+        # non-numeric stored values don't match range, and don't fail the query
+        record = self.api_manager.records.list()[0]
+        field = session.query(Field).filter(Field.data_name == 'diameter').one()
+        record.values = dict(record.values, **{field.id: 'abc'})
+        session.flush()
+        self.assertEqual(count(**{'values.diameter__gte': '0'}), 0)
+        self.assertEqual(count(**{'values.diameter__lt': '10'}), 0)
+
+    def test_spatial_filters(self):
+        self.assertEqual(len(list(self.api_manager.forms.list(cached=False))), 1)
+        self.assertEqual(len(list(self.api_manager.records.list(cached=False))), 1)
+        self.assertEqual(len(list(self.api_manager.photos.list(cached=False))), 1)
+
+        def count(manager, **url_params):
+            return manager.list(url_params=url_params).count()
+
+        # record at -73.8936123, 42.8208336
+        records = self.api_manager.records
+        self.assertEqual(count(records, bbox='-74,42,-73,43'), 1)
+        self.assertEqual(count(records, bbox='42,-74,43,-73'), 0)
+        self.assertEqual(count(records, near='-73.89,42.82', radius='1000'), 1)
+        self.assertEqual(count(records, near='-73.89,42.82', radius='100'), 0)
+        self.assertEqual(count(records, intersects='POLYGON((-74 42, -73 43, -74 43, -74 42))'), 1)
+        self.assertEqual(count(records, intersects='POLYGON((-74 42, -73 42, -73 43, -74 42))'), 0)
+
+        # photo at -81.4179583, 41.4226889
+        photos = self.api_manager.photos
+        self.assertEqual(count(photos, bbox='-82,41,-81,42'), 1)
+        self.assertEqual(count(photos, bbox='-74,42,-73,43'), 0)
+        self.assertEqual(count(photos, near='-81.418,41.423', radius='100'), 1)
+
+        with self.assertRaises(ValueError):
+            count(records, bbox='-74,42,-73')
+        with self.assertRaises(ValueError):
+            count(records, near='-73.89,42.82')
+        with self.assertRaises(ValueError):
+            count(records, intersects='POLYGON(')
+
+    def test_spatial_filters_invalid(self):
+        invalid = ({'bbox': '-74,42,-73'},
+                   {'bbox': '-74,42,-73,nan'},
+                   {'bbox': '-inf,42,-73,43'},
+                   {'near': '-73.89,42.82'},
+                   {'near': 'nan,42.82', 'radius': '100'},
+                   {'near': '-73.89,42.82', 'radius': 'inf'},
+                   {'near': '-73.89,42.82', 'radius': 'nan'},
+                   {'near': '-73.89,42.82', 'radius': '-1'},
+                   {'intersects': 'POLYGON('},
+                   )
+        for url_params in invalid:
+            with self.assertRaises(ValueError, msg=url_params):
+                get_spatial_filters(Record.point, url_params)
+
     def test_records_removed(self):
         forms = self.api_manager.forms.list(cached=False)
         self.assertEqual(len(list(self.api_manager.records.list())), 0)
         self.assertEqual(len(list(self.api_manager.records.list(cached=False))), 1)
+        record = self.api_manager.records.list()[0]
+        form, value = record.form, record.values_list[0]
         self.api_manager.records.remove("4e1c33ad-5496-4818-826f-504e66239b4d")
+        # only objects of removed children classes are expired
+        self.assertFalse(inspect(form).expired_attributes)
+        self.assertIn('removed', inspect(value).expired_attributes)
         self.assertEqual(len(list(self.api_manager.records.list(cached=True))), 0)
         self.assertEqual(len(list(self.api_manager.records.list_removed())), 1)
 
+    def test_forms_removed(self):
+        self.assertEqual(len(list(self.api_manager.forms.list(cached=False))), 1)
+        self.assertEqual(len(list(self.api_manager.records.list(cached=False))), 1)
+        self.assertEqual(len(list(self.api_manager.photos.list(cached=False))), 1)
+        form_id = "7a0c3378-b63a-4707-b459-df499698f23c"
+        form = self.api_manager.forms.get(form_id)
+        self.assertEqual(form.records_count, 1)
+        self.api_manager.records.remove("4e1c33ad-5496-4818-826f-504e66239b4d")
+        self.assertEqual(form.records_count, 0)
+        self.api_manager.records.get("4e1c33ad-5496-4818-826f-504e66239b4d",
+                                     cached=False, if_removed=True)
+        self.assertEqual(form.records_count, 1)
+        # form, 5 fields, record, its values and photo
+        count = self.api_manager.forms.remove(form_id)
+        self.assertTrue(count > 8, count)
+        self.assertIsNone(self.api_manager.forms.remove('invalid'))
+        self.assertEqual(len(list(self.api_manager.forms.list())), 0)
+        self.assertEqual(len(list(self.api_manager.fields.list())), 0)
+        self.assertEqual(len(list(self.api_manager.records.list())), 0)
+        session = self.api_manager.session
+        self.assertEqual(session.query(Value).filter(Value.removed == False).count(), 0)
+        self.assertEqual(len(list(self.api_manager.photos.list())), 0)
+        self.assertEqual(len(list(self.api_manager.records.list_removed())), 1)
+        # removed form reports all its records
+        self.assertEqual(form.records_count, 1)
+
+        # fetching form from api restores form and its fields
+        form = self.api_manager.forms.get(form_id, cached=False, if_removed=True)
+        self.assertFalse(form.removed)
+        self.assertEqual(len(list(self.api_manager.fields.list())), 5)
+
 
 
 
@@ -86,3 +228,10 @@ class ModelsTestCase(BaseTestCase):
         photo_links = photo.get_paths(self.api_manager.storage)
         expected = ('large', 'thumbnail', 'original',)
         self.assertEqual(set(expected), set(photo_links.keys()))
+        self.assertIsNotNone(photo.manifest)
+        self.assertEqual(set(expected), set(photo.manifest['paths'].keys()))
+        for size in expected:
+            self.assertEqual(photo_links[size]['path'],
+                             self.api_manager.storage.get_path(photo.form_id, photo.record_id,
+                                                               photo.media_type, size,
+                                                               photo.content_type))
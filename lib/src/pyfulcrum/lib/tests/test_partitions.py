@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from . import BaseTestCase
+from .. import partitions
+from ..models import Value
+
+FORM_ID = '7a0c3378-b63a-4707-b459-df499698f23c'
+
+
+class PartitionsTestCase(BaseTestCase):
+
+    def test_values_form_id(self):
+        self.api_manager.forms.list(cached=False)
+        self.api_manager.records.list(cached=False)
+        values = self.api_manager.session.query(Value).all()
+        self.assertTrue(values)
+        self.assertEqual(set(v.form_id for v in values), set([FORM_ID]))
+
+        # form removal marks values removed through form_id
+        self.api_manager.forms.remove(FORM_ID)
+        self.assertEqual(self.api_manager.session.query(Value)
+                                                 .filter(Value.removed == False)
+                                                 .count(), 0)
+
+    def test_unpartitioned(self):
+        session = self.api_manager.session
+        self.assertIsNone(partitions.get_strategy(session))
+        self.assertFalse(partitions.create_partitions(session, FORM_ID))
+        self.assertFalse(partitions.drop_partitions(session, FORM_ID))
+
+    def test_ddl(self):
+        self.assertEqual(partitions.get_partition_name('fulcrum_value', FORM_ID),
+                         'fulcrum_value_7a0c3378_b63a_4707_b459_df499698f23c')
+        create = partitions.get_create_ddl("form'1")
+        self.assertEqual(len(create), len(partitions.PARTITIONED_TABLES))
+        self.assertEqual(create[0], "CREATE TABLE IF NOT EXISTS fulcrum_record_form_1 "
+                                    "PARTITION OF fulcrum_record FOR VALUES IN ('form''1')")
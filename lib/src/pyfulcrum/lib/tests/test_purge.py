@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+from io import StringIO
+from datetime import datetime, timedelta, timezone
+
+from . import BaseTestCase
+from ..models import Form, Record, Value, Media
+from ..purge import purge
+
+FORM_ID = '7a0c3378-b63a-4707-b459-df499698f23c'
+RECORD_ID = '4e1c33ad-5496-4818-826f-504e66239b4d'
+
+
+class PurgeTestCase(BaseTestCase):
+
+    def test_purge(self):
+        self.api_manager.forms.list(cached=False)
+        self.api_manager.records.list(cached=False)
+        self.api_manager.photos.list(cached=False)
+        session = self.api_manager.session
+        values_count = session.query(Value).count()
+        paths = [p['path'] for m in session.query(Media)
+                 for p in m.get_paths(self._storage).values()]
+
+        past = datetime.now(timezone.utc) - timedelta(days=1)
+        future = datetime.now(timezone.utc) + timedelta(days=1)
+
+        # nothing is removed
+        stats = purge(session, future)
+        self.assertEqual(sum(s['count'] for s in stats.values()), 0)
+
+        # record was removed after cutoff time
+        self.api_manager.records.remove(RECORD_ID)
+        stats = purge(session, past)
+        self.assertEqual(sum(s['count'] for s in stats.values()), 0)
+
+        archive = StringIO()
+        stats = purge(session, future, storage=self._storage, archive=archive, batch_size=2)
+        self.assertEqual(stats['fulcrum_record']['count'], 1)
+        self.assertEqual(stats['fulcrum_value']['count'], values_count)
+        self.assertEqual(stats['fulcrum_media']['count'], 1)
+        self.assertEqual(stats['fulcrum_form']['count'], 0)
+        self.assertTrue(stats['fulcrum_record']['bytes'] > 0)
+        self.assertEqual(stats['files']['count'], len(paths))
+        self.assertFalse([p for p in paths if os.path.exists(p)])
+        self.assertIsNone(Record.get(RECORD_ID, session, if_removed=True))
+
+        lines = [json.loads(line) for line in archive.getvalue().splitlines()]
+        self.assertEqual(len(lines), values_count + 2)
+        self.assertEqual(set(line['table'] for line in lines),
+                         set(['fulcrum_record', 'fulcrum_value', 'fulcrum_media']))
+        record = [line['row'] for line in lines if line['table'] == 'fulcrum_record'][0]
+        self.assertEqual(record['id'], RECORD_ID)
+
+        # form without records
+        self.api_manager.forms.remove(FORM_ID)
+        stats = purge(session, future)
+        self.assertEqual(stats['fulcrum_form']['count'], 1)
+        self.assertEqual(stats['fulcrum_field']['count'], 5)
+        self.assertIsNone(Form.get(FORM_ID, session, if_removed=True))
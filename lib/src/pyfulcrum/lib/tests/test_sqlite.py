@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import csv
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+from datetime import datetime, timezone, timedelta
+from io import StringIO
+from unittest import TestCase, skipUnless
+
+from alembic import command
+from alembic.config import Config
+from alembic.runtime.migration import MigrationContext
+from alembic.script import ScriptDirectory
+from sqlalchemy import inspect, select
+from sqlalchemy.dialects import sqlite as sqlite_dialect, postgresql
+from sqlalchemy.orm import aliased
+
+from . import MockedFulcrumClient, get_storage
+from .. import flat, sqlite
+from ..api import ApiManager
+from ..formats import FORMATS
+from ..models import Change, Record, get_spatial_filters
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(__file__), '..', 'migrations')
+FORM_ID = '7a0c3378-b63a-4707-b459-df499698f23c'
+RECORD_ID = '4e1c33ad-5496-4818-826f-504e66239b4d'
+
+
+def has_spatialite():
+    """
+    Returns True if sqlite3 module can load SpatiaLite extension
+    """
+    conn = sqlite3.connect(':memory:')
+    try:
+        conn.enable_load_extension(True)
+        conn.load_extension(os.getenv(sqlite.SPATIALITE_LIBRARY_ENV) or sqlite.SPATIALITE_LIBRARY)
+    except (AttributeError, sqlite3.OperationalError):
+        return False
+    finally:
+        conn.close()
+    return True
+
+
+class SQLiteTestCase(TestCase):
+
+    def test_datetime_type(self):
+        dtype = sqlite.DateTimeType()
+        dialect = sqlite_dialect.dialect()
+        self.assertEqual(dtype.process_bind_param('2018-11-20T10:11:12Z', dialect),
+                         datetime(2018, 11, 20, 10, 11, 12))
+        self.assertEqual(dtype.process_bind_param(datetime(2018, 11, 20, 12, 11, 12,
+                                                           tzinfo=timezone(timedelta(hours=2))),
+                                                  dialect),
+                         datetime(2018, 11, 20, 10, 11, 12))
+        self.assertEqual(dtype.process_result_value(datetime(2018, 11, 20, 10, 11, 12), dialect),
+                         datetime(2018, 11, 20, 10, 11, 12, tzinfo=timezone.utc))
+        # other databases parse strings themselves
+        self.assertEqual(dtype.process_bind_param('2018-11-20T10:11:12Z', postgresql.dialect()),
+                         '2018-11-20T10:11:12Z')
+
+    def test_parse_datetime(self):
+        parse = sqlite.parse_datetime
+        self.assertEqual(parse('2018-11-20T10:11:12Z'),
+                         datetime(2018, 11, 20, 10, 11, 12, tzinfo=timezone.utc))
+        self.assertEqual(parse('2018-11-20T12:11:12.5+02:00'),
+                         datetime(2018, 11, 20, 12, 11, 12, 500000,
+                                  tzinfo=timezone(timedelta(hours=2))))
+        self.assertEqual(parse('2018-11-20 10:11'), datetime(2018, 11, 20, 10, 11))
+        self.assertEqual(parse('2018-11-20'), datetime(2018, 11, 20))
+        with self.assertRaises(ValueError):
+            parse('20.11.2018')
+
+    def test_spatial_filters(self):
+        dialect = sqlite_dialect.dialect()
+        filters = get_spatial_filters(Record.point, {'bbox': '-74,42,-73,43',
+                                                     'near': '-73.89,42.82',
+                                                     'radius': '100',
+                                                     'intersects': 'POINT(-73.89 42.82)'},
+                                      dialect)
+        sql = [str(f.compile(dialect=dialect)) for f in filters]
+        self.assertEqual(len(sql), 3)
+        for s in sql:
+            self.assertIn('fulcrum_record.rowid IN (SELECT "SpatialIndex".rowid', s)
+            self.assertIn('BuildMbr(', s)
+            self.assertNotIn('ST_MakeEnvelope', s)
+        self.assertIn('PtDistWithin(fulcrum_record.point, MakePoint(', sql[1])
+        self.assertIn('ST_Intersects(fulcrum_record.point, ST_GeomFromText(', sql[2])
+
+        # rowid is selected from aliased table, spatial index is searched by table name
+        record = aliased(Record)
+        compiled = (get_spatial_filters(record.point, {'bbox': '-74,42,-73,43'}, dialect)[0]
+                    .compile(dialect=dialect))
+        self.assertIn('fulcrum_record_1.rowid IN (SELECT "SpatialIndex".rowid', str(compiled))
+        self.assertIn('fulcrum_record', compiled.params.values())
+
+
+@skipUnless(has_spatialite(), "SpatiaLite extension can't be loaded")
+class SpatiaLiteTestCase(TestCase):
+    """
+    Runs ingest, filters, removals and exports with SpatiaLite database
+    created with alembic migrations
+    """
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        url = 'sqlite:///{}'.format(os.path.join(self._dir, 'pyfulcrum.sqlite'))
+        self._config = Config()
+        self._config.set_main_option('script_location', MIGRATIONS_DIR)
+        self._config.set_main_option('sqlalchemy.url', url)
+        command.upgrade(self._config, 'head')
+        self.api_manager = ApiManager(url, MockedFulcrumClient(), get_storage(),
+                                      flat_tables=True)
+
+    def tearDown(self):
+        self.api_manager.session.close()
+        self.api_manager.db.dispose()
+        shutil.rmtree(self._dir)
+
+    def test_migrations(self):
+        # new database is created from models and stamped
+        head = ScriptDirectory.from_config(self._config).get_current_head()
+        with self.api_manager.db.connect() as conn:
+            self.assertEqual(MigrationContext.configure(conn).get_current_revision(), head)
+            self.assertTrue(conn.execute('SELECT CheckSpatialMetaData()').scalar())
+            self.assertNotIn('ix_fulcrum_record_values',
+                             [i['name'] for i in inspect(conn).get_indexes('fulcrum_record')])
+        # existing database is migrated, not created again
+        command.upgrade(self._config, 'head')
+
+    def test_ingest(self):
+        api_manager = self.api_manager
+        api_manager.forms.list(cached=False)
+        api_manager.records.list(cached=False)
+        api_manager.photos.list(cached=False)
+        api_manager.session.commit()
+
+        def count(**url_params):
+            return api_manager.records.list(url_params=url_params).count()
+
+        # json1 values filters
+        self.assertEqual(count(**{'values.id_tag': '183'}), 1)
+        self.assertEqual(count(**{'values.id_tag__in': '182,183'}), 1)
+        self.assertEqual(count(**{'values.diameter__gte': '4'}), 1)
+        self.assertEqual(count(**{'values.diameter__gt': '4'}), 0)
+        # spatial index filters, record at -73.8936123, 42.8208336
+        self.assertEqual(count(bbox='-74,42,-73,43'), 1)
+        self.assertEqual(count(bbox='42,-74,43,-73'), 0)
+        self.assertEqual(count(near='-73.89,42.82', radius='1000'), 1)
+        self.assertEqual(count(near='-73.89,42.82', radius='100'), 0)
+        self.assertEqual(count(intersects='POLYGON((-74 42, -73 43, -74 43, -74 42))'), 1)
+        self.assertEqual(api_manager.photos.list(url_params={'bbox': '-82,41,-81,42'}).count(), 1)
+        # dates are compared in UTC
+        self.assertEqual(count(created_since='2015-05-30T17:47:18+02:00'), 1)
+        self.assertEqual(count(created_since='2015-05-30T15:47:19Z'), 0)
+
+        form = api_manager.forms.get(FORM_ID)
+        table = flat.get_table(FORM_ID, form.flat_schema)
+        rows = list(api_manager.session.execute(select([table])))
+        self.assertEqual([row['id_tag'] for row in rows], ['183'])
+
+        out = json.loads(FORMATS['geojson'](api_manager.records.list(), api_manager.storage,
+                                            multiple=True))
+        coords = out['features'][0]['geometry']['coordinates']
+        self.assertAlmostEqual(coords[0], -73.8936123)
+        self.assertAlmostEqual(coords[1], 42.8208336)
+        out = FORMATS['csv'](api_manager.records.list(), api_manager.storage, multiple=True)
+        rows = list(csv.reader(StringIO(out.decode('utf-8'))))
+        self.assertEqual([row[0] for row in rows[1:]], [RECORD_ID])
+
+        # unchanged payloads are updated in place, without changes logged
+        cursor = api_manager.get_changes().all()[-1].id
+        api_manager.records.list(cached=False)
+        api_manager.session.commit()
+        self.assertEqual(api_manager.get_changes(since=cursor).count(), 0)
+
+        api_manager.records.remove(RECORD_ID)
+        api_manager.session.commit()
+        self.assertEqual(count(), 0)
+        self.assertEqual(api_manager.photos.list().count(), 0)
+        self.assertEqual(list(api_manager.session.execute(select([table]))), [])
+        self.assertIn(('records', RECORD_ID, Change.OP_REMOVE,),
+                      [(c.resource, c.resource_id, c.op,)
+                       for c in api_manager.get_changes(since=cursor)])
+
+        api_manager.records.get(RECORD_ID, cached=False, if_removed=True)
+        api_manager.session.commit()
+        self.assertEqual(count(bbox='-74,42,-73,43'), 1)
+        self.assertEqual(len(list(api_manager.session.execute(select([table])))), 1)
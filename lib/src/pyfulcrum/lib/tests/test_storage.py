@@ -1,11 +1,15 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
 import json
+import time
+import tempfile
+import threading
 from io import BytesIO
 from unittest import TestCase
 from . import get_storage
-from ..storage import Storage
+from ..storage import Storage, LAYOUT_FLAT, LAYOUT_HASHED
 
 
 class StorageTestCase(TestCase):
@@ -37,3 +41,79 @@ class StorageTestCase(TestCase):
         f.seek(0)
         with open(local_path, 'rt') as fin:
             self.assertEqual(f.read().decode('utf-8'), fin.read())
+
+    def test_storage_hashed(self):
+        storage = get_storage(layout=LAYOUT_HASHED)
+        shards = storage.get_shards('record_id')
+        self.assertEqual(len(shards), 2)
+        self.assertTrue(all(len(s) == 2 for s in shards), shards)
+        local_path = storage.get_path('form_id', 'record_id', 'test', 'normal', 'image/png')
+        expected = os.path.join('form_id', shards[0], shards[1], 'record_id', 'test_normal.png')
+        self.assertTrue(local_path.endswith(expected), local_path)
+
+    def test_storage_migrate_layout(self):
+        with tempfile.TemporaryDirectory() as root_dir:
+            flat = Storage(root_dir, layout=LAYOUT_FLAT)
+            for record_id in ('record_1', 'record_2', 'record_3',):
+                flat.save(BytesIO(b'ffff'), 'form_id', record_id, 'test', 'normal', 'image/png')
+            old_path = flat.get_path('form_id', 'record_1', 'test', 'normal', 'image/png')
+
+            hashed = Storage(root_dir, layout=LAYOUT_HASHED, previous_layout=LAYOUT_FLAT)
+            new_path = hashed.get_common_path('form_id', 'record_1', 'test', 'normal', 'image/png')
+            new_path = os.path.join(root_dir, new_path)
+            # not migrated yet, file is resolved in previous layout
+            self.assertEqual(hashed.get_path('form_id', 'record_1', 'test', 'normal', 'image/png'),
+                             old_path)
+
+            batches = list(hashed.migrate_layout(batch_size=2))
+            self.assertEqual([len(b) for b in batches], [2, 1])
+            self.assertEqual(hashed.get_path('form_id', 'record_1', 'test', 'normal', 'image/png'),
+                             new_path)
+            self.assertTrue(os.path.exists(new_path))
+            self.assertFalse(os.path.exists(old_path))
+            self.assertFalse(os.path.exists(os.path.dirname(old_path)))
+            # nothing left to migrate
+            self.assertEqual(list(hashed.migrate_layout()), [])
+
+    def test_storage_manifest(self):
+        sizes = ('large', 'original',)
+        manifest = self.storage_url.get_manifest('form_id', 'record_id', 'test', sizes, 'image/png')
+        self.assertTrue(self.storage_url.is_current_manifest(manifest))
+        self.assertFalse(get_storage(layout=LAYOUT_HASHED).is_current_manifest(manifest))
+        paths = self.storage_url.get_manifest_paths(manifest)
+        self.assertEqual(set(paths.keys()), set(sizes))
+        for size in sizes:
+            self.assertEqual(paths[size]['path'],
+                             self.storage_url.get_path('form_id', 'record_id', 'test', size, 'image/png'))
+            self.assertEqual(paths[size]['url'],
+                             self.storage_url.get_url('form_id', 'record_id', 'test', size, 'image/png'))
+
+    def test_storage_fetch(self):
+        calls = []
+
+        def opener():
+            calls.append(1)
+            # give other threads time to race for the file
+            time.sleep(0.1)
+            return BytesIO(b'ffff')
+
+        with tempfile.TemporaryDirectory() as root_dir:
+            storage = Storage(root_dir)
+            threads = [threading.Thread(target=storage.fetch,
+                                        args=(opener, 'form_id', 'record_id',
+                                              'test', 'normal', 'image/png',))
+                       for i in range(5)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(len(calls), 1)
+            path = storage.get_path('form_id', 'record_id', 'test', 'normal', 'image/png')
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), b'ffff')
+            # no temporary or lock files left
+            self.assertEqual(os.listdir(os.path.dirname(path)), ['test_normal.png'])
+
+            storage.fetch(opener, 'form_id', 'record_id', 'test', 'normal', 'image/png',
+                          overwrite=True)
+            self.assertEqual(len(calls), 2)
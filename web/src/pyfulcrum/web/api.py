@@ -1,13 +1,19 @@
 #!/usr/bin/env python 
 # -*- coding: utf-8 -*-
 
+import json
 import logging
 import math
 
 from werkzeug.routing import BaseConverter, ValidationError
-from flask import Blueprint, abort, current_app, Response, request, jsonify
+from flask import Blueprint, abort, current_app, Response, request, jsonify, stream_with_context
+from sqlalchemy.orm import undefer_group
 from pyfulcrum.lib.api import ApiManager, PER_PAGE
-from pyfulcrum.lib.formats import json_item, geojson_item, format_kml, format_csv, format_shapefile
+from pyfulcrum.lib.models import PAYLOAD_GROUP
+from pyfulcrum.lib.formats import (json_item, geojson_item, iter_json_array, iter_encoded,
+                                   stream_csv, stream_kml, stream_shapefile, stream_gpkg, stream_fgb,
+                                   stream_parquet, stream_arrow,
+                                   stream_ndjson, stream_geojsonseq,)
 
 
 class ResourcesConverter(BaseConverter):
@@ -28,7 +34,8 @@ class FormatConverter(BaseConverter):
     """
     Allows to validate output format
     """
-    formats = ('json', 'raw', 'geojson', 'csv', 'kml', 'shp', 'shapefile',)
+    formats = ('json', 'raw', 'geojson', 'csv', 'kml', 'shp', 'shapefile', 'ndjson', 'geojsonseq',
+               'gpkg', 'fgb', 'parquet', 'arrow',)
 
     @classmethod
     def to_python(cls, value):
@@ -41,6 +48,10 @@ class FormatConverter(BaseConverter):
 
 
 log = logging.getLogger(__name__)
+
+COLUMNAR_MIMETYPES = {'parquet': 'application/vnd.apache.parquet',
+                      'arrow': 'application/vnd.apache.arrow.file'}
+
 api = Blueprint('pyfulcrum.web.api', __name__)
 
 # hooking up resource type converter
@@ -56,6 +67,71 @@ def spatial_only(resource_name, format):
                        .format(resource_name, format), status=400))
 
 
+def stream_page(api_manager, key, items, serialize, **meta):
+    """
+    Returns json response with items serialized under key as they
+    come from query, and page metadata. Items are read while response
+    is sent, so api manager's transaction is ended after last chunk.
+
+    @param serialize callable, which returns json value for item,
+        or None if item should be skipped
+    """
+    prefix = '{{{}: ['.format(json.dumps(key))
+    suffix = '], {}'.format(json.dumps(meta)[1:])
+
+    def iter_values():
+        for item in items:
+            value = serialize(item)
+            if value is not None:
+                yield value
+
+    chunks = iter_encoded(iter_json_array(iter_values(), prefix, suffix))
+    return stream_response(api_manager, chunks, mimetype='application/json')
+
+
+def stream_response(api_manager, chunks, **kwargs):
+    """
+    Returns response, which sends chunks as they're generated, within
+    api manager's transaction.
+
+    @param chunks lazy iterable of encoded chunks
+    @param kwargs Response arguments
+    """
+    def generate():
+        with api_manager:
+            yield from chunks
+
+    return Response(stream_with_context(generate()), **kwargs)
+
+
+def stream_format(api_manager, stream, items, **kwargs):
+    """
+    Returns response, which streams items in format. Format checks
+    class of items and its arguments before chunks are generated, so
+    errors are returned with 400 status instead of truncated response.
+
+    @param stream generator variant of format, see STREAM_FORMATS
+    @param kwargs Response arguments
+    """
+    try:
+        chunks = stream(items, api_manager.storage, multiple=True)
+    except (TypeError, ValueError) as err:
+        abort(Response(str(err), status=400))
+    return stream_response(api_manager, chunks, **kwargs)
+
+
+def begin_snapshot(api_manager):
+    """
+    Begins api manager's transaction, in which all queries see the same
+    data, so page metadata agrees with streamed items. In PostgreSQL
+    default READ COMMITTED level, each query sees data committed before
+    it started, so REPEATABLE READ is used. Other databases use their
+    default level.
+    """
+    if api_manager.db.dialect.name == 'postgresql':
+        api_manager.session.connection(execution_options={'isolation_level': 'REPEATABLE READ'})
+
+
 @api.route('/api/<resource:resource_name>/', methods=['GET'])
 def list_resources(resource_name):
     config = current_app.config.get_namespace('API_')
@@ -67,65 +143,128 @@ def list_resources(resource_name):
         format = FormatConverter.to_python(request.args.get('format'))
     except ValidationError:
         format = 'json'
-    is_spatial = resource_name in ('records', 'photos',) and format in ('kml', 'geojson', 'shp', 'shapefile',)
-    with api_manager:
+    is_spatial = resource_name in ('records', 'photos',) and format in ('kml', 'geojson', 'geojsonseq', 'shp', 'shapefile', 'gpkg', 'fgb',)
+    begin_snapshot(api_manager)
+    # transaction is not ended here: page is counted and items are
+    # streamed in the same transaction, which response ends
+    try:
         res = api_manager.get_manager(resource_name)
         if not res:
             abort(Response("Resource not found: {}".format(resource_name), status=404))
         url_params = request.args.to_dict()
         page = int(url_params.get('page') or 0)
         per_page = int(url_params.get('per_page') or PER_PAGE)
-        q = res.list(cached=True,
-                     url_params=url_params,
-                     is_spatial=is_spatial)
+        try:
+            q = res.list(cached=True,
+                         url_params=url_params,
+                         is_spatial=is_spatial)
+        except ValueError as err:
+            abort(Response(str(err), status=400))
         count = q.count()
         total_pages = math.ceil(count/per_page)
         paged = q.offset(page * per_page).limit(per_page)
 
-        if format == 'json':
-            out = {'items': [json_item(r, api_manager.storage) for r in paged],
-                   'total': count,
-                   'per_page': per_page,
-                   'total_pages': total_pages,
-                   'page': page}
+        page_meta = {'total': count,
+                     'per_page': per_page,
+                     'total_pages': total_pages,
+                     'page': page}
 
-            return jsonify(out)
+        if format == 'json':
+            return stream_page(api_manager, 'items', paged,
+                               lambda r: json_item(r, api_manager.storage),
+                               **page_meta)
 
         elif format == 'raw':
-            out = {resource_name: [r.payload for r in paged],
-                   'total': count,
-                   'per_page': per_page,
-                   'total_pages': total_pages,
-                   'page': page}
-
-            return jsonify(out)
-            
+            return stream_page(api_manager, resource_name,
+                               paged.options(undefer_group(PAYLOAD_GROUP)),
+                               lambda r: r.payload,
+                               **page_meta)
 
         elif format == 'geojson':
             spatial_only(resource_name, 'geojson')
-            features = {'type': 'FeatureCollection',
-                        'features': [geojson_item(r, api_manager.storage) for r in 
-                                     paged],
-                        'total': count,
-                        'per_page': per_page,
-                        'total_pages': total_pages,
-                        'page': page}
-
-            return jsonify(features)
+            return stream_page(api_manager, 'features',
+                               paged.options(undefer_group(PAYLOAD_GROUP)),
+                               lambda r: geojson_item(r, api_manager.storage),
+                               type='FeatureCollection',
+                               **page_meta)
+
+        elif format == 'ndjson':
+            return stream_format(api_manager, stream_ndjson, paged,
+                                 mimetype='application/x-ndjson')
+
+        elif format == 'geojsonseq':
+            spatial_only(resource_name, 'geojsonseq')
+            return stream_format(api_manager, stream_geojsonseq, paged,
+                                 # features are newline-delimited, without RS
+                                 # separators of RFC 8142 text sequences
+                                 mimetype='application/x-ndjson')
         elif format == 'kml':
             spatial_only(resource_name, 'kml')
-            kml_data = format_kml(paged, api_manager.storage, multiple=True)
-            return Response(kml_data, mimetype='application/vnd.google-earth.kml+xml',
-                            headers={'Content-Disposition': "attachment;filename={}.kml".format(resource_name)})
+            return stream_format(api_manager, stream_kml, paged,
+                                 mimetype='application/vnd.google-earth.kml+xml',
+                                 headers={'Content-Disposition': "attachment;filename={}.kml".format(resource_name)})
         elif format == 'csv':
-            csv_data = format_csv(paged, api_manager.storage, multiple=True)
-            return Response(csv_data, mimetype='text/csv',
-                            headers={'Content-Disposition': "attachment;filename={}.csv".format(resource_name)})
+            return stream_format(api_manager, stream_csv, paged,
+                                 mimetype='text/csv',
+                                 headers={'Content-Disposition': "attachment;filename={}.csv".format(resource_name)})
 
         elif format in ('shp', 'shapefile'):
             spatial_only(resource_name, 'shapefile')
-            shapefile = format_shapefile(paged, api_manager.storage, multiple=True)
-            return Response(shapefile,
-                            mimetype='application/zip',
-                            headers={'Content-Disposition': "attachment;filename={}.zip".format(resource_name)})
+            return stream_format(api_manager, stream_shapefile, paged,
+                                 mimetype='application/zip',
+                                 headers={'Content-Disposition': "attachment;filename={}.zip".format(resource_name)})
+
+        elif format == 'gpkg':
+            spatial_only(resource_name, 'gpkg')
+            return stream_format(api_manager, stream_gpkg, paged,
+                                 mimetype='application/geopackage+sqlite3',
+                                 headers={'Content-Disposition': "attachment;filename={}.gpkg".format(resource_name)})
+
+        elif format == 'fgb':
+            spatial_only(resource_name, 'fgb')
+            return stream_format(api_manager, stream_fgb, paged,
+                                 mimetype='application/octet-stream',
+                                 headers={'Content-Disposition': "attachment;filename={}.fgb".format(resource_name)})
+
+        elif format in ('parquet', 'arrow',):
+            if resource_name != 'records':
+                abort(Response("Resource type {} cannot be serialized to {} format"
+                               .format(resource_name, format), status=400))
+            return stream_format(api_manager,
+                                 stream_parquet if format == 'parquet' else stream_arrow,
+                                 paged,
+                                 mimetype=COLUMNAR_MIMETYPES[format],
+                                 headers={'Content-Disposition': "attachment;filename={}.{}".format(resource_name, format)})
         abort(400)
+    except Exception:
+        api_manager.rollback()
+        raise
+
+
+@api.route('/api/changes/', methods=['GET'])
+def list_changes():
+    """
+    Returns page of changes logged after `since` change id. Consumers
+    should pass `next` value from response as `since` in next request.
+    """
+    config = current_app.config.get_namespace('API_')
+    api_manager = ApiManager(**config)
+    url_params = request.args.to_dict()
+    try:
+        since = int(url_params['since']) if url_params.get('since') else None
+        per_page = int(url_params.get('per_page') or PER_PAGE)
+        if per_page < 1:
+            raise ValueError("Invalid per_page: {}".format(per_page))
+    except ValueError as err:
+        abort(Response(str(err), status=400))
+    with api_manager:
+        try:
+            q = api_manager.get_changes(since=since, resource=url_params.get('resource'))
+        except ValueError as err:
+            abort(Response(str(err), status=400))
+        changes = q.limit(per_page).all()
+        out = {'items': [c.as_dict() for c in changes],
+               'since': since,
+               'next': changes[-1].id if changes else since,
+               'per_page': per_page}
+        return jsonify(out)
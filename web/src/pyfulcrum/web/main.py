@@ -5,6 +5,7 @@ import sys
 from flask import abort, current_app, Response, request, Flask
 from .webhooks import webhooks
 from .api import api
+from .media import media
 
 
 CONFIG_ENV_VAR = 'PYFULCRUM_WEB_CONFIG'
@@ -15,6 +16,7 @@ def make_app():
     app.config.from_envvar(CONFIG_ENV_VAR, silent=False)
     app.register_blueprint(webhooks)
     app.register_blueprint(api)
+    app.register_blueprint(media)
 
     return app
 
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import logging
+from urllib.parse import quote
+
+from flask import (Blueprint, abort, current_app, Response, request,
+                   send_file, stream_with_context)
+from pyfulcrum.lib.api import ApiManager
+from pyfulcrum.lib.models import Media
+from pyfulcrum.lib.archive import iter_media_bundle
+
+
+log = logging.getLogger(__name__)
+media = Blueprint('pyfulcrum.web.media', __name__)
+
+
+def get_etag(item, size, stat):
+    """
+    Returns ETag value for media file. Media files are not changed
+    once they're stored, so file stats are enough to detect change.
+    """
+    return '{}-{}-{}-{}'.format(item.id, size, int(stat.st_mtime), stat.st_size)
+
+
+@media.route('/media/<media_id>/<size>', methods=['GET', 'HEAD'])
+def get_media(media_id, size):
+    """
+    Serves media file of given size.
+
+    Range and If-None-Match requests are supported. If
+    MEDIA_ACCEL_REDIRECT is configured, file will be served by nginx
+    from internal location with that prefix (X-Accel-Redirect). If
+    USE_X_SENDFILE is set, X-Sendfile header will be used instead.
+    """
+    config = current_app.config.get_namespace('API_')
+    api_manager = ApiManager(**config)
+    with api_manager:
+        item = Media.get(media_id, session=api_manager.session)
+        if item is None:
+            abort(Response("Media not found: {}".format(media_id), status=404))
+        if size not in item.sizes:
+            abort(Response("Invalid size {} for {} media".format(size, item.media_type), status=404))
+
+        storage = api_manager.storage
+        common = item.get_common_path(storage, size)
+        path = storage.get_path_for(common)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            log.warning("Missing file for %s, size %s: %s", item, size, path)
+            abort(Response("File not found for {}, size {}".format(media_id, size), status=404))
+
+        accel_prefix = current_app.config.get('MEDIA_ACCEL_REDIRECT')
+        if accel_prefix:
+            resp = Response(mimetype=item.content_type)
+            resp.headers['X-Accel-Redirect'] = '{}/{}'.format(accel_prefix.rstrip('/'),
+                                                              quote(common))
+            resp.set_etag(get_etag(item, size, stat))
+            resp.last_modified = stat.st_mtime
+            return resp.make_conditional(request)
+
+        # send_file handles ETag, Range and X-Sendfile (USE_X_SENDFILE) by itself
+        return send_file(path,
+                         mimetype=item.content_type,
+                         conditional=True)
+
+
+@media.route('/media/bundle/<resource_name>/', methods=['GET'])
+def get_media_bundle(resource_name):
+    """
+    Streams zip archive with media files of given resource type
+    (photos, videos, audio, signatures) and manifest csv.
+
+    Query params are used to filter media list (like in /api/ endpoint).
+    `sizes` param can contain comma-separated list of sizes to include.
+    """
+    config = current_app.config.get_namespace('API_')
+    api_manager = ApiManager(**config)
+    if resource_name not in api_manager.manager_names:
+        abort(Response("Resource not found: {}".format(resource_name), status=404))
+    res = api_manager.get_manager(resource_name)
+    if res.model is not Media:
+        abort(Response("Resource type {} cannot be bundled".format(resource_name), status=400))
+
+    url_params = request.args.to_dict()
+    sizes = [s for s in (url_params.pop('sizes', None) or '').split(',') if s]
+
+    def generate():
+        with api_manager:
+            items = res.list(cached=True, url_params=url_params)
+            for chunk in iter_media_bundle(items, api_manager.storage, sizes=sizes):
+                yield chunk
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/zip',
+                    headers={'Content-Disposition': "attachment;filename={}.zip".format(resource_name)})
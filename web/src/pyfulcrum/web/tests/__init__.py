@@ -12,6 +12,7 @@ from pyfulcrum.lib.tests import BaseTestCase
 
 from ..webhooks import webhooks
 from ..api import api
+from ..media import media
 
 
 
@@ -30,4 +31,5 @@ class WebTestCase(BaseTestCase):
         self._app.config.from_mapping(self._config)
         self._app.register_blueprint(webhooks)
         self._app.register_blueprint(api)
+        self._app.register_blueprint(media)
         self._test_client = self._app.test_client()
@@ -1,6 +1,12 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import json
+from unittest import mock
+
+from sqlalchemy import event
+
+from pyfulcrum.lib import columnar
 from pyfulcrum.web.tests import WebTestCase
 
 class ApiTestCase(WebTestCase):
@@ -55,6 +61,13 @@ class ApiTestCase(WebTestCase):
         self.assertFalse(resp.is_json)
         self.assertTrue(resp.data.startswith(b'PK'))
 
+        resp = self._test_client.get('/api/records/?format=gpkg')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.data.startswith(b'SQLite format 3'))
+
+        resp = self._test_client.get('/api/forms/?format=fgb')
+        self.assertEqual(resp.status_code, 400)
+
         resp = self._test_client.get('/api/records/?format=invalid')
         self.assertTrue(resp.status_code, 400)
 
@@ -63,3 +76,141 @@ class ApiTestCase(WebTestCase):
         self.assertFalse(resp.is_json)
         self.assertTrue(resp.data.startswith(b'"id","altitude",'))
 
+
+    def test_api_values_filters(self):
+        with self.api_manager:
+            self.api_manager.forms.list(cached=False)
+            self.api_manager.records.list(cached=False)
+
+        resp = self._test_client.get('/api/records/?values.hydrant_type=Pillar')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['total'], 1)
+
+        resp = self._test_client.get('/api/records/?values.diameter__gt=4')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['total'], 0)
+
+        resp = self._test_client.get('/api/records/?values.diameter__like=4')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['total'], 0)
+
+        resp = self._test_client.get('/api/records/?values.diameter__gt=abc')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_api_spatial_filters(self):
+        with self.api_manager:
+            self.api_manager.forms.list(cached=False)
+            self.api_manager.records.list(cached=False)
+
+        resp = self._test_client.get('/api/records/?format=geojson&bbox=-74,42,-73,43')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['total'], 1)
+
+        resp = self._test_client.get('/api/records/?near=-73.89,42.82&radius=100')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['total'], 0)
+
+        resp = self._test_client.get('/api/records/?bbox=-74,42')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_api_changes(self):
+        with self.api_manager:
+            self.api_manager.forms.list(cached=False)
+            self.api_manager.records.list(cached=False)
+
+        resp = self._test_client.get('/api/changes/?resource=records')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([c['resource'] for c in resp.json['items']], ['records'])
+        cursor = resp.json['next']
+
+        resp = self._test_client.get('/api/changes/?since={}'.format(cursor))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['items'], [])
+        self.assertEqual(resp.json['next'], cursor)
+
+        resp = self._test_client.get('/api/changes/?resource=values')
+        self.assertEqual(resp.status_code, 400)
+        resp = self._test_client.get('/api/changes/?since=x')
+        self.assertEqual(resp.status_code, 400)
+        resp = self._test_client.get('/api/changes/?per_page=-1')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_api_ogr_formats_empty(self):
+        with self.api_manager:
+            self.api_manager.forms.list(cached=False)
+            self.api_manager.records.list(cached=False)
+
+        for format in ('shp', 'kml', 'gpkg', 'fgb',):
+            resp = self._test_client.get('/api/records/?format={}&record_id=missing'.format(format))
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.data, b'')
+
+    def test_api_stream_transaction(self):
+        with self.api_manager:
+            self.api_manager.forms.list(cached=False)
+            self.api_manager.records.list(cached=False)
+
+        transactions = []
+
+        def begin(conn):
+            transactions.append(conn)
+
+        # page is counted and items are streamed in one transaction
+        event.listen(self._conn, 'begin', begin)
+        try:
+            for format in ('json', 'csv', 'ndjson',):
+                del transactions[:]
+                resp = self._test_client.get('/api/records/?format={}'.format(format))
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn(b'4e1c33ad-5496-4818-826f-504e66239b4d', resp.data)
+                self.assertEqual(len(transactions), 1, format)
+        finally:
+            event.remove(self._conn, 'begin', begin)
+
+    def test_api_ogr_driver_missing(self):
+        with self.api_manager:
+            self.api_manager.forms.list(cached=False)
+            self.api_manager.records.list(cached=False)
+
+        with mock.patch('pyfulcrum.lib.formats.ogr.GetDriverByName', return_value=None):
+            resp = self._test_client.get('/api/records/?format=fgb')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_api_line_formats(self):
+        with self.api_manager:
+            self.api_manager.forms.list(cached=False)
+            self.api_manager.records.list(cached=False)
+
+        resp = self._test_client.get('/api/records/?format=ndjson')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        lines = resp.data.decode('utf-8').splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(json.loads(lines[0])['class'], 'Record')
+
+        resp = self._test_client.get('/api/records/?format=geojsonseq')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        lines = resp.data.decode('utf-8').splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(json.loads(lines[0])['type'], 'Feature')
+
+        resp = self._test_client.get('/api/forms/?format=geojsonseq')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_api_columnar_formats(self):
+        with self.api_manager:
+            self.api_manager.forms.list(cached=False)
+            self.api_manager.records.list(cached=False)
+
+        resp = self._test_client.get('/api/forms/?format=parquet')
+        self.assertEqual(resp.status_code, 400)
+        resp = self._test_client.get('/api/records/?format=parquet')
+        if not columnar.is_available():
+            self.assertEqual(resp.status_code, 400)
+            return
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.data.startswith(b'PAR1'))
+        resp = self._test_client.get('/api/records/?format=arrow')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.data.startswith(b'ARROW1'))
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import zipfile
+from io import BytesIO
+
+from pyfulcrum.web.tests import WebTestCase
+from pyfulcrum.lib.tests import STATIC_FILE
+
+PHOTO_ID = '622997aa-929f-4758-bd86-859cc7435e3f'
+
+
+class MediaTestCase(WebTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # test client uses separate db session, data must be commited
+        with self.api_manager:
+            self.api_manager.forms.list(cached=False)
+            self.api_manager.records.list(cached=False)
+            self.api_manager.photos.list(cached=False)
+        with open(STATIC_FILE, 'rb') as f:
+            self._file_data = f.read()
+
+    def test_media(self):
+        resp = self._test_client.get('/media/{}/original'.format(PHOTO_ID))
+        self.assertEqual(resp.status_code, 200, resp.data)
+        self.assertEqual(resp.data, self._file_data)
+        self.assertEqual(resp.mimetype, 'image/jpeg')
+        etag = resp.headers.get('ETag')
+        self.assertTrue(etag)
+
+        resp = self._test_client.get('/media/{}/original'.format(PHOTO_ID),
+                                     headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+
+        resp = self._test_client.get('/media/{}/original'.format(PHOTO_ID),
+                                     headers={'Range': 'bytes=2-5'})
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp.data, self._file_data[2:6])
+
+        resp = self._test_client.get('/media/{}/invalid'.format(PHOTO_ID))
+        self.assertEqual(resp.status_code, 404)
+
+        resp = self._test_client.get('/media/invalid/original')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_media_accel_redirect(self):
+        self._app.config['MEDIA_ACCEL_REDIRECT'] = '/storage-internal/'
+        resp = self._test_client.get('/media/{}/large'.format(PHOTO_ID))
+        self.assertEqual(resp.status_code, 200, resp.data)
+        self.assertEqual(resp.data, b'')
+        accel = resp.headers.get('X-Accel-Redirect')
+        self.assertTrue(accel.startswith('/storage-internal/'), accel)
+        self.assertTrue('/photo_large.' in accel, accel)
+
+        resp = self._test_client.get('/media/{}/large'.format(PHOTO_ID),
+                                     headers={'If-None-Match': resp.headers['ETag']})
+        self.assertEqual(resp.status_code, 304)
+
+    def test_media_bundle(self):
+        resp = self._test_client.get('/media/bundle/photos/?sizes=original')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'application/zip')
+        zf = zipfile.ZipFile(BytesIO(resp.data), mode='r')
+        names = zf.namelist()
+        self.assertEqual(names[0], 'manifest.csv')
+        self.assertEqual(len(names), 2, names)
+        self.assertEqual(zf.read(names[1]), self._file_data)
+
+        resp = self._test_client.get('/media/bundle/records/')
+        self.assertEqual(resp.status_code, 400)
+        resp = self._test_client.get('/media/bundle/invalid/')
+        self.assertEqual(resp.status_code, 404)